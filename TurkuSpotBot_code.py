@@ -3,6 +3,7 @@ from telebot import types
 import os
 import csv
 import logging
+import logging.handlers
 import time
 import datetime
 import threading
@@ -11,6 +12,25 @@ import hashlib
 import json
 import sqlite3
 import queue
+import collections
+import functools
+import concurrent.futures
+import atexit
+import contextlib
+import itertools
+import bisect
+import sys
+import urllib.request
+import hmac
+import http.server
+import uuid
+import gzip
+import io
+import re
+import heapq
+import argparse
+import math
+import shutil
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -21,13 +41,33 @@ local_storage_dir = 'XXX'
 # Telegram bot token
 TOKEN = 'XXX'  
 
+# Optional Bot API base URL, e.g. a local Bot API server: 'http://localhost:8081/bot{0}/{1}'
+TELEGRAM_API_URL = None
+
+# 'threaded' long-polls with TeleBot.get_updates, 'webhook' receives updates on the built-in HTTP server
+BOT_RUNTIME = 'threaded'
+
+# Every runtime hands updates to the same chat-sharded executor
+UPDATE_SHARDS = 16  # Worker threads; all updates of one chat go to the same one
+UPDATE_SHARD_QUEUE_SIZE = 100  # Updates waiting per shard before intake is pushed back
+UPDATE_DEDUP_WINDOW = 10000  # Recent update_ids remembered to drop redelivered updates
+CONFIRM_DEDUP_WINDOW = 10000  # Recent submission tokens remembered to drop repeated confirmations
+
+# Webhook mode
+WEBHOOK_URL = None  # Public HTTPS URL registered with Telegram, None to manage the webhook elsewhere
+WEBHOOK_LISTEN = '127.0.0.1'  # Address the HTTP server binds to, usually behind a TLS reverse proxy
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = '/telegram-webhook'
+WEBHOOK_SECRET_TOKEN = 'XXX'  # Compared with the X-Telegram-Bot-Api-Secret-Token header
+WEBHOOK_MAX_BODY = 1024 * 1024  # Largest update body accepted, in bytes
+
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
+
 bot = telebot.TeleBot(TOKEN, threaded=True)
 
 data_file = 'city_issue_data.csv'
 
-# Dictionaries to store user data during conversation
-user_data = {}
-
 # File to store the last used id
 last_id_file = os.path.join(local_storage_dir, 'last_id.txt')
 
@@ -43,59 +83,71 @@ last_id_lock = threading.Lock()
 
 
 
-def generate_anonymous_id(user_id):
+def generate_anonymous_id(user_id, attempt=0):
     """
     Generate a consistent anonymous ID for a Telegram user_id.
     Format: AdjectiveNoun123
     
+    The adjective, noun and number are read straight from the SHA-256 digest,
+    so the derivation is pure: it never touches the shared random module and
+    is safe to call from concurrent handler threads.
+    
     Args:
         user_id (int): Telegram user ID
+        attempt (int, optional): Collision retry counter, 0 for the primary nickname
         
     Returns:
         str: Anonymous ID string
     """
-    # Random nickname generation data
-    adjectives = [
-        'Agile', 'Ancient', 'Brave', 'Bright', 'Calm', 'Charming',
-        'Clever', 'Cool', 'Creative', 'Cute', 'Daring', 'Eager', 
-        'Energetic', 'Friendly', 'Funny', 'Gentle', 'Graceful', 
-        'Happy', 'Helpful', 'Honest', 'Kind', 'Lively', 'Lucky', 
-        'Mysterious', 'Nice', 'Nimble', 'Peaceful', 'Playful',
-        'Proud', 'Quick', 'Quiet', 'Smart', 'Smooth', 'Soft', 
-        'Strong', 'Swift', 'Thoughtful', 'Warm', 'Wild', 'Wise'
-    ]
-    nouns = [
-        'Antelope', 'Badger', 'Bear', 'Beaver', 'Bee', 'Butterfly',
-        'Cat', 'Chicken', 'Deer', 'Dog', 'Dolphin', 'Duck', 'Eagle', 
-        'Elephant', 'Fox', 'Frog', 'Giraffe', 'Goat', 'Hamster', 
-        'Hawk', 'Hedgehog', 'Horse', 'Koala', 'Lion', 'Lizard', 
-        'Monkey', 'Moose', 'Mouse', 'Owl', 'Panda', 'Parrot',
-        'Penguin', 'Rabbit', 'Raccoon', 'Seal', 'Sheep', 'Squirrel', 
-        'Swan', 'Tiger', 'Turtle', 'Wolf', 'Zebra'
-    ]
-    
     # Create a hash of the user_id to ensure the same user always gets the same anonymous ID
-    # Use SHA-256 for good distribution
-    hash_obj = hashlib.sha256(str(user_id).encode())
-    hash_hex = hash_obj.hexdigest()
+    # Retries hash a suffixed key so each attempt lands somewhere else in the namespace
+    key = str(user_id) if attempt == 0 else f"{user_id}:{attempt}"
+    digest = hashlib.sha256(key.encode()).digest()
     
-    # Use the hash to seed the random generator for consistent results
-    random.seed(hash_hex)
+    # 64 bits of digest split into mixed-radix indices; the modulo bias is negligible
+    value = int.from_bytes(digest[:8], 'big')
+    value, adjective_index = divmod(value, len(adjectives))
+    value, noun_index = divmod(value, len(nouns))
+    number = value % 1000
     
-    # Select a random adjective and noun
+    # Create and return the anonymous ID
+    return f"{adjectives[adjective_index]}{nouns[noun_index]}{number:03d}"
+
+
+def _generate_seeded_anonymous_id(user_id):
+    """Previous reseeding derivation, kept only for benchmark_nickname_derivation."""
+    hash_hex = hashlib.sha256(str(user_id).encode()).hexdigest()
+    random.seed(hash_hex)
     adjective = random.choice(adjectives)
     noun = random.choice(nouns)
-    
-    # Generate a number between 0 and 999
     number = random.randint(0, 999)
-    
-    # Create and return the anonymous ID
-    anonymous_id = f"{adjective}{noun}{number:03d}"
-    
-    # Reset the random seed to avoid affecting other random operations
     random.seed()
+    return f"{adjective}{noun}{number:03d}"
+
+
+def benchmark_nickname_derivation(iterations=100000):
+    """
+    Time the digest-based derivation against the previous random.seed approach
     
-    return anonymous_id
+    Args:
+        iterations (int, optional): Number of IDs derived with each approach
+        
+    Returns:
+        dict: Microseconds per call for both approaches and the speedup
+    """
+    results = {}
+    for name, derive in (('seeded', _generate_seeded_anonymous_id), ('digest', generate_anonymous_id)):
+        start = time.perf_counter()
+        for user_id in range(iterations):
+            derive(user_id)
+        results[name] = (time.perf_counter() - start) / iterations * 1e6
+    
+    results['speedup'] = results['seeded'] / results['digest']
+    flow_logger.info(
+        f"Nickname derivation: seeded {results['seeded']:.2f}us, "
+        f"digest {results['digest']:.2f}us ({results['speedup']:.1f}x)"
+    )
+    return results
 
 # Messages dictionary
 
@@ -562,15 +614,174 @@ def update_welcome_message():
 
 # Constants and configuration
 DB_POOL_SIZE = 10  # Adjust based on expected concurrent users
+DB_READ_POOL_SIZE = 10  # Read-only connections for lookups and exports
+DB_READ_MMAP_SIZE = 256 * 1024 * 1024  # Bytes of the database file memory-mapped by readers
 db_file = '/scratch/project_2004147/telebot/turkubot.db'
-db_pool = queue.Queue(maxsize=DB_POOL_SIZE)
 db_lock = threading.Lock()
+IDENTITY_CACHE_SIZE = 50000  # Max Telegram ID -> nickname mappings kept in memory
+NICKNAME_MAX_ATTEMPTS = 16  # Derivations tried before a new user gets a fallback nickname
+
+# Conversation state kept in memory per Telegram user
+SESSION_IDLE_TTL = 3600  # Seconds of inactivity before a session is dropped
+SESSION_MAX_ENTRIES = 20000  # Max sessions kept; least recently used idle ones go first
+SESSION_SWEEP_INTERVAL = 60  # Seconds between background sweeps of idle sessions
+KEYBOARD_CACHE_SIZE = 4096  # Serialized multi-select keyboards kept in the LRU cache
+KEYBOARD_REFRESH_DELAY = 0.4  # Seconds a multi-select keyboard edit waits for further taps
+
+# Outbound Bot API pacing (Telegram allows ~30 messages/s overall and ~1/s per chat)
+OUTBOUND_GLOBAL_RATE = 30  # Requests per second across all chats
+OUTBOUND_GLOBAL_BURST = 30  # Requests that may go out back to back after a quiet period
+OUTBOUND_CHAT_RATE = 1  # Messages and edits per second in one chat
+OUTBOUND_CHAT_BURST = 3  # Per-chat burst, enough for the answer + edit + send of one tap
+OUTBOUND_WORKERS = 8  # Threads performing the HTTP requests
+OUTBOUND_MAX_RETRIES = 5  # 429 responses tolerated per request before giving up
+OUTBOUND_RESULT_TIMEOUT = 60  # Seconds a handler waits for its request to be sent
+
+# Write-behind settings for the single writer thread
+WRITER_QUEUE_SIZE = 2000  # Max pending write jobs before callers block
+WRITER_BATCH_SIZE = 200  # Max write jobs committed together in one transaction
+WRITER_FLUSH_INTERVAL = 0.01  # Seconds to wait for more jobs before committing a batch
+WRITER_SUBMIT_TIMEOUT = 10  # Seconds to wait for room in the write queue
+WRITER_RESULT_TIMEOUT = 30  # Seconds to wait for a queued write to be committed
+
+# Data export
+EXPORT_DIR = '/scratch/project_2004147/telebot'
+EXPORT_PAGE_SIZE = 5000  # Rows read per keyset page; the read connection is released between pages
+EXPORT_BUFFER_SIZE = 1024 * 1024  # Bytes buffered before writing to the (compressed) file
+EXPORT_GZIP_LEVEL = 6
+EXPORT_ZSTD_LEVEL = 3  # zstd needs the optional zstandard package
+EXPORT_DELTA_DIR = os.path.join(EXPORT_DIR, 'deltas')  # Append-only incremental exports
+EXPORT_PARQUET_ROW_GROUP_SIZE = 100000  # Rows per Parquet row group, also the rows held in memory
+EXPORT_PARQUET_COMPRESSION = 'zstd'  # Parquet export needs the optional pyarrow package
+EXPORT_TILE_DIR = os.path.join(EXPORT_DIR, 'tiles')  # z/x/y.json count tiles for the map dashboard
+EXPORT_TILE_MIN_ZOOM = 8  # Whole region
+EXPORT_TILE_MAX_ZOOM = 16  # Street level
+
+# Spatial index
+COORDINATE_BACKFILL_BATCH_SIZE = 5000  # Rows converted per writer transaction when backfilling REAL coordinates
+EARTH_RADIUS_M = 6371008.8  # Mean Earth radius used for radius queries
+
+# Nearby duplicates: same-category reports this close in space and time share a cluster_id
+NEARBY_DUPLICATE_RADIUS_M = 100
+NEARBY_DUPLICATE_WINDOW = 24 * 60 * 60  # Seconds
+NEARBY_DUPLICATE_PRUNE_EVERY = 1000  # Inserts between sweeps dropping expired entries from every cell
+
+# Data flow log; handlers only enqueue records, a listener thread writes them
+FLOW_LOG_FILE = '/scratch/project_2004147/telebot/data_flow.log'
+FLOW_LOG_QUEUE_SIZE = 10000  # Records buffered before new ones are dropped
+FLOW_LOG_MAX_BYTES = 50 * 1024 * 1024  # Rotate when the file grows past this size
+FLOW_LOG_ROTATE_INTERVAL = 24 * 60 * 60  # ...or when it is this many seconds old
+FLOW_LOG_BACKUP_COUNT = 14  # Rotated files kept
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+    
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SizedTimedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotating file handler that rolls over on size or on age, whichever comes first.
+    
+    Backups are numbered like RotatingFileHandler's, so a size rollover within
+    one time interval never overwrites an earlier backup.
+    """
+    
+    def __init__(self, filename, max_bytes, interval, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+    
+    def shouldRollover(self, record):
+        if time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+    
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that never blocks the logging thread.
+    
+    When the queue is full the record is dropped and counted; the count is
+    logged as a warning with the next record that fits.
+    """
+    
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self._exc_formatter = logging.Formatter()
+        self._lock = threading.Lock()
+        self.dropped = 0
+        self._unreported = 0
+    
+    def prepare(self, record):
+        # Resolve arguments and traceback now, since they may not survive the trip to
+        # the listener; the traceback stays separate so the JSON keeps it in its own field
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+    
+    def enqueue(self, record):
+        with self._lock:
+            unreported = self._unreported
+        if unreported:
+            notice = logging.LogRecord(
+                record.name, logging.WARNING, __file__, 0,
+                f"Dropped {unreported} log records, logging queue was full", None, None
+            )
+            try:
+                self.queue.put_nowait(notice)
+            except queue.Full:
+                pass
+            else:
+                with self._lock:
+                    self._unreported -= unreported
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._unreported += 1
+    
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'dropped': self.dropped}
+
+
+flow_log_file_handler = SizedTimedRotatingFileHandler(
+    FLOW_LOG_FILE, FLOW_LOG_MAX_BYTES, FLOW_LOG_ROTATE_INTERVAL, FLOW_LOG_BACKUP_COUNT
+)
+flow_log_file_handler.setFormatter(JsonLogFormatter())
+flow_log_queue = queue.Queue(FLOW_LOG_QUEUE_SIZE)
+flow_log_handler = DroppingQueueHandler(flow_log_queue)
+flow_log_listener = logging.handlers.QueueListener(flow_log_queue, flow_log_file_handler)
+# Started with the handler so importing the module never just fills the queue; registered
+# before anything else, so it stops last and still writes what the other shutdowns log
+flow_log_listener.start()
+atexit.register(flow_log_listener.stop)
 
 # Set up a separate logger for data flow
 flow_logger = logging.getLogger('TurkuBotDataFlow')
-flow_handler = logging.FileHandler('/scratch/project_2004147/telebot/data_flow.log')
-flow_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-flow_logger.addHandler(flow_handler)
+flow_logger.addHandler(flow_log_handler)
 flow_logger.setLevel(logging.INFO)
 
 # Random nickname generation data
@@ -593,18 +804,49 @@ nouns = [
     'Swan', 'Tiger', 'Turtle', 'Wolf', 'Zebra'
 ]
 
-def initialize_database():
-    """Initialize the SQLite database with required tables."""
+def _create_spatial_schema(cursor):
+    """
+    Add REAL lat/lon columns to submissions and an R*Tree index kept in sync by triggers
+    
+    Rows from before the migration have NULL lat/lon until backfill_coordinates
+    converts them; the update trigger then adds them to the index.
+    
+    Args:
+        cursor (sqlite3.Cursor): Cursor on the database to migrate
+    """
+    submission_columns = {row[1] for row in cursor.execute("PRAGMA table_info(submissions)")}
+    for column in ('lat', 'lon'):
+        if column not in submission_columns:
+            cursor.execute(f"ALTER TABLE submissions ADD COLUMN {column} REAL")
+    
+    # R*Tree boxes are stored as 32-bit floats rounded outwards, so queries re-check the REAL columns
+    cursor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS submissions_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS trg_submissions_rtree_insert AFTER INSERT ON submissions "
+        "WHEN NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL BEGIN "
+        "INSERT INTO submissions_rtree VALUES (NEW.id, NEW.lat, NEW.lat, NEW.lon, NEW.lon); END"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS trg_submissions_rtree_update AFTER UPDATE OF lat, lon ON submissions BEGIN "
+        "DELETE FROM submissions_rtree WHERE id = OLD.id; "
+        "INSERT INTO submissions_rtree SELECT NEW.id, NEW.lat, NEW.lat, NEW.lon, NEW.lon "
+        "WHERE NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL; END"
+    )
+    cursor.execute(
+        "CREATE TRIGGER IF NOT EXISTS trg_submissions_rtree_delete AFTER DELETE ON submissions BEGIN "
+        "DELETE FROM submissions_rtree WHERE id = OLD.id; END"
+    )
+
+
+def initialize_database(path=None):
+    """Initialize the SQLite database with required tables, in db_file unless another path is given."""
     with db_lock:
         try:
-            conn = sqlite3.connect(db_file, check_same_thread=False)
+            conn = open_db_connection(path=path)
             cursor = conn.cursor()
 
-            # Set pragmas for better performance
-            conn.execute("PRAGMA journal_mode=WAL")
-            conn.execute("PRAGMA synchronous=NORMAL")
-            conn.execute("PRAGMA busy_timeout=5000")
-
             # Create table for user submissions - using anonymized IDs
             create_submissions_table_query = '''
                 CREATE TABLE IF NOT EXISTS submissions (
@@ -652,6 +894,60 @@ def initialize_database():
             # Add indexes for better performance
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON submissions(user_id)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_timestamp ON submissions(timestamp)")
+            # Submissions written by one confirmation share a token; older rows have NULL
+            submission_columns = {row[1] for row in cursor.execute("PRAGMA table_info(submissions)")}
+            if 'submission_token' not in submission_columns:
+                cursor.execute("ALTER TABLE submissions ADD COLUMN submission_token TEXT")
+            cursor.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_submissions_token "
+                "ON submissions(submission_token, submission_type)"
+            )
+            
+            # Nearby same-category reports point at the id of the first one; NULL while unlinked
+            if 'cluster_id' not in submission_columns:
+                cursor.execute("ALTER TABLE submissions ADD COLUMN cluster_id INTEGER")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_submissions_cluster_id ON submissions(cluster_id)")
+            
+            # REAL coordinates and the R*Tree over them
+            _create_spatial_schema(cursor)
+            
+            # Preference rows get a new global version whenever an exported column changes,
+            # so incremental exports can find users whose earlier submissions need re-emitting
+            preference_columns = {row[1] for row in cursor.execute("PRAGMA table_info(user_preferences)")}
+            if 'version' not in preference_columns:
+                cursor.execute("ALTER TABLE user_preferences ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_preferences_version ON user_preferences(version)")
+            bump_version = '''
+                UPDATE user_preferences
+                SET version = (SELECT COALESCE(MAX(version), 0) + 1 FROM user_preferences)
+                WHERE user_id = NEW.user_id;
+            '''
+            cursor.execute(
+                "CREATE TRIGGER IF NOT EXISTS trg_user_preferences_version_insert "
+                f"AFTER INSERT ON user_preferences BEGIN {bump_version} END"
+            )
+            cursor.execute(
+                "CREATE TRIGGER IF NOT EXISTS trg_user_preferences_version_update "
+                "AFTER UPDATE OF age, gender, occupation, time_in_turku ON user_preferences "
+                "WHEN OLD.age IS NOT NEW.age OR OLD.gender IS NOT NEW.gender "
+                "OR OLD.occupation IS NOT NEW.occupation OR OLD.time_in_turku IS NOT NEW.time_in_turku "
+                f"BEGIN {bump_version} END"
+            )
+            
+            # High-water marks of the incremental exports
+            create_export_watermarks_table = '''
+                CREATE TABLE IF NOT EXISTS export_watermarks (
+                    name TEXT PRIMARY KEY,
+                    last_submission_id INTEGER NOT NULL,
+                    last_preference_version INTEGER NOT NULL,
+                    sequence INTEGER NOT NULL,
+                    updated_at TEXT
+                );
+            '''
+            cursor.execute(create_export_watermarks_table)
+            
+            # Not UNIQUE: databases from before collision checks may already hold duplicates
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_nicknames_nickname ON user_nicknames(nickname)")
 
             conn.commit()
             conn.close()
@@ -667,376 +963,3345 @@ def initialize_database():
 
 
 # Database connection pool functions
-def initialize_connection_pool():
-    """Initialize the database connection pool."""
-    for _ in range(DB_POOL_SIZE):
-        try:
-            conn = sqlite3.connect(db_file, check_same_thread=False)
-            # Set pragmas for better performance
-            conn.execute("PRAGMA journal_mode=WAL")
-            conn.execute("PRAGMA synchronous=NORMAL")
-            conn.execute("PRAGMA busy_timeout=5000")
-            db_pool.put(conn)
-        except Exception as e:
-            logging.exception(f"Error initializing connection pool: {e}")
-
-def get_db_connection():
-    """Get a database connection from the pool or create a new one if needed."""
-    try:
-        # Try to get a connection from the pool with a timeout
-        connection = db_pool.get(block=True, timeout=5)
+def open_db_connection(isolation_level='', read_only=False, path=None):
+    """
+    Open a connection to the bot database with the standard pragmas applied
+    
+    Args:
+        isolation_level (str, optional): sqlite3 isolation level, None for autocommit
+        read_only (bool, optional): Open the file with mode=ro and refuse writes
+        path (str, optional): Database file, db_file by default
         
-        # Test if the connection is valid
-        try:
-            connection.execute("SELECT 1")
-            return connection
-        except sqlite3.Error:
-            # Connection is stale, create a new one
-            try:
-                connection.close()
-            except:
-                pass
-            flow_logger.warning("Retrieved stale connection from pool, creating new one")
-            return sqlite3.connect(db_file, check_same_thread=False)
-            
-    except queue.Empty:
-        # If pool is empty and timeout expires, create a new connection
-        flow_logger.warning("DB pool exhausted, creating new connection")
-        return sqlite3.connect(db_file, check_same_thread=False)
-    except Exception as e:
-        flow_logger.error(f"Error getting DB connection: {e}")
-        # Always return a working connection
-        return sqlite3.connect(db_file, check_same_thread=False)
+    Returns:
+        sqlite3.Connection: New connection usable from any thread
+    """
+    if read_only:
+        # Readers never take the write lock, so WAL lets them run next to the writer
+        uri = f"file:{urllib.request.pathname2url(os.path.abspath(path or db_file))}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=isolation_level)
+        conn.execute("PRAGMA query_only=ON")
+        conn.execute(f"PRAGMA mmap_size={int(DB_READ_MMAP_SIZE)}")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+    
+    conn = sqlite3.connect(path or db_file, check_same_thread=False, isolation_level=isolation_level)
+    # Set pragmas for better performance
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
 
-def return_db_connection(connection):
-    """Return a connection to the pool or close it if pool is full."""
-    try:
-        # Test if the connection is still valid
+
+class ConnectionPool:
+    """
+    Fixed-size pool of SQLite connections opened through open_db_connection.
+    
+    Connections are not probed on checkout or return; a connection is only
+    validated after the block that used it raised a database error, and is
+    discarded if the validation fails. When the pool is exhausted for longer
+    than the timeout, an overflow connection with the same pragmas is opened
+    and closed again on return. A read_only pool opens its connections with
+    mode=ro and query_only so it can never contend for the write lock.
+    """
+    
+    def __init__(self, size, timeout=5, read_only=False, path=None):
+        self.size = size
+        self.timeout = timeout
+        self.read_only = read_only
+        # Database file, db_file when None
+        self.path = path
+        self._idle = queue.LifoQueue()
+        self._pooled = set()
+        self._open_count = 0
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.overflow_created = 0
+        self.discarded = 0
+    
+    def initialize(self):
+        """Open connections until the pool is full."""
+        while True:
+            conn = self._open_pooled()
+            if conn is None:
+                return
+            self._idle.put(conn)
+    
+    def _open_pooled(self):
+        # Reserve a slot first so concurrent callers never exceed the pool size
+        with self._lock:
+            if self._open_count >= self.size:
+                return None
+            self._open_count += 1
         try:
-            connection.execute("SELECT 1")
-            # Try to return the connection to the pool
-            db_pool.put(connection, block=False)
-        except (sqlite3.Error, Exception):
-            # If connection is no longer valid, close it
-            try:
-                connection.close()
-            except:
-                pass
-    except queue.Full:
-        # If pool is full, close the connection
+            conn = open_db_connection(read_only=self.read_only, path=self.path)
+        except Exception:
+            with self._lock:
+                self._open_count -= 1
+            raise
+        with self._lock:
+            self._pooled.add(id(conn))
+        return conn
+    
+    def acquire(self):
+        """Check out a connection, opening an overflow one if none frees up in time."""
+        start = time.monotonic()
         try:
-            connection.close()
-        except:
-            pass
-    except Exception as e:
-        # Ensure connection is closed on any error
-        flow_logger.error(f"Error returning DB connection: {e}")
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            # Grow lazily up to the pool size before waiting for a free connection
+            conn = self._open_pooled()
+            if conn is None:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    flow_logger.warning("DB pool exhausted, creating overflow connection")
+                    conn = open_db_connection(read_only=self.read_only, path=self.path)
+                    with self._lock:
+                        self.overflow_created += 1
+        
+        waited = time.monotonic() - start
+        with self._lock:
+            self.checkouts += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+        return conn
+    
+    def release(self, conn, failed=False):
+        """
+        Return a connection to the pool
+        
+        Args:
+            conn (sqlite3.Connection): Connection obtained from acquire()
+            failed (bool): The connection was in use when a database error occurred
+        """
+        with self._lock:
+            pooled = id(conn) in self._pooled
+        
+        healthy = True
+        try:
+            # Never hand out a connection with a transaction left open
+            if conn.in_transaction:
+                conn.rollback()
+            if failed:
+                conn.execute("SELECT 1")
+        except sqlite3.Error:
+            healthy = False
+        
+        if pooled and healthy:
+            self._idle.put(conn)
+            return
+        
+        if pooled:
+            flow_logger.warning("Discarding broken DB connection from pool")
+            with self._lock:
+                self._pooled.discard(id(conn))
+                self._open_count -= 1
+                self.discarded += 1
         try:
-            connection.close()
+            conn.close()
         except:
             pass
+    
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a with block
+        
+        Yields:
+            sqlite3.Connection: Pooled (or overflow) connection
+        """
+        conn = self.acquire()
+        failed = False
+        try:
+            yield conn
+        except sqlite3.Error:
+            failed = True
+            raise
+        finally:
+            self.release(conn, failed=failed)
+    
+    def stats(self):
+        """Return a snapshot of the pool metrics."""
+        with self._lock:
+            return {
+                'read_only': self.read_only,
+                'size': self.size,
+                'open': self._open_count,
+                'idle': self._idle.qsize(),
+                'checkouts': self.checkouts,
+                'wait_time_total': self.wait_time_total,
+                'wait_time_max': self.wait_time_max,
+                'overflow_created': self.overflow_created,
+                'discarded': self.discarded
+            }
 
-def get_anonymous_user_id(telegram_id):
-    conn = get_db_connection()
-    anonymous_id = None
+db_pool = ConnectionPool(DB_POOL_SIZE)
+# Lookups and exports read through their own pool so they never queue behind writers
+db_read_pool = ConnectionPool(DB_READ_POOL_SIZE, read_only=True)
+
+def initialize_connection_pool():
+    """Initialize the read-write and read-only database connection pools."""
     try:
-        cursor = conn.cursor()
-        
-        # Check if we already have a nickname for this user
-        cursor.execute("SELECT nickname FROM user_nicknames WHERE telegram_id = ?", (str(telegram_id),))
-        result = cursor.fetchone()
-        
-        if result:
-            # Store existing nickname
-            anonymous_id = result[0]
-        else:
-            # Create a new nickname
-            # Hash the telegram_id to ensure consistency
-            hash_obj = hashlib.sha256(str(telegram_id).encode())
-            hash_hex = hash_obj.hexdigest()
-            
-            # Use hash to seed the random generator
-            random.seed(hash_hex)
-            
-            # Generate the anonymous ID
-            adjective = random.choice(adjectives)
-            noun = random.choice(nouns)
-            number = random.randint(0, 999)
-            anonymous_id = f"{adjective}{noun}{number:03d}"
-            
-            # Reset the random seed
-            random.seed()
-            
-            # Store the mapping in the database
-            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            cursor.execute(
-                "INSERT INTO user_nicknames (telegram_id, nickname, created_at) VALUES (?, ?, ?)",
-                (str(telegram_id), anonymous_id, now)
-            )
-            conn.commit()
-            
+        db_pool.initialize()
     except Exception as e:
-        flow_logger.error(f"Error in get_anonymous_user_id: {e}")
-        # Make sure to not expose the error details to log if they contain the actual telegram_id
-        conn.rollback()
-        # Fallback to a generic ID if something goes wrong
-        anonymous_id = f"Anonymous{random.randint(10000, 99999)}"
-    finally:
-        return_db_connection(conn)
-        return anonymous_id
-
+        logging.exception(f"Error initializing connection pool: {e}")
+    try:
+        db_read_pool.initialize()
+    except Exception as e:
+        logging.exception(f"Error initializing read-only connection pool: {e}")
 
-def update_user_preferences(anonymous_id, consent=None, age=None, gender=None, 
-                           occupation=None, time_in_turku=None, language=None):
+class SubmissionWriter:
     """
-    Update or create user preferences in the database
+    Single writer thread that applies queued write jobs in group commits.
     
-    Args:
-        anonymous_id (str): Anonymous user ID
-        consent (bool, optional): User consent status
-        age (str, optional): Age group
-        gender (str, optional): Gender
-        occupation (str, optional): Occupation
-        time_in_turku (str, optional): Time living in Turku
-        language (str, optional): Preferred language (en, fi, sv, uk)
-        
-    Returns:
-        bool: Success status
+    A job is a callable taking a sqlite3 connection. Jobs are drained from a
+    bounded queue and up to batch_size of them run in one BEGIN IMMEDIATE
+    transaction, each inside its own savepoint so a failing job does not
+    take the rest of the batch down with it. The future returned by submit()
+    resolves with the job's return value only after the batch is committed.
+    Jobs must not commit or roll back themselves.
     """
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # Check if user already exists
-        cursor.execute("SELECT user_id FROM user_preferences WHERE user_id = ?", (anonymous_id,))
-        exists = cursor.fetchone()
-        
-        if exists:
-            # Update existing user
-            # Build the SET part of the query dynamically based on which fields are provided
-            set_parts = []
-            params = []
-            
-            if consent is not None:
-                set_parts.append("consent = ?")
-                params.append(1 if consent else 0)
-            
-            if age is not None:
-                set_parts.append("age = ?")
-                params.append(age)
-                
-            if gender is not None:
-                set_parts.append("gender = ?")
-                params.append(gender)
-                
-            if occupation is not None:
-                set_parts.append("occupation = ?")
-                params.append(occupation)
-                
-            if time_in_turku is not None:
-                set_parts.append("time_in_turku = ?")
-                params.append(time_in_turku)
-                
-            if language is not None:
-                set_parts.append("language = ?")
-                params.append(language)
-            
-            # Always update last_active
-            set_parts.append("last_active = ?")
-            params.append(now)
-            
-            # Add user_id to params
-            params.append(anonymous_id)
+    
+    _STOP = object()
+    
+    def __init__(self, batch_size, flush_interval, queue_size):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._conn = None
+        self._stats_lock = threading.Lock()
+        self.jobs = 0
+        self.failed_jobs = 0
+        self.commits = 0
+        self.max_batch = 0
+    
+    def start(self):
+        """Start the writer thread if it is not already running."""
+        if self.is_running():
+            return
+        self._thread = threading.Thread(target=self._run, name='SubmissionWriter', daemon=True)
+        self._thread.start()
+    
+    def stop(self, timeout=None):
+        """Flush everything queued so far and stop the writer thread."""
+        if not self.is_running():
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+    
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    def submit(self, job, timeout=WRITER_SUBMIT_TIMEOUT):
+        """
+        Queue a write job, blocking while the queue is full
+        
+        Returns:
+            concurrent.futures.Future: Resolves to the job result once committed
+        """
+        future = concurrent.futures.Future()
+        try:
+            self._queue.put((job, future), timeout=timeout)
+        except queue.Full:
+            future.set_exception(RuntimeError("Write queue is full"))
+        return future
+    
+    def stats(self):
+        """Return a snapshot of the writer counters."""
+        with self._stats_lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'jobs': self.jobs,
+                'failed_jobs': self.failed_jobs,
+                'commits': self.commits,
+                'max_batch': self.max_batch
+            }
+    
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
             
-            # Execute update
-            query = f"UPDATE user_preferences SET {', '.join(set_parts)} WHERE user_id = ?"
-            cursor.execute(query, params)
+            # Gather more jobs until the batch is full or the flush interval passes
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        item = self._queue.get(timeout=remaining)
+                    else:
+                        item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
             
-        else:
-            # Create new user
-            cursor.execute(
-                """
-                INSERT INTO user_preferences 
-                (user_id, consent, last_active, age, gender, occupation, time_in_turku, language) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    anonymous_id, 
-                    1 if consent else 0 if consent is not None else None, 
-                    now, 
-                    age if age is not None else 'Not provided', 
-                    gender if gender is not None else 'Not provided', 
-                    occupation if occupation is not None else 'Not provided', 
-                    time_in_turku if time_in_turku is not None else 'Not provided',
-                    language if language is not None else 'en'
-                )
-            )
+            self._apply_batch(batch)
         
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+    
+    def _apply_batch(self, batch):
+        outcomes = []
+        committed = False
+        try:
+            if self._conn is None:
+                # Autocommit mode so transactions are controlled explicitly below
+                self._conn = open_db_connection(isolation_level=None)
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            for job, future in batch:
+                conn.execute("SAVEPOINT write_job")
+                try:
+                    result = job(conn)
+                    conn.execute("RELEASE SAVEPOINT write_job")
+                    outcomes.append((future, result, None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO SAVEPOINT write_job")
+                    conn.execute("RELEASE SAVEPOINT write_job")
+                    outcomes.append((future, None, e))
+            conn.execute("COMMIT")
+            committed = True
+        except Exception as e:
+            flow_logger.error(f"Write batch of {len(batch)} jobs failed: {e}")
+            try:
+                if self._conn is not None and self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                # Connection is unusable, reopen it for the next batch
+                try:
+                    self._conn.close()
+                except:
+                    pass
+                self._conn = None
+            outcomes = [(future, None, e) for _, future in batch]
+        
+        with self._stats_lock:
+            self.jobs += len(batch)
+            self.failed_jobs += sum(1 for _, _, error in outcomes if error is not None)
+            if committed:
+                self.commits += 1
+            self.max_batch = max(self.max_batch, len(batch))
+        
+        # Only resolve futures once the batch is durable
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+submission_writer = SubmissionWriter(WRITER_BATCH_SIZE, WRITER_FLUSH_INTERVAL, WRITER_QUEUE_SIZE)
+
+@contextlib.contextmanager
+def db_transaction():
+    """
+    Run a block on one pooled connection inside a BEGIN IMMEDIATE transaction
+    
+    Commits when the block finishes and rolls back if it raises.
+    
+    Yields:
+        sqlite3.Connection: Connection with the transaction open
+    """
+    with db_pool.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
         conn.commit()
-        return True
-    except Exception as e:
-        conn.rollback()
-        flow_logger.error(f"Error in update_user_preferences: {e}")
-        return False
-    finally:
-        return_db_connection(conn)
 
-def save_submission(anonymous_id, submission_type, standard_selections, custom_inputs,
-                  latitude, longitude, venue_title="", venue_address="", additional_info=""):
+def submit_write(job):
     """
-    Save a new user submission to the database
+    Run a write job through the writer thread, or inline if it is not running
     
     Args:
-        anonymous_id (str): Anonymous user ID
-        submission_type (str): 'issue' or 'improvement'
-        standard_selections (str): Semicolon-separated list of standard selections
-        custom_inputs (str): Semicolon-separated list of custom inputs
-        latitude (float): Location latitude
-        longitude (float): Location longitude
-        venue_title (str, optional): Venue title
-        venue_address (str, optional): Venue address
-        additional_info (str, optional): Additional information
+        job (callable): Function taking a connection; must not commit itself
         
     Returns:
-        int: Submission ID or 0 if failed
+        concurrent.futures.Future: Resolves to the job result once committed
     """
-    conn = get_db_connection()
+    if submission_writer.is_running():
+        return submission_writer.submit(job)
+    
+    future = concurrent.futures.Future()
     try:
-        cursor = conn.cursor()
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        cursor.execute(
-            """
-            INSERT INTO submissions
-            (user_id, submission_type, standard_selections, custom_inputs, 
-             latitude, longitude, venue_title, venue_address, additional_info, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                anonymous_id,
-                submission_type,
-                standard_selections,
-                custom_inputs,
-                str(latitude),
-                str(longitude),
-                venue_title,
-                venue_address,
-                additional_info,
-                now
-            )
-        )
-        
-        conn.commit()
-        submission_id = cursor.lastrowid
-        
-        flow_logger.info(f"Saved submission {submission_id} for user: {anonymous_id}")
-        return submission_id
+        with db_transaction() as conn:
+            result = job(conn)
+        future.set_result(result)
     except Exception as e:
-        conn.rollback()
-        flow_logger.error(f"Error in save_submission: {e}")
-        return 0
-    finally:
-        return_db_connection(conn)
+        future.set_exception(e)
+    return future
 
-def export_data_to_csv():
+class RecentKeys:
     """
-    Export all data from the database to CSV
+    Thread-safe set of the most recent capacity keys, oldest forgotten first.
     
-    Returns:
-        str: Path to the exported CSV file
+    A deque keeps insertion order as a ring and a set answers membership, so
+    checking and recording a key are both O(1).
     """
-    conn = get_db_connection()
-    try:
-        import csv
-        
-        # Output file path
-        output_dir = '/scratch/project_2004147/telebot'
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        
-        output_file = os.path.join(output_dir, f'city_issue_data_export_{int(time.time())}.csv')
-        
-        # Get all submissions with user info
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT s.id, s.user_id, s.submission_type, s.standard_selections, s.custom_inputs,
-                   s.latitude, s.longitude, s.venue_title, s.venue_address, s.additional_info,
-                   p.age, p.gender, p.occupation, p.time_in_turku, s.timestamp
-            FROM submissions s
-            LEFT JOIN user_preferences p ON s.user_id = p.user_id
-            ORDER BY s.id
-            """
-        )
-        
-        rows = cursor.fetchall()
-        
-        # Column names for the CSV
-        fieldnames = [
-            'id', 'anonymous_id', 'submission_type', 'standard_selections', 'custom_inputs',
-            'latitude', 'longitude', 'venue_title', 'venue_address', 'additional_info',
-            'age', 'gender', 'occupation', 'time_in_turku', 'timestamp'
-        ]
-        
-        # Write to CSV
-        with open(output_file, 'w', newline='', encoding='utf-8-sig') as csvfile:
-            writer = csv.writer(csvfile, delimiter=';', quoting=csv.QUOTE_ALL)
-            
-            # Write header
-            writer.writerow(fieldnames)
-            
-            # Write data rows
-            for row in rows:
-                writer.writerow(row)
-        
-        return output_file
-    except Exception as e:
-        flow_logger.error(f"Error in export_data_to_csv: {e}")
-        return None
-    finally:
-        return_db_connection(conn)
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._order = collections.deque()
+        self._keys = set()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+    
+    def add(self, key):
+        """
+        Record a key
+        
+        Returns:
+            bool: True if the key was new, False if it was seen recently
+        """
+        with self._lock:
+            if key in self._keys:
+                self.duplicates += 1
+                return False
+            self._keys.add(key)
+            self._order.append(key)
+            if len(self._order) > self.capacity:
+                self._keys.discard(self._order.popleft())
+            return True
+    
+    def discard(self, key):
+        """Forget a key recorded by add, e.g. when the work it stood for was refused."""
+        with self._lock:
+            # Its slot in the ring stays until it ages out; that only shortens the window
+            self._keys.discard(key)
+    
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._keys
 
 
-def get_user_language(user_id):
+class IdentityCache:
     """
-    Get the user's preferred language from database
+    Thread-safe, size-bounded LRU cache of Telegram ID -> nickname mappings.
     
-    Args:
-        user_id (int): Telegram user ID
-        
+    Nicknames never change once assigned, so entries never need invalidation;
+    the least recently used entry is evicted when the cache is full.
+    """
+    
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, telegram_id):
+        """Return the cached nickname or None, counting the hit/miss."""
+        key = str(telegram_id)
+        with self._lock:
+            nickname = self._entries.get(key)
+            if nickname is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return nickname
+    
+    def put(self, telegram_id, nickname):
+        """Store a mapping, evicting the least recently used entry if full."""
+        key = str(telegram_id)
+        with self._lock:
+            self._entries[key] = nickname
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def stats(self):
+        """Return a snapshot of the cache counters."""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+identity_cache = IdentityCache(IDENTITY_CACHE_SIZE)
+# Fallback IDs handed out while the nickname lookup fails; never mixed into identity_cache, so the
+# stored nickname takes over as soon as the database answers again
+fallback_identity_cache = IdentityCache(IDENTITY_CACHE_SIZE)
+
+# Idempotency guards: redelivered updates and repeated "confirm" taps are dropped in memory
+seen_update_ids = RecentKeys(UPDATE_DEDUP_WINDOW)
+confirmed_submission_tokens = RecentKeys(CONFIRM_DEDUP_WINDOW)
+
+def prewarm_identity_cache():
+    """
+    Load the most recently created nicknames into the identity cache
+    
+    Returns:
+        int: Number of mappings loaded
+    """
+    try:
+        with db_read_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT telegram_id, nickname FROM user_nicknames ORDER BY created_at DESC LIMIT ?",
+                (identity_cache.maxsize,)
+            )
+            rows = cursor.fetchall()
+            
+            # Insert oldest first so the newest users end up most recently used
+            for telegram_id, nickname in reversed(rows):
+                identity_cache.put(telegram_id, nickname)
+            
+            flow_logger.info(f"Identity cache prewarmed with {len(rows)} nicknames")
+            return len(rows)
+    except Exception as e:
+        flow_logger.error(f"Error in prewarm_identity_cache: {e}")
+        return 0
+
+class NicknameRegistry:
+    """
+    Assigns collision-free nicknames from the adjective x noun x 1000 namespace.
+    
+    Nicknames key user_preferences and submissions, so two Telegram users must
+    never share one. A new user gets the first derivation attempt whose
+    nickname is not yet registered in user_nicknames; already persisted
+    nicknames are never changed.
+    """
+    
+    def __init__(self, max_attempts):
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self.assigned = 0
+        self.collisions = 0
+        self.exhausted = 0
+    
+    @property
+    def namespace_size(self):
+        return len(adjectives) * len(nouns) * 1000
+    
+    def claim(self, telegram_id):
+        """
+        Return the nickname registered for telegram_id, registering a new one if needed
+        
+        Args:
+            telegram_id (int): Telegram user ID
+            
+        Returns:
+            str: Persisted nickname for the user
+        """
+        # Check if we already have a nickname for this user
+        with db_read_pool.connection() as conn:
+            result = conn.execute(
+                "SELECT nickname FROM user_nicknames WHERE telegram_id = ?", (str(telegram_id),)
+            ).fetchone()
+        if result:
+            return result[0]
+        
+        # The single writer serializes registrations, so two claims cannot take the same nickname
+        anonymous_id, collisions = submit_write(
+            functools.partial(self._register, telegram_id=telegram_id)
+        ).result(timeout=WRITER_RESULT_TIMEOUT)
+        
+        if collisions is not None:
+            with self._lock:
+                self.assigned += 1
+                self.collisions += collisions
+                if collisions >= self.max_attempts:
+                    self.exhausted += 1
+        return anonymous_id
+    
+    def _register(self, conn, telegram_id):
+        """Write job registering a nickname; returns it with the collision count, None if it already existed."""
+        cursor = conn.cursor()
+        
+        # Another handler may have registered this user since our lookup
+        cursor.execute("SELECT nickname FROM user_nicknames WHERE telegram_id = ?", (str(telegram_id),))
+        result = cursor.fetchone()
+        if result:
+            return result[0], None
+        
+        collisions = 0
+        anonymous_id = None
+        for attempt in range(self.max_attempts):
+            candidate = generate_anonymous_id(telegram_id, attempt)
+            cursor.execute("SELECT 1 FROM user_nicknames WHERE nickname = ? LIMIT 1", (candidate,))
+            if cursor.fetchone() is None:
+                anonymous_id = candidate
+                break
+            collisions += 1
+        
+        if anonymous_id is None:
+            # Practically unreachable until the namespace is nearly full
+            flow_logger.warning("Nickname namespace exhausted for a new user, using fallback")
+            anonymous_id = f"Anonymous{random.randint(10000, 99999)}"
+        
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute(
+            "INSERT INTO user_nicknames (telegram_id, nickname, created_at) VALUES (?, ?, ?)",
+            (str(telegram_id), anonymous_id, now)
+        )
+        return anonymous_id, collisions
+    
+    def stats(self):
+        """Return a snapshot of the registry counters."""
+        with self._lock:
+            return {
+                'namespace_size': self.namespace_size,
+                'assigned': self.assigned,
+                'collisions': self.collisions,
+                'exhausted': self.exhausted
+            }
+
+nickname_registry = NicknameRegistry(NICKNAME_MAX_ATTEMPTS)
+
+def get_anonymous_user_id(telegram_id):
+    # Serve repeat lookups from memory without touching the database
+    anonymous_id = identity_cache.get(telegram_id)
+    if anonymous_id is not None:
+        return anonymous_id
+    
+    try:
+        # Look up the stored nickname or register a collision-free one
+        anonymous_id = nickname_registry.claim(telegram_id)
+    except Exception as e:
+        flow_logger.error(f"Error in get_anonymous_user_id: {e}")
+        # Make sure to not expose the error details to log if they contain the actual telegram_id
+        # Fallback to a generic ID if something goes wrong, the same one for every update of the outage
+        anonymous_id = fallback_identity_cache.get(telegram_id)
+        if anonymous_id is None:
+            anonymous_id = f"Anonymous{random.randint(10000, 99999)}"
+            fallback_identity_cache.put(telegram_id, anonymous_id)
+        return anonymous_id
+    
+    identity_cache.put(telegram_id, anonymous_id)
+    return anonymous_id
+
+
+# Columns update_user_preferences can set, and the value a new row gets when not provided
+PREFERENCE_DEFAULTS = {
+    'consent': None,
+    'age': 'Not provided',
+    'gender': 'Not provided',
+    'occupation': 'Not provided',
+    'time_in_turku': 'Not provided',
+    'language': 'en'
+}
+
+def _build_preferences_upsert_query(provided_fields):
+    """Build the UPSERT that inserts a full row or updates only the provided fields."""
+    set_parts = [f"{field} = excluded.{field}" for field in provided_fields]
+    
+    # Always update last_active
+    set_parts.append("last_active = excluded.last_active")
+    
+    return f"""
+        INSERT INTO user_preferences 
+        (user_id, consent, last_active, age, gender, occupation, time_in_turku, language) 
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET {', '.join(set_parts)}
+    """
+
+# One statement per combination of provided fields (64 shapes). The SQL text is
+# fixed per shape, so sqlite3's per-connection statement cache reuses the
+# prepared statements instead of compiling a new query on every update.
+PREFERENCES_UPSERT_QUERIES = {
+    provided_fields: _build_preferences_upsert_query(provided_fields)
+    for count in range(len(PREFERENCE_DEFAULTS) + 1)
+    for provided_fields in itertools.combinations(PREFERENCE_DEFAULTS, count)
+}
+
+def _write_user_preferences(conn, anonymous_id, consent=None, age=None, gender=None,
+                            occupation=None, time_in_turku=None, language=None):
+    """Update or create user preferences on the given connection without committing."""
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    values = {
+        'consent': None if consent is None else (1 if consent else 0),
+        'age': age,
+        'gender': gender,
+        'occupation': occupation,
+        'time_in_turku': time_in_turku,
+        'language': language
+    }
+    
+    # Pick the statement shape for the fields that were provided
+    provided_fields = tuple(field for field in PREFERENCE_DEFAULTS if values[field] is not None)
+    
+    # New rows get defaults for the missing fields; existing rows keep them
+    for field, default in PREFERENCE_DEFAULTS.items():
+        if values[field] is None:
+            values[field] = default
+    
+    conn.execute(
+        PREFERENCES_UPSERT_QUERIES[provided_fields],
+        (
+            anonymous_id,
+            values['consent'],
+            now,
+            values['age'],
+            values['gender'],
+            values['occupation'],
+            values['time_in_turku'],
+            values['language']
+        )
+    )
+    return True
+
+def queue_user_preferences(anonymous_id, consent=None, age=None, gender=None,
+                           occupation=None, time_in_turku=None, language=None):
+    """
+    Queue a user preferences update for the writer thread
+    
+    Takes the same arguments as update_user_preferences.
+    
+    Returns:
+        concurrent.futures.Future: Resolves to True once the update is committed
+    """
+    return submit_write(functools.partial(
+        _write_user_preferences, anonymous_id=anonymous_id, consent=consent, age=age,
+        gender=gender, occupation=occupation, time_in_turku=time_in_turku, language=language
+    ))
+
+def update_user_preferences(anonymous_id, consent=None, age=None, gender=None, 
+                           occupation=None, time_in_turku=None, language=None):
+    """
+    Update or create user preferences in the database
+    
+    Args:
+        anonymous_id (str): Anonymous user ID
+        consent (bool, optional): User consent status
+        age (str, optional): Age group
+        gender (str, optional): Gender
+        occupation (str, optional): Occupation
+        time_in_turku (str, optional): Time living in Turku
+        language (str, optional): Preferred language (en, fi, sv, uk)
+        
+    Returns:
+        bool: Success status
+    """
+    try:
+        return queue_user_preferences(
+            anonymous_id, consent=consent, age=age, gender=gender,
+            occupation=occupation, time_in_turku=time_in_turku, language=language
+        ).result(timeout=WRITER_RESULT_TIMEOUT)
+    except Exception as e:
+        flow_logger.error(f"Error in update_user_preferences: {e}")
+        return False
+
+def _to_float(value):
+    """Convert a coordinate stored as TEXT to float, None if missing, malformed or not finite."""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+# latitude/longitude keep the original TEXT; lat/lon hold the same values as REAL for the spatial index
+INSERT_SUBMISSION_QUERY = """
+    INSERT INTO submissions
+    (user_id, submission_type, standard_selections, custom_inputs, 
+     latitude, longitude, lat, lon, venue_title, venue_address, additional_info, timestamp, submission_token,
+     cluster_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def _find_cluster(conn, index, submission_type, standard_selections, lat, lon, created):
+    """Return the cluster a new submission joins in index, marking its first report as a member; None if none."""
+    if lat is None or lon is None:
+        return None
+    
+    cluster_id = index.find_cluster(
+        lat, lon, submission_type, submission_categories(standard_selections), created
+    )
+    if cluster_id is not None:
+        # The first report joins its own cluster when the first duplicate arrives
+        conn.execute("UPDATE submissions SET cluster_id = ? WHERE id = ? AND cluster_id IS NULL", (cluster_id, cluster_id))
+    return cluster_id
+
+class SubmissionUnitOfWork:
+    """
+    Everything one confirmed response writes, applied in a single transaction.
+    
+    Collects the preference update and the submission rows for a confirmation
+    and applies them on one connection: the socioeconomic check, the
+    preference write and a single executemany for the submissions all run in
+    the same BEGIN IMMEDIATE transaction, so a confirmation costs one commit
+    and is either fully stored or not at all.
+    """
+    
+    def __init__(self, anonymous_id, submission_token=None, recent_index=None):
+        self.anonymous_id = anonymous_id
+        # Index of recent submissions used for clustering, recent_submissions unless given
+        self.recent_index = recent_submissions if recent_index is None else recent_index
+        # Unique per confirmation and submission type, so a replay fails on the DB index
+        self.submission_token = submission_token
+        self.preferences = None
+        self.keep_existing_socioeconomic = False
+        self.submissions = []
+        # IDs added to recent_index by apply, removed again if the batch is not committed
+        self.indexed_ids = []
+    
+    def update_preferences(self, keep_existing_socioeconomic=False, **fields):
+        """
+        Record the preference update for this unit
+        
+        Args:
+            keep_existing_socioeconomic (bool): Skip socioeconomic fields if the
+                user already has complete socioeconomic data stored
+            **fields: Keyword arguments accepted by update_user_preferences
+        """
+        self.preferences = fields
+        self.keep_existing_socioeconomic = keep_existing_socioeconomic
+    
+    def add_submission(self, submission_type, standard_selections, custom_inputs,
+                       latitude, longitude, venue_title="", venue_address="", additional_info=""):
+        """
+        Record a submission row for this unit
+        
+        Args:
+            submission_type (str): 'issue' or 'improvement'
+            standard_selections (str): Semicolon-separated list of standard selections
+            custom_inputs (str): Semicolon-separated list of custom inputs
+            latitude (float): Location latitude
+            longitude (float): Location longitude
+            venue_title (str, optional): Venue title
+            venue_address (str, optional): Venue address
+            additional_info (str, optional): Additional information
+        """
+        self.submissions.append((
+            submission_type, standard_selections, custom_inputs, str(latitude), str(longitude),
+            _to_float(latitude), _to_float(longitude), venue_title, venue_address, additional_info
+        ))
+    
+    def apply(self, conn):
+        """
+        Apply the unit on a connection with an open transaction
+        
+        Returns:
+            list: IDs of the inserted submissions
+        """
+        if self.preferences is not None:
+            fields = dict(self.preferences)
+            if self.keep_existing_socioeconomic and _fetch_socioeconomic_data(conn, self.anonymous_id):
+                # Avoid overwriting previously answered questions with 'Not provided'
+                for key in ('age', 'gender', 'occupation', 'time_in_turku'):
+                    fields.pop(key, None)
+            _write_user_preferences(conn, self.anonymous_id, **fields)
+        
+        if not self.submissions:
+            return []
+        
+        now = datetime.datetime.now()
+        created = now.timestamp()
+        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+        
+        # Link each row to a recent nearby report of the same category
+        clusters = [
+            _find_cluster(conn, self.recent_index, row[0], row[1], row[5], row[6], created)
+            for row in self.submissions
+        ]
+        conn.executemany(
+            INSERT_SUBMISSION_QUERY,
+            [
+                (self.anonymous_id,) + row + (timestamp, self.submission_token, cluster_id)
+                for row, cluster_id in zip(self.submissions, clusters)
+            ]
+        )
+        
+        # The transaction holds the write lock, so the new IDs are contiguous
+        last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        submission_ids = list(range(last_id - len(self.submissions) + 1, last_id + 1))
+        
+        # Indexed now so later jobs in the same write batch already see these rows
+        for submission_id, row, cluster_id in zip(submission_ids, self.submissions, clusters):
+            self.recent_index.add(
+                submission_id, row[5], row[6], row[0], submission_categories(row[1]),
+                cluster_id or submission_id, created
+            )
+        self.indexed_ids = submission_ids
+        return submission_ids
+    
+    def commit(self):
+        """
+        Queue the unit as one write job
+        
+        Returns:
+            concurrent.futures.Future: Resolves to the submission IDs once committed
+        """
+        future = submit_write(self.apply)
+        # Also runs if the batch fails after the caller stopped waiting for it
+        future.add_done_callback(self._discard_if_failed)
+        return future
+    
+    def _discard_if_failed(self, future):
+        if future.cancelled() or future.exception() is not None:
+            self.recent_index.discard(self.indexed_ids)
+
+def benchmark_confirmation_commits(confirmations=200):
+    """
+    Count commits per confirmation for separate transactions against one unit of work
+    
+    Replays the steps of a confirmation with both an issue and an improvement
+    on a scratch database with its own pool and recent-submission index: first
+    the way save_data used to run them (the socioeconomic check as a plain
+    read, then one transaction for the preferences and one per submission),
+    then as one SubmissionUnitOfWork. The connection uses synchronous=FULL so
+    every commit pays for its fsync.
+    
+    Args:
+        confirmations (int, optional): Confirmations replayed with each approach
+        
+    Returns:
+        dict: Commits per confirmation and milliseconds per confirmation for both approaches
+    """
+    import tempfile
+    
+    preferences = {
+        'consent': True, 'age': '26-40', 'gender': 'Female', 'occupation': 'Student', 'time_in_turku': '1-3 years'
+    }
+    submission_types = ('issue', 'improvement')
+    
+    def add_submission(unit, submission_type, index):
+        unit.add_submission(submission_type, 'Littering', '', 60.45 + index * 1e-3, 22.26, additional_info="Benchmark")
+    
+    def separate(conn, index, recent_index):
+        anonymous_id = f"Bench{index:05d}"
+        # The check was a plain read outside any transaction
+        _fetch_socioeconomic_data(conn, anonymous_id)
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            _write_user_preferences(conn, anonymous_id, **preferences)
+        for submission_type in submission_types:
+            unit = SubmissionUnitOfWork(anonymous_id, str(uuid.uuid4()), recent_index)
+            add_submission(unit, submission_type, index)
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                unit.apply(conn)
+    
+    def combined(conn, index, recent_index):
+        unit = SubmissionUnitOfWork(f"Bench{index:05d}", str(uuid.uuid4()), recent_index)
+        unit.update_preferences(keep_existing_socioeconomic=True, **preferences)
+        for submission_type in submission_types:
+            add_submission(unit, submission_type, index)
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            unit.apply(conn)
+    
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'confirmation_benchmark.db')
+        initialize_database(path)
+        pool = ConnectionPool(1, path=path)
+        
+        for name, confirm in (('separate', separate), ('unit_of_work', combined)):
+            recent_index = RecentSubmissionIndex(NEARBY_DUPLICATE_RADIUS_M, NEARBY_DUPLICATE_WINDOW)
+            commits = [0]
+            with pool.connection() as conn:
+                conn.execute("PRAGMA synchronous=FULL")
+                conn.set_trace_callback(lambda statement: commits.__setitem__(0, commits[0] + (statement == 'COMMIT')))
+                start = time.perf_counter()
+                for index in range(confirmations):
+                    confirm(conn, index, recent_index)
+                elapsed = time.perf_counter() - start
+                conn.set_trace_callback(None)
+            
+            results[f"{name}_commits"] = commits[0] / confirmations
+            results[f"{name}_ms"] = elapsed / confirmations * 1000
+        
+        # Close the pool's only connection before the directory goes away
+        pool.acquire().close()
+    
+    flow_logger.info(f"Confirmation commit benchmark for {confirmations} confirmations: {results}")
+    return results
+
+EXPORT_FIELDNAMES = [
+    'id', 'anonymous_id', 'submission_type', 'standard_selections', 'custom_inputs',
+    'latitude', 'longitude', 'venue_title', 'venue_address', 'additional_info',
+    'age', 'gender', 'occupation', 'time_in_turku', 'timestamp', 'cluster_id'
+]
+
+EXPORT_SELECT_COLUMNS = """
+    SELECT s.id, s.user_id, s.submission_type, s.standard_selections, s.custom_inputs,
+           s.latitude, s.longitude, s.venue_title, s.venue_address, s.additional_info,
+           p.age, p.gender, p.occupation, p.time_in_turku, s.timestamp, s.cluster_id
+"""
+
+# Keyset page: seeks on the primary key instead of skipping rows with OFFSET
+EXPORT_PAGE_QUERY = EXPORT_SELECT_COLUMNS + """
+    FROM submissions s
+    LEFT JOIN user_preferences p ON s.user_id = p.user_id
+    WHERE s.id > :after
+    ORDER BY s.id
+    LIMIT :limit
+"""
+
+# Incremental export: submissions added since the watermark...
+EXPORT_NEW_ROWS_QUERY = EXPORT_SELECT_COLUMNS + """
+    FROM submissions s
+    LEFT JOIN user_preferences p ON s.user_id = p.user_id
+    WHERE s.id > :after AND s.id <= :max_id
+    ORDER BY s.id
+    LIMIT :limit
+"""
+
+# ...and earlier submissions of users whose exported preferences changed since it. CROSS JOIN
+# keeps user_preferences as the outer loop: changed users come from idx_user_preferences_version
+# and their submissions from idx_user_id, instead of walking every submission up to since_id
+EXPORT_CHANGED_ROWS_QUERY = EXPORT_SELECT_COLUMNS + """
+    FROM user_preferences p
+    CROSS JOIN submissions s ON s.user_id = p.user_id
+    WHERE p.version > :since_version AND p.version <= :max_version
+      AND s.id > :after AND s.id <= :since_id
+    ORDER BY s.id
+    LIMIT :limit
+"""
+
+# ...and earlier first reports that new submissions linked into a cluster, which set their cluster_id
+EXPORT_CLUSTER_HEAD_ROWS_QUERY = EXPORT_SELECT_COLUMNS + """
+    FROM submissions s
+    LEFT JOIN user_preferences p ON s.user_id = p.user_id
+    WHERE s.id IN (
+        SELECT cluster_id FROM submissions WHERE id > :since_id AND id <= :max_id AND cluster_id <= :since_id
+    ) AND s.id > :after
+    ORDER BY s.id
+    LIMIT :limit
+"""
+
+EXPORT_EXTENSIONS = {None: '.csv', 'gzip': '.csv.gz', 'zstd': '.csv.zst'}
+
+
+def iter_export_rows(connection, page_size=EXPORT_PAGE_SIZE, query=EXPORT_PAGE_QUERY, params=None, after=0):
+    """
+    Yield export rows in id order, one keyset page at a time
+    
+    Args:
+        connection: Callable returning a context manager that yields a connection,
+            such as db_read_pool.connection; it is held only while a page is read
+        page_size (int, optional): Rows read per page
+        query (str, optional): Page query taking :after and :limit, ordered by s.id
+        params (dict, optional): Further named parameters of the query
+        after (int, optional): Only rows with a larger id are returned
+        
+    Yields:
+        tuple: One row in EXPORT_FIELDNAMES order
+    """
+    last_id = after
+    while True:
+        with connection() as conn:
+            cursor = conn.execute(query, dict(params or {}, after=last_id, limit=page_size))
+            rows = cursor.fetchmany(page_size)
+        
+        if not rows:
+            return
+        yield from rows
+        
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1][0]
+
+
+def _export_compression(path):
+    """Return the compression of an export file from its extension."""
+    if path.endswith('.gz'):
+        return 'gzip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+def open_export_stream(path, compression=None, encoding='utf-8-sig'):
+    """
+    Open a buffered text stream for export output, optionally compressed
+    
+    Args:
+        path (str): File to create
+        compression (str, optional): None, 'gzip' or 'zstd'
+        encoding (str, optional): Text encoding; the default BOM lets Excel detect UTF-8
+        
+    Returns:
+        io.TextIOWrapper: Stream that closes the underlying file when closed
+    """
+    if compression is None:
+        return open(path, 'w', newline='', encoding=encoding, buffering=EXPORT_BUFFER_SIZE)
+    
+    if compression == 'gzip':
+        binary = gzip.GzipFile(path, 'wb', compresslevel=EXPORT_GZIP_LEVEL)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstd export needs the zstandard package")
+        binary = zstandard.ZstdCompressor(level=EXPORT_ZSTD_LEVEL).stream_writer(open(path, 'wb'))
+    else:
+        raise ValueError(f"Unknown export compression: {compression}")
+    
+    # Batch small writes before they reach the compressor
+    return io.TextIOWrapper(io.BufferedWriter(binary, EXPORT_BUFFER_SIZE), encoding=encoding, newline='')
+
+
+def open_export_reader(path):
+    """
+    Open an export file written by write_export for reading
+    
+    Args:
+        path (str): Plain, .gz or .zst export file
+        
+    Returns:
+        io.TextIOWrapper: Text stream positioned before the header row
+    """
+    compression = _export_compression(path)
+    if compression is None:
+        return open(path, 'r', newline='', encoding='utf-8-sig', buffering=EXPORT_BUFFER_SIZE)
+    
+    if compression == 'gzip':
+        binary = gzip.GzipFile(path, 'rb')
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstd export needs the zstandard package")
+        binary = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return io.TextIOWrapper(io.BufferedReader(binary, EXPORT_BUFFER_SIZE), encoding='utf-8-sig', newline='')
+
+
+@contextlib.contextmanager
+def _partial_output(output_file):
+    """
+    Yield a temporary path that replaces output_file once the block completes
+    
+    Readers never see a truncated export; the temporary file is removed if the block raises.
+    """
+    partial_file = output_file + '.part'
+    try:
+        yield partial_file
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(partial_file)
+        raise
+    os.replace(partial_file, output_file)
+
+
+def write_export(rows, output_file, compression=None):
+    """
+    Stream rows into a CSV file, written under a temporary name and renamed when complete
+    
+    Args:
+        rows (iterable): Rows in EXPORT_FIELDNAMES order
+        output_file (str): Final path of the export
+        compression (str, optional): None, 'gzip' or 'zstd'
+        
+    Returns:
+        int: Number of rows written
+    """
+    count = 0
+    with _partial_output(output_file) as partial_file:
+        with open_export_stream(partial_file, compression) as stream:
+            writer = csv.writer(stream, delimiter=';', quoting=csv.QUOTE_ALL)
+            
+            # Write header
+            writer.writerow(EXPORT_FIELDNAMES)
+            
+            # Write data rows as they are read
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+    
+    return count
+
+
+def export_data_to_csv(compression=None, page_size=EXPORT_PAGE_SIZE):
+    """
+    Export all data from the database to CSV without loading it into memory
+    
+    Args:
+        compression (str, optional): None, 'gzip' or 'zstd'
+        page_size (int, optional): Rows read per keyset page
+    
+    Returns:
+        str: Path to the exported CSV file
+    """
+    try:
+        # Output file path
+        if not os.path.exists(EXPORT_DIR):
+            os.makedirs(EXPORT_DIR)
+        
+        output_file = os.path.join(
+            EXPORT_DIR, f'city_issue_data_export_{int(time.time())}{EXPORT_EXTENSIONS[compression]}'
+        )
+        
+        start = time.perf_counter()
+        count = write_export(iter_export_rows(db_read_pool.connection, page_size), output_file, compression)
+        elapsed = time.perf_counter() - start
+        flow_logger.info(
+            f"Exported {count} rows to {output_file} in {elapsed:.2f}s "
+            f"({count / elapsed if elapsed else 0:.0f} rows/s)"
+        )
+        
+        return output_file
+    except Exception as e:
+        flow_logger.error(f"Error in export_data_to_csv: {e}")
+        return None
+
+
+EXPORT_DELTA_PATTERN = re.compile(r'^city_issue_data_delta_(\d{8})(_compacted)?\.csv(\.gz|\.zst)?$')
+
+
+def _read_export_watermark(conn, name):
+    """Return (last_submission_id, last_preference_version, sequence) of an export, zeros if new."""
+    row = conn.execute(
+        "SELECT last_submission_id, last_preference_version, sequence FROM export_watermarks WHERE name = ?",
+        (name,)
+    ).fetchone()
+    return tuple(row) if row else (0, 0, 0)
+
+
+def _write_export_watermark(conn, name, last_submission_id, last_preference_version, sequence):
+    """Store the high-water mark of an export on the given connection without committing."""
+    conn.execute(
+        """
+        INSERT INTO export_watermarks (name, last_submission_id, last_preference_version, sequence, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET
+            last_submission_id = excluded.last_submission_id,
+            last_preference_version = excluded.last_preference_version,
+            sequence = excluded.sequence,
+            updated_at = excluded.updated_at
+        """,
+        (name, last_submission_id, last_preference_version, sequence,
+         datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    )
+
+
+def export_delta_csv(compression=None, page_size=EXPORT_PAGE_SIZE, name='default'):
+    """
+    Export the rows added or changed since the last delta into a new delta file
+    
+    A delta holds submissions newer than the watermark, plus earlier submissions
+    of users whose exported preferences changed since it and earlier first
+    reports that new submissions joined into a cluster, in id order. A row can
+    appear in several deltas; the newest copy wins. The watermark only advances
+    after the delta file is complete, so a failed run is simply repeated. Run one
+    exporter per name at a time.
+    
+    Args:
+        compression (str, optional): None, 'gzip' or 'zstd'
+        page_size (int, optional): Rows read per keyset page
+        name (str, optional): Watermark to use, one per downstream consumer
+        
+    Returns:
+        str: Path to the delta file, or None if nothing changed or on error
+    """
+    try:
+        with db_read_pool.connection() as conn:
+            since_id, since_version, sequence = _read_export_watermark(conn, name)
+            # Fix the upper bounds now; rows committed during the export go to the next delta
+            max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM submissions").fetchone()[0]
+            max_version = conn.execute("SELECT COALESCE(MAX(version), 0) FROM user_preferences").fetchone()[0]
+        
+        if max_id == since_id and max_version == since_version:
+            flow_logger.info(f"No changes to export since submission {since_id}, preference version {since_version}")
+            return None
+        
+        if not os.path.exists(EXPORT_DELTA_DIR):
+            os.makedirs(EXPORT_DELTA_DIR)
+        
+        sequence += 1
+        output_file = os.path.join(
+            EXPORT_DELTA_DIR, f'city_issue_data_delta_{sequence:08d}{EXPORT_EXTENSIONS[compression]}'
+        )
+        
+        changed_rows = [iter_export_rows(
+            db_read_pool.connection, page_size, EXPORT_CLUSTER_HEAD_ROWS_QUERY,
+            {'since_id': since_id, 'max_id': max_id}
+        )]
+        if max_version > since_version:
+            changed_rows.append(iter_export_rows(
+                db_read_pool.connection, page_size, EXPORT_CHANGED_ROWS_QUERY,
+                {'since_version': since_version, 'max_version': max_version, 'since_id': since_id}
+            ))
+        new_rows = iter_export_rows(
+            db_read_pool.connection, page_size, EXPORT_NEW_ROWS_QUERY, {'max_id': max_id}, after=since_id
+        )
+        # Changed rows all have ids up to since_id and new rows ids above it, so chaining keeps id order
+        rows = itertools.chain(_merge_export_rows(changed_rows), new_rows)
+        
+        start = time.perf_counter()
+        count = write_export(rows, output_file, compression)
+        elapsed = time.perf_counter() - start
+        
+        submit_write(
+            functools.partial(_write_export_watermark, name=name, last_submission_id=max_id,
+                              last_preference_version=max_version, sequence=sequence)
+        ).result(timeout=WRITER_RESULT_TIMEOUT)
+        
+        flow_logger.info(
+            f"Exported {count} new or changed rows to {output_file} in {elapsed:.2f}s "
+            f"(submissions {since_id + 1}-{max_id}, preference versions {since_version + 1}-{max_version})"
+        )
+        return output_file
+    except Exception as e:
+        flow_logger.error(f"Error in export_delta_csv: {e}")
+        return None
+
+
+def _merge_export_rows(streams):
+    """Merge export row streams that are each in id order, yielding every id once."""
+    last_id = None
+    for row in heapq.merge(*streams, key=lambda row: row[0]):
+        if row[0] != last_id:
+            last_id = row[0]
+            yield row
+
+
+def _iter_delta_rows(reader, sequence):
+    """Yield (id, -sequence, row) for each data row of a delta, so newer deltas sort first per id."""
+    next(reader, None)  # Header
+    # Deltas written before cluster_id was exported lack the last columns
+    padding = len(EXPORT_FIELDNAMES)
+    for row in reader:
+        yield int(row[0]), -sequence, row + [''] * (padding - len(row))
+
+
+def compact_export_deltas(compression=None):
+    """
+    Merge all delta files into one compacted delta holding the newest copy of each row
+    
+    The deltas are already sorted by id, so they are merged as streams and
+    memory stays flat however large they are. The merged files are removed
+    once the compacted file is complete; it keeps the newest sequence number,
+    so later deltas still sort after it.
+    
+    Args:
+        compression (str, optional): None, 'gzip' or 'zstd' for the compacted file
+        
+    Returns:
+        str: Path to the compacted file, or None if there was nothing to merge or on error
+    """
+    try:
+        if not os.path.exists(EXPORT_DELTA_DIR):
+            return None
+        
+        deltas = []
+        for filename in os.listdir(EXPORT_DELTA_DIR):
+            match = EXPORT_DELTA_PATTERN.match(filename)
+            if match:
+                deltas.append((int(match.group(1)), os.path.join(EXPORT_DELTA_DIR, filename)))
+        deltas.sort()
+        
+        if len(deltas) < 2:
+            return None
+        
+        last_sequence = deltas[-1][0]
+        output_file = os.path.join(
+            EXPORT_DELTA_DIR,
+            f'city_issue_data_delta_{last_sequence:08d}_compacted{EXPORT_EXTENSIONS[compression]}'
+        )
+        
+        with contextlib.ExitStack() as stack:
+            streams = [
+                _iter_delta_rows(csv.reader(stack.enter_context(open_export_reader(path)), delimiter=';'), sequence)
+                for sequence, path in deltas
+            ]
+            
+            def newest_rows():
+                last_id = None
+                for row_id, _, row in heapq.merge(*streams):
+                    if row_id != last_id:
+                        last_id = row_id
+                        yield row
+            
+            count = write_export(newest_rows(), output_file, compression)
+        
+        for _, path in deltas:
+            if path != output_file:
+                os.remove(path)
+        
+        flow_logger.info(f"Compacted {len(deltas)} deltas into {output_file} ({count} rows)")
+        return output_file
+    except Exception as e:
+        flow_logger.error(f"Error in compact_export_deltas: {e}")
+        return None
+
+
+def _create_export_benchmark_db(path, row_count, users=10000):
+    """Create a database with the exported tables filled with row_count synthetic submissions."""
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE submissions (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, "
+        "submission_type TEXT, standard_selections TEXT, custom_inputs TEXT, latitude TEXT, "
+        "longitude TEXT, venue_title TEXT, venue_address TEXT, additional_info TEXT, timestamp TEXT, "
+        "cluster_id INTEGER)"
+    )
+    conn.execute(
+        "CREATE TABLE user_preferences (user_id TEXT PRIMARY KEY, age TEXT, gender TEXT, "
+        "occupation TEXT, time_in_turku TEXT)"
+    )
+    ages, genders = messages['en']['age_options'], messages['en']['gender_options']
+    conn.executemany(
+        "INSERT INTO user_preferences VALUES (?, ?, ?, 'Student', '1-3 years')",
+        ((f"User{i:05d}", ages[i % len(ages)], genders[i % len(genders)]) for i in range(users))
+    )
+    conn.executemany(
+        "INSERT INTO submissions (user_id, submission_type, standard_selections, custom_inputs, "
+        "latitude, longitude, venue_title, venue_address, additional_info, timestamp) "
+        "VALUES (?, ?, 'Littering;Noise', '', ?, ?, NULL, NULL, 'Synthetic row', ?)",
+        (
+            (
+                f"User{i % users:05d}", 'issue' if i % 3 else 'improvement',
+                str(60.45 + i % 1000 * 1e-4), str(22.26 + i % 997 * 1e-4),
+                f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d} {i % 24:02d}:00:00"
+            )
+            for i in range(row_count)
+        )
+    )
+    conn.commit()
+    return conn
+
+
+def benchmark_export(row_count=1000000, compressions=(None, 'gzip'), page_size=EXPORT_PAGE_SIZE):
+    """
+    Time the streaming export on a synthetic database and report peak RSS
+    
+    Args:
+        row_count (int, optional): Synthetic submissions to generate
+        compressions (tuple, optional): Output formats to time
+        page_size (int, optional): Rows read per keyset page
+        
+    Returns:
+        dict: Rows per second and output size for each format, and the peak RSS in MB
+    """
+    import resource
+    import tempfile
+    
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        conn = _create_export_benchmark_db(os.path.join(tmp_dir, 'export_benchmark.db'), row_count)
+        
+        for compression in compressions:
+            output_file = os.path.join(tmp_dir, 'export' + EXPORT_EXTENSIONS[compression])
+            start = time.perf_counter()
+            count = write_export(
+                iter_export_rows(lambda: contextlib.nullcontext(conn), page_size), output_file, compression
+            )
+            elapsed = time.perf_counter() - start
+            results[compression or 'plain'] = {
+                'rows_per_sec': count / elapsed,
+                'size_mb': os.path.getsize(output_file) / 2**20,
+            }
+        conn.close()
+    
+    # ru_maxrss is in kilobytes on Linux
+    results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    flow_logger.info(f"Export benchmark for {row_count} rows: {results}")
+    return results
+
+
+def _import_pyarrow():
+    """Import pyarrow and pyarrow.parquet, which only the Parquet export needs."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet export needs the pyarrow package")
+    return pyarrow, pyarrow.parquet
+
+
+def _parquet_schema(pa):
+    """Arrow schema of the Parquet export, in EXPORT_FIELDNAMES order."""
+    categorical = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ('id', pa.int64()),
+        ('anonymous_id', pa.string()),
+        ('submission_type', categorical),
+        ('standard_selections', pa.string()),
+        ('custom_inputs', pa.string()),
+        ('latitude', pa.float64()),
+        ('longitude', pa.float64()),
+        ('venue_title', pa.string()),
+        ('venue_address', pa.string()),
+        ('additional_info', pa.string()),
+        ('age', categorical),
+        ('gender', categorical),
+        ('occupation', categorical),
+        ('time_in_turku', categorical),
+        ('timestamp', pa.timestamp('s')),
+        ('cluster_id', pa.int64()),
+    ])
+
+
+def _rows_to_arrow(pa, schema, rows):
+    """Build one Arrow table from a batch of export rows."""
+    import pyarrow.compute as pc
+    
+    columns = list(zip(*rows))
+    arrays = []
+    for field, values in zip(schema, columns):
+        if field.name in ('latitude', 'longitude'):
+            arrays.append(pa.array([_to_float(value) for value in values], type=pa.float64()))
+        elif field.name == 'timestamp':
+            # Parsed in C; values in another format become null rather than failing the export
+            arrays.append(pc.strptime(
+                pa.array(values, type=pa.string()), format='%Y-%m-%d %H:%M:%S', unit='s', error_is_null=True
+            ))
+        elif pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_parquet_export(rows, output_file, row_group_size=EXPORT_PARQUET_ROW_GROUP_SIZE):
+    """
+    Stream rows into a Parquet file, one row group per batch of row_group_size rows
+    
+    Args:
+        rows (iterable): Rows in EXPORT_FIELDNAMES order
+        output_file (str): Final path of the export
+        row_group_size (int, optional): Rows per row group
+        
+    Returns:
+        int: Number of rows written
+    """
+    pa, pq = _import_pyarrow()
+    schema = _parquet_schema(pa)
+    
+    count = 0
+    rows = iter(rows)
+    with _partial_output(output_file) as partial_file:
+        with pq.ParquetWriter(partial_file, schema, compression=EXPORT_PARQUET_COMPRESSION) as writer:
+            while True:
+                batch = list(itertools.islice(rows, row_group_size))
+                if not batch:
+                    break
+                writer.write_table(_rows_to_arrow(pa, schema, batch), row_group_size=row_group_size)
+                count += len(batch)
+    
+    return count
+
+
+def export_data_to_parquet(page_size=EXPORT_PAGE_SIZE):
+    """
+    Export all submissions with demographics to a typed, columnar Parquet file
+    
+    Args:
+        page_size (int, optional): Rows read per keyset page
+    
+    Returns:
+        str: Path to the exported Parquet file
+    """
+    try:
+        if not os.path.exists(EXPORT_DIR):
+            os.makedirs(EXPORT_DIR)
+        
+        output_file = os.path.join(EXPORT_DIR, f'city_issue_data_export_{int(time.time())}.parquet')
+        
+        start = time.perf_counter()
+        count = write_parquet_export(iter_export_rows(db_read_pool.connection, page_size), output_file)
+        elapsed = time.perf_counter() - start
+        flow_logger.info(
+            f"Exported {count} rows to {output_file} in {elapsed:.2f}s "
+            f"({count / elapsed if elapsed else 0:.0f} rows/s)"
+        )
+        
+        return output_file
+    except Exception as e:
+        flow_logger.error(f"Error in export_data_to_parquet: {e}")
+        return None
+
+
+def benchmark_parquet_export(row_count=1000000, page_size=EXPORT_PAGE_SIZE):
+    """
+    Compare the Parquet export with the CSV export on a synthetic database
+    
+    Load time is the time to read the whole file back into an Arrow table,
+    with pyarrow's CSV reader for the CSV so both sides are parsed in C.
+    
+    Args:
+        row_count (int, optional): Synthetic submissions to generate
+        page_size (int, optional): Rows read per keyset page
+        
+    Returns:
+        dict: Export seconds, file size in MB and load seconds for each format
+    """
+    import tempfile
+    
+    _, pq = _import_pyarrow()
+    import pyarrow.csv as pa_csv
+    
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        conn = _create_export_benchmark_db(os.path.join(tmp_dir, 'export_benchmark.db'), row_count)
+        
+        def rows():
+            return iter_export_rows(lambda: contextlib.nullcontext(conn), page_size)
+        
+        csv_file = os.path.join(tmp_dir, 'export.csv')
+        parquet_file = os.path.join(tmp_dir, 'export.parquet')
+        
+        for name, output_file, write, load in (
+            ('csv', csv_file, write_export, lambda: pa_csv.read_csv(
+                csv_file, parse_options=pa_csv.ParseOptions(delimiter=';'))),
+            ('parquet', parquet_file, write_parquet_export, lambda: pq.read_table(parquet_file)),
+        ):
+            start = time.perf_counter()
+            write(rows(), output_file)
+            export_time = time.perf_counter() - start
+            
+            start = time.perf_counter()
+            table = load()
+            load_time = time.perf_counter() - start
+            
+            results[name] = {
+                'export_s': export_time,
+                'size_mb': os.path.getsize(output_file) / 2**20,
+                'load_s': load_time,
+                'rows': table.num_rows,
+            }
+        conn.close()
+    
+    flow_logger.info(f"Parquet export benchmark for {row_count} rows: {results}")
+    return results
+
+
+# Map export reads only the submission columns a map layer shows; demographics stay out
+# of a layer with exact coordinates
+EXPORT_GEO_QUERY = """
+    SELECT s.id, s.submission_type, s.standard_selections, s.custom_inputs,
+           s.latitude, s.longitude, s.venue_title, s.venue_address, s.additional_info, s.timestamp,
+           s.cluster_id
+    FROM submissions s
+    WHERE s.id > :after
+    ORDER BY s.id
+    LIMIT :limit
+"""
+
+# Selections are stored in the reporter's language; tiles count them under the English label
+CATEGORY_LABELS = {
+    option: messages['en'][list_key][idx]
+    for lang in messages
+    for list_key in ('issue_list', 'improvement_list')
+    for idx, option in enumerate(messages[lang][list_key])
+}
+CUSTOM_CATEGORY = 'Custom'
+
+# Web Mercator stops at this latitude
+MAX_MERCATOR_LATITUDE = 85.0511287798
+
+
+def lonlat_to_tile(longitude, latitude, zoom):
+    """
+    Return the x, y of the slippy-map tile containing a point
+    
+    Args:
+        longitude (float): Degrees east
+        latitude (float): Degrees north
+        zoom (int): Zoom level
+        
+    Returns:
+        tuple: Tile x and y at that zoom
+    """
+    latitude = max(-MAX_MERCATOR_LATITUDE, min(MAX_MERCATOR_LATITUDE, latitude))
+    n = 1 << zoom
+    x = int((longitude + 180.0) / 360.0 * n)
+    lat_rad = math.radians(latitude)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _split_selections(value):
+    """Split a ';'-joined selections column into its non-empty parts."""
+    return [part for part in (value or '').split(';') if part]
+
+
+class TileAggregator:
+    """
+    Counts points per issue category in every z/x/y tile between two zoom levels.
+    
+    Memory grows with the number of non-empty tiles, not with the number of
+    points, so it stays small for a city-sized dataset.
+    """
+    
+    def __init__(self, min_zoom=EXPORT_TILE_MIN_ZOOM, max_zoom=EXPORT_TILE_MAX_ZOOM):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.tiles = collections.defaultdict(collections.Counter)
+        self.points = 0
+        self.bounds = None
+    
+    def add(self, longitude, latitude, submission_type, categories):
+        """
+        Count one point in its tile at every zoom level
+        
+        Args:
+            longitude (float): Degrees east
+            latitude (float): Degrees north
+            submission_type (str): 'issue' or 'improvement'
+            categories (list): Category labels of the submission
+        """
+        self.points += 1
+        if self.bounds is None:
+            self.bounds = [longitude, latitude, longitude, latitude]
+        else:
+            self.bounds = [
+                min(self.bounds[0], longitude), min(self.bounds[1], latitude),
+                max(self.bounds[2], longitude), max(self.bounds[3], latitude)
+            ]
+        
+        # The max-zoom tile determines all coarser ones by shifting
+        x, y = lonlat_to_tile(longitude, latitude, self.max_zoom)
+        for zoom in range(self.max_zoom, self.min_zoom - 1, -1):
+            shift = self.max_zoom - zoom
+            counts = self.tiles[(zoom, x >> shift, y >> shift)]
+            counts['total'] += 1
+            counts[f"type:{submission_type}"] += 1
+            for category in categories:
+                counts[category] += 1
+    
+    def write(self, directory):
+        """
+        Write one JSON file per tile as directory/z/x/y.json plus an index.json
+        
+        The tiles are built next to the directory and swapped in at the end, so
+        the dashboard never reads a half-written set.
+        
+        Args:
+            directory (str): Tile root
+            
+        Returns:
+            int: Number of tiles written
+        """
+        building = directory + '.part'
+        shutil.rmtree(building, ignore_errors=True)
+        
+        for (zoom, x, y), counts in self.tiles.items():
+            tile_dir = os.path.join(building, str(zoom), str(x))
+            os.makedirs(tile_dir, exist_ok=True)
+            types = {key[5:]: value for key, value in counts.items() if key.startswith('type:')}
+            categories = {
+                key: value for key, value in counts.items() if key != 'total' and not key.startswith('type:')
+            }
+            tile = {'z': zoom, 'x': x, 'y': y, 'count': counts['total'], 'types': types, 'categories': categories}
+            with open(os.path.join(tile_dir, f"{y}.json"), 'w', encoding='utf-8') as tile_file:
+                json.dump(tile, tile_file, ensure_ascii=False, separators=(',', ':'))
+        
+        os.makedirs(building, exist_ok=True)
+        with open(os.path.join(building, 'index.json'), 'w', encoding='utf-8') as index_file:
+            json.dump({
+                'min_zoom': self.min_zoom,
+                'max_zoom': self.max_zoom,
+                'bounds': self.bounds,
+                'points': self.points,
+                'tiles': len(self.tiles),
+                'generated_at': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            }, index_file, ensure_ascii=False)
+        
+        # Swap the new set in; the old one is only removed once the new one is in place
+        previous = directory + '.old'
+        shutil.rmtree(previous, ignore_errors=True)
+        if os.path.exists(directory):
+            os.replace(directory, previous)
+        os.replace(building, directory)
+        shutil.rmtree(previous, ignore_errors=True)
+        
+        return len(self.tiles)
+
+
+def write_geojson_export(rows, output_file, compression=None, tiles=None):
+    """
+    Stream submissions with valid coordinates into a GeoJSON FeatureCollection
+    
+    Args:
+        rows (iterable): Rows in EXPORT_GEO_QUERY column order
+        output_file (str): Final path of the export
+        compression (str, optional): None, 'gzip' or 'zstd'
+        tiles (TileAggregator, optional): Also counts every written point
+        
+    Returns:
+        int: Number of features written
+    """
+    count = 0
+    with _partial_output(output_file) as partial_file:
+        # RFC 7946: UTF-8 without a byte order mark
+        with open_export_stream(partial_file, compression, encoding='utf-8') as stream:
+            stream.write('{"type":"FeatureCollection","features":[\n')
+            
+            for (submission_id, submission_type, standard_selections, custom_inputs, latitude, longitude,
+                 venue_title, venue_address, additional_info, timestamp, cluster_id) in rows:
+                latitude, longitude = _to_float(latitude), _to_float(longitude)
+                if latitude is None or longitude is None:
+                    continue
+                
+                selections = _split_selections(standard_selections)
+                custom = _split_selections(custom_inputs)
+                categories = [CATEGORY_LABELS.get(selection, selection) for selection in selections]
+                if custom:
+                    categories.append(CUSTOM_CATEGORY)
+                
+                feature = {
+                    'type': 'Feature',
+                    'id': submission_id,
+                    'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+                    'properties': {
+                        'submission_type': submission_type,
+                        'categories': categories,
+                        'selections': selections,
+                        'custom_inputs': custom,
+                        'venue_title': venue_title or None,
+                        'venue_address': venue_address or None,
+                        'additional_info': additional_info or None,
+                        'timestamp': timestamp,
+                        'cluster_id': cluster_id,
+                    },
+                }
+                if count:
+                    stream.write(',\n')
+                stream.write(json.dumps(feature, ensure_ascii=False, separators=(',', ':')))
+                count += 1
+                
+                if tiles is not None:
+                    tiles.add(longitude, latitude, submission_type, categories)
+            
+            stream.write('\n]}\n')
+    
+    return count
+
+
+def export_map_layers(compression=None, page_size=EXPORT_PAGE_SIZE):
+    """
+    Export submissions as GeoJSON and rebuild the dashboard's count tiles in the same pass
+    
+    Args:
+        compression (str, optional): None, 'gzip' or 'zstd' for the GeoJSON file
+        page_size (int, optional): Rows read per keyset page
+    
+    Returns:
+        str: Path to the GeoJSON file
+    """
+    try:
+        if not os.path.exists(EXPORT_DIR):
+            os.makedirs(EXPORT_DIR)
+        
+        extension = {None: '.geojson', 'gzip': '.geojson.gz', 'zstd': '.geojson.zst'}[compression]
+        output_file = os.path.join(EXPORT_DIR, f'city_issue_map_{int(time.time())}{extension}')
+        
+        start = time.perf_counter()
+        tiles = TileAggregator()
+        count = write_geojson_export(
+            iter_export_rows(db_read_pool.connection, page_size, EXPORT_GEO_QUERY), output_file, compression, tiles
+        )
+        tile_count = tiles.write(EXPORT_TILE_DIR)
+        elapsed = time.perf_counter() - start
+        flow_logger.info(
+            f"Exported {count} features to {output_file} and {tile_count} tiles to {EXPORT_TILE_DIR} "
+            f"in {elapsed:.2f}s"
+        )
+        
+        return output_file
+    except Exception as e:
+        flow_logger.error(f"Error in export_map_layers: {e}")
+        return None
+
+
+def _backfill_coordinates_batch(conn, after, batch_size, since=None):
+    """
+    Fill lat/lon for the next batch of rows after an id that still lack them
+    
+    Returns:
+        tuple: Last id examined (None when no rows are left) and number of rows updated
+    """
+    if since is None:
+        rows = conn.execute(
+            "SELECT id, latitude, longitude FROM submissions WHERE id > ? AND lat IS NULL ORDER BY id LIMIT ?",
+            (after, batch_size)
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT id, latitude, longitude FROM submissions "
+            "WHERE id > ? AND lat IS NULL AND timestamp >= ? ORDER BY id LIMIT ?",
+            (after, since, batch_size)
+        ).fetchall()
+    if not rows:
+        return None, 0
+    
+    updates = []
+    for submission_id, latitude, longitude in rows:
+        lat, lon = _to_float(latitude), _to_float(longitude)
+        # Malformed text stays NULL; the keyset cursor moves past it
+        if lat is not None and lon is not None:
+            updates.append((lat, lon, submission_id))
+    conn.executemany("UPDATE submissions SET lat = ?, lon = ? WHERE id = ?", updates)
+    return rows[-1][0], len(updates)
+
+
+def backfill_coordinates(batch_size=COORDINATE_BACKFILL_BATCH_SIZE, since=None):
+    """
+    Convert TEXT coordinates of older submissions to lat/lon, one writer transaction per batch
+    
+    Short batches let bot writes interleave with the backfill. Safe to run
+    again; rows already converted are skipped.
+    
+    Args:
+        batch_size (int, optional): Rows converted per transaction
+        since (str, optional): Only convert rows with a timestamp from this one on
+        
+    Returns:
+        int: Number of rows updated
+    """
+    try:
+        after, total = 0, 0
+        start = time.perf_counter()
+        while True:
+            after, updated = submit_write(
+                functools.partial(_backfill_coordinates_batch, after=after, batch_size=batch_size, since=since)
+            ).result(timeout=WRITER_RESULT_TIMEOUT)
+            if after is None:
+                break
+            total += updated
+        
+        if total:
+            flow_logger.info(f"Backfilled coordinates of {total} submissions in {time.perf_counter() - start:.2f}s")
+        return total
+    except Exception as e:
+        flow_logger.error(f"Error in backfill_coordinates: {e}")
+        return 0
+
+
+SPATIAL_RESULT_FIELDS = ('id', 'submission_type', 'standard_selections', 'latitude', 'longitude', 'timestamp')
+
+# The R*Tree narrows the candidates; the REAL columns give the exact bounds
+SPATIAL_BBOX_QUERY = """
+    SELECT s.id, s.submission_type, s.standard_selections, s.lat, s.lon, s.timestamp
+    FROM submissions_rtree r
+    JOIN submissions s ON s.id = r.id
+    WHERE r.max_lat >= :min_lat AND r.min_lat <= :max_lat
+      AND r.max_lon >= :min_lon AND r.min_lon <= :max_lon
+      AND s.lat BETWEEN :min_lat AND :max_lat
+      AND s.lon BETWEEN :min_lon AND :max_lon
+    ORDER BY s.id
+    LIMIT :limit
+"""
+
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance between two points
+    
+    Returns:
+        float: Distance in metres
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(1.0, a)))
+
+
+def find_submissions_in_bbox(min_lat, min_lon, max_lat, max_lon, limit=None, connection=None):
+    """
+    Find submissions inside a bounding box using the R*Tree index
+    
+    Args:
+        min_lat (float): Southern edge
+        min_lon (float): Western edge
+        max_lat (float): Northern edge
+        max_lon (float): Eastern edge
+        limit (int, optional): Maximum number of results, in id order
+        connection (callable, optional): Connection context manager factory,
+            db_read_pool.connection by default
+        
+    Returns:
+        list: Dicts with the SPATIAL_RESULT_FIELDS keys
+    """
+    try:
+        with (connection or db_read_pool.connection)() as conn:
+            rows = conn.execute(SPATIAL_BBOX_QUERY, {
+                'min_lat': min_lat, 'max_lat': max_lat, 'min_lon': min_lon, 'max_lon': max_lon,
+                'limit': -1 if limit is None else limit
+            }).fetchall()
+        return [dict(zip(SPATIAL_RESULT_FIELDS, row)) for row in rows]
+    except Exception as e:
+        flow_logger.error(f"Error in find_submissions_in_bbox: {e}")
+        return []
+
+
+def find_submissions_within_radius(latitude, longitude, radius_m, limit=None, connection=None):
+    """
+    Find submissions within a distance of a point, nearest first
+    
+    Queries the bounding box of the circle through the R*Tree, then keeps the
+    candidates whose great-circle distance is within the radius.
+    
+    Args:
+        latitude (float): Centre latitude
+        longitude (float): Centre longitude
+        radius_m (float): Radius in metres
+        limit (int, optional): Maximum number of results
+        connection (callable, optional): Connection context manager factory,
+            db_read_pool.connection by default
+        
+    Returns:
+        list: Dicts with the SPATIAL_RESULT_FIELDS keys plus distance_m
+    """
+    d_lat = math.degrees(radius_m / EARTH_RADIUS_M)
+    d_lon = d_lat / max(math.cos(math.radians(latitude)), 1e-6)
+    candidates = find_submissions_in_bbox(
+        latitude - d_lat, longitude - d_lon, latitude + d_lat, longitude + d_lon, connection=connection
+    )
+    
+    results = []
+    for submission in candidates:
+        distance = haversine_distance(latitude, longitude, submission['latitude'], submission['longitude'])
+        if distance <= radius_m:
+            submission['distance_m'] = distance
+            results.append(submission)
+    results.sort(key=lambda submission: submission['distance_m'])
+    return results if limit is None else results[:limit]
+
+
+def benchmark_spatial_query(row_count=1000000, queries=100, radius_m=100, scan_queries=10):
+    """
+    Time radius queries through the R*Tree against a full scan of the TEXT columns
+    
+    Args:
+        row_count (int, optional): Synthetic submissions to generate
+        queries (int, optional): Radius queries timed through the index
+        radius_m (float, optional): Query radius in metres
+        scan_queries (int, optional): Queries timed with the full scan, which is much slower
+        
+    Returns:
+        dict: Milliseconds per query for both approaches, the speedup and the mean result size
+    """
+    import tempfile
+    
+    rng = random.Random(0)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        conn = _create_export_benchmark_db(os.path.join(tmp_dir, 'spatial_benchmark.db'), row_count)
+        
+        start = time.perf_counter()
+        _create_spatial_schema(conn.cursor())
+        after = 0
+        while after is not None:
+            after, _ = _backfill_coordinates_batch(conn, after, COORDINATE_BACKFILL_BATCH_SIZE)
+        conn.commit()
+        results['backfill_s'] = time.perf_counter() - start
+        
+        lat_min, lat_max, lon_min, lon_max = conn.execute(
+            "SELECT MIN(lat), MAX(lat), MIN(lon), MAX(lon) FROM submissions"
+        ).fetchone()
+        centres = [(rng.uniform(lat_min, lat_max), rng.uniform(lon_min, lon_max)) for _ in range(queries)]
+        
+        def indexed(lat, lon):
+            return find_submissions_within_radius(lat, lon, radius_m, connection=lambda: contextlib.nullcontext(conn))
+        
+        def full_scan(lat, lon):
+            # The best a radius query could do before: cast every TEXT coordinate in a table scan
+            d_lat = math.degrees(radius_m / EARTH_RADIUS_M)
+            d_lon = d_lat / math.cos(math.radians(lat))
+            rows = conn.execute(
+                "SELECT id, CAST(latitude AS REAL), CAST(longitude AS REAL) FROM submissions "
+                "WHERE CAST(latitude AS REAL) BETWEEN ? AND ? AND CAST(longitude AS REAL) BETWEEN ? AND ?",
+                (lat - d_lat, lat + d_lat, lon - d_lon, lon + d_lon)
+            ).fetchall()
+            return [row for row in rows if haversine_distance(lat, lon, row[1], row[2]) <= radius_m]
+        
+        start = time.perf_counter()
+        indexed_counts = [len(indexed(lat, lon)) for lat, lon in centres]
+        results['rtree_ms'] = (time.perf_counter() - start) / queries * 1000
+        results['mean_results'] = sum(indexed_counts) / queries
+        
+        start = time.perf_counter()
+        scan_counts = [len(full_scan(lat, lon)) for lat, lon in centres[:scan_queries]]
+        results['scan_ms'] = (time.perf_counter() - start) / len(scan_counts) * 1000
+        results['speedup'] = results['scan_ms'] / results['rtree_ms']
+        # Both approaches must find the same submissions
+        results['mismatches'] = sum(a != b for a, b in zip(scan_counts, indexed_counts))
+        conn.close()
+    
+    flow_logger.info(f"Spatial query benchmark for {row_count} rows: {results}")
+    return results
+
+
+def submission_categories(standard_selections):
+    """Return the English category labels of a ';'-joined selections column as a frozenset."""
+    return frozenset(CATEGORY_LABELS.get(selection, selection) for selection in _split_selections(standard_selections))
+
+
+class _RecentSubmission:
+    __slots__ = ('submission_id', 'lat', 'lon', 'submission_type', 'categories', 'cluster_id', 'created')
+    
+    def __init__(self, submission_id, lat, lon, submission_type, categories, cluster_id, created):
+        self.submission_id = submission_id
+        self.lat = lat
+        self.lon = lon
+        self.submission_type = submission_type
+        self.categories = categories
+        self.cluster_id = cluster_id
+        self.created = created
+
+
+class RecentSubmissionIndex:
+    """
+    In-memory grid of recent submissions for finding nearby same-category reports.
+    
+    Cells are radius_m tall and at least radius_m wide, so every point within
+    radius_m of a location lies in the three cell rows around it and a couple
+    of columns in each. Cells keep their entries oldest first and drop expired
+    ones whenever they are visited, with a full sweep every prune_every
+    inserts for cells nobody visits. A lookup therefore touches a constant
+    number of cells and is O(1) expected for a bounded local density.
+    """
+    
+    def __init__(self, radius_m, window, prune_every=NEARBY_DUPLICATE_PRUNE_EVERY):
+        self.radius_m = radius_m
+        self.window = window
+        self.prune_every = prune_every
+        self._cell_lat = math.degrees(radius_m / EARTH_RADIUS_M)
+        self._cells = {}
+        self._cell_of = {}
+        self._lock = threading.Lock()
+        self._adds_since_prune = 0
+        self.lookups = 0
+        self.matches = 0
+    
+    def _column_width(self, band):
+        """Longitude width of the cells in a row, measured at the row's poleward edge."""
+        edge = max(abs(band), abs(band + 1)) * self._cell_lat
+        return self._cell_lat / max(math.cos(math.radians(min(edge, 89.9))), 1e-6)
+    
+    def _cell(self, lat, lon):
+        band = math.floor(lat / self._cell_lat)
+        return band, math.floor(lon / self._column_width(band))
+    
+    def _expire(self, key, cell, cutoff):
+        while cell and cell[0].created < cutoff:
+            self._cell_of.pop(cell.popleft().submission_id, None)
+        if not cell:
+            del self._cells[key]
+    
+    def add(self, submission_id, lat, lon, submission_type, categories, cluster_id, created):
+        """
+        Add a stored submission
+        
+        Args:
+            submission_id (int): Row id
+            lat (float): Latitude, None to skip the row
+            lon (float): Longitude, None to skip the row
+            submission_type (str): 'issue' or 'improvement'
+            categories (frozenset): Category labels from submission_categories
+            cluster_id (int): Cluster the row belongs to, its own id if it starts one
+            created (float): Unix time the row was stored
+        """
+        if lat is None or lon is None:
+            return
+        
+        key = self._cell(lat, lon)
+        entry = _RecentSubmission(submission_id, lat, lon, submission_type, categories, cluster_id, created)
+        with self._lock:
+            cell = self._cells.get(key)
+            if cell is None:
+                cell = self._cells[key] = collections.deque()
+            # Rows arrive almost in time order; keep the deque sorted for the expiry scan
+            if cell and cell[-1].created > created:
+                position = len(cell)
+                while position and cell[position - 1].created > created:
+                    position -= 1
+                cell.insert(position, entry)
+            else:
+                cell.append(entry)
+            self._cell_of[submission_id] = key
+            
+            self._adds_since_prune += 1
+            if self._adds_since_prune >= self.prune_every:
+                self._adds_since_prune = 0
+                cutoff = created - self.window
+                for cell_key in list(self._cells):
+                    self._expire(cell_key, self._cells[cell_key], cutoff)
+    
+    def find_cluster(self, lat, lon, submission_type, categories, now):
+        """
+        Find the nearest recent submission of the same type sharing a category
+        
+        Args:
+            lat (float): Latitude of the new submission
+            lon (float): Longitude of the new submission
+            submission_type (str): 'issue' or 'improvement'
+            categories (frozenset): Category labels of the new submission
+            now (float): Unix time of the new submission
+            
+        Returns:
+            int: cluster_id of the nearest match, or None
+        """
+        if not categories:
+            return None
+        
+        band = math.floor(lat / self._cell_lat)
+        lon_reach = self._column_width(band + (1 if lat >= 0 else -1))
+        cutoff = now - self.window
+        best, best_distance = None, None
+        
+        with self._lock:
+            self.lookups += 1
+            for row in (band - 1, band, band + 1):
+                width = self._column_width(row)
+                for column in range(math.floor((lon - lon_reach) / width), math.floor((lon + lon_reach) / width) + 1):
+                    key = (row, column)
+                    cell = self._cells.get(key)
+                    if cell is None:
+                        continue
+                    self._expire(key, cell, cutoff)
+                    for entry in cell:
+                        if entry.submission_type != submission_type or not (entry.categories & categories):
+                            continue
+                        distance = haversine_distance(lat, lon, entry.lat, entry.lon)
+                        if distance <= self.radius_m and (best_distance is None or distance < best_distance):
+                            best, best_distance = entry, distance
+            if best is not None:
+                self.matches += 1
+        
+        return best.cluster_id if best is not None else None
+    
+    def discard(self, submission_ids):
+        """Remove submissions that were indexed but never committed."""
+        with self._lock:
+            for submission_id in submission_ids:
+                key = self._cell_of.pop(submission_id, None)
+                cell = self._cells.get(key)
+                if cell is None:
+                    continue
+                remaining = [entry for entry in cell if entry.submission_id != submission_id]
+                if remaining:
+                    self._cells[key] = collections.deque(remaining)
+                else:
+                    del self._cells[key]
+    
+    def window_start(self):
+        """Return the timestamp, in the submissions' format, of the oldest row the window covers."""
+        return datetime.datetime.fromtimestamp(time.time() - self.window).strftime("%Y-%m-%d %H:%M:%S")
+    
+    def load(self, connection=None):
+        """
+        Fill the index with the submissions stored within the window
+        
+        Rows without lat/lon are skipped, so backfill the window's coordinates first.
+        
+        Args:
+            connection (callable, optional): Connection context manager factory,
+                db_read_pool.connection by default
+            
+        Returns:
+            int: Number of submissions loaded
+        """
+        try:
+            since = self.window_start()
+            with (connection or db_read_pool.connection)() as conn:
+                rows = conn.execute(
+                    "SELECT id, lat, lon, submission_type, standard_selections, cluster_id, timestamp "
+                    "FROM submissions WHERE timestamp >= ? AND lat IS NOT NULL AND lon IS NOT NULL ORDER BY id",
+                    (since,)
+                ).fetchall()
+            
+            for submission_id, lat, lon, submission_type, standard_selections, cluster_id, timestamp in rows:
+                created = datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").timestamp()
+                self.add(
+                    submission_id, lat, lon, submission_type, submission_categories(standard_selections),
+                    cluster_id or submission_id, created
+                )
+            flow_logger.info(f"Loaded {len(rows)} recent submissions for nearby duplicate detection")
+            return len(rows)
+        except Exception as e:
+            flow_logger.error(f"Error loading recent submissions: {e}")
+            return 0
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._cell_of),
+                'cells': len(self._cells),
+                'lookups': self.lookups,
+                'matches': self.matches,
+            }
+
+recent_submissions = RecentSubmissionIndex(NEARBY_DUPLICATE_RADIUS_M, NEARBY_DUPLICATE_WINDOW)
+
+
+def lookup_user_language(anonymous_id):
+    """
+    Get the user's stored language preference from the database
+    
+    Args:
+        anonymous_id (str): Anonymous user ID
+        
+    Returns:
+        str: Supported language code, or None if no valid preference is stored
+    """
+    with db_read_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT language FROM user_preferences WHERE user_id = ?", (anonymous_id,))
+        result = cursor.fetchone()
+        
+        if result and result[0] and result[0] in messages:
+            return result[0]
+        return None
+
+
+class Session:
+    """
+    Conversation state of one user in a compact, slotted form.
+    
+    Scalar answers are read and written with the same mapping syntax the
+    handlers always used (session['age'], session.get(...), 'x' in session,
+    session.pop(...)); a key is present once its slot has been assigned.
+    The action, issue and improvement multi-selects are stored as integer
+    bitmasks over option indices and only turned into localized strings by
+    selected_options() when a summary is rendered or a submission is saved.
+    Free-text "Other" answers stay in the custom_issue/custom_improvement lists.
+    """
+    
+    __slots__ = (
+        'language', 'consent', 'action_type', 'awaiting_multiple_select',
+        'is_modifying', 'return_to_summary_after_both', 'returning_from_modify',
+        'location', 'additional_info', 'custom_issue', 'custom_improvement', 'submission_token',
+        'age', 'gender', 'occupation', 'time_in_turku',
+        'age_selected', 'gender_selected', 'occupation_selected', 'time_in_turku_selected',
+        'action_mask', 'issue_mask', 'improvement_mask'
+    )
+    
+    # Multi-select fields, each backed by a <field>_mask slot
+    SELECTIONS = ('action', 'issue', 'improvement')
+    
+    def __init__(self, **fields):
+        self.action_mask = 0
+        self.issue_mask = 0
+        self.improvement_mask = 0
+        for key, value in fields.items():
+            self[key] = value
+    
+    def _check_key(self, key):
+        if key.endswith('_mask') or key not in self.__slots__:
+            raise KeyError(key)
+    
+    def __getitem__(self, key):
+        self._check_key(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+    
+    def __setitem__(self, key, value):
+        self._check_key(key)
+        setattr(self, key, value)
+    
+    def __contains__(self, key):
+        return key in self.__slots__ and not key.endswith('_mask') and hasattr(self, key)
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def pop(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        delattr(self, key)
+        return value
+    
+    def items(self):
+        """Yield (key, value) for every assigned answer, masks included."""
+        for key in self.__slots__:
+            if hasattr(self, key):
+                yield key, getattr(self, key)
+    
+    def toggle(self, field, idx):
+        """
+        Flip one option of a multi-select
+        
+        Args:
+            field (str): 'action', 'issue' or 'improvement'
+            idx (int): Option index in the localized option list
+            
+        Returns:
+            bool: True if the option is selected afterwards
+        """
+        mask = getattr(self, f"{field}_mask") ^ (1 << idx)
+        setattr(self, f"{field}_mask", mask)
+        return bool(mask >> idx & 1)
+    
+    def is_selected(self, field, idx):
+        return bool(getattr(self, f"{field}_mask") >> idx & 1)
+    
+    def has_selection(self, field):
+        return getattr(self, f"{field}_mask") != 0
+    
+    def clear_selection(self, field):
+        setattr(self, f"{field}_mask", 0)
+    
+    def selected_options(self, field, options):
+        """
+        Materialize a multi-select as localized strings
+        
+        Args:
+            field (str): 'action', 'issue' or 'improvement'
+            options (list): Localized option list the indices refer to
+            
+        Returns:
+            list: Selected options in option order
+        """
+        mask = getattr(self, f"{field}_mask")
+        return [option for idx, option in enumerate(options) if mask >> idx & 1]
+
+
+def benchmark_session_memory(count=100000):
+    """
+    Compare the memory of count mid-conversation sessions as dicts vs Session objects
+    
+    Args:
+        count (int, optional): Number of concurrent sessions to simulate
+        
     Returns:
-        str: Language code ('en', 'fi', 'sv', 'uk') with default 'en'
+        dict: Bytes per session for both representations and the ratio
     """
-    try:
-        # First check if it's in user_data (for current session)
-        if user_id in user_data and 'language' in user_data[user_id]:
-            # Validate language code is supported
-            lang_code = user_data[user_id]['language']
-            if lang_code in messages:
-                return lang_code
-        
-        # Otherwise check in the database
-        anonymous_id = get_anonymous_user_id(user_id)
-        conn = get_db_connection()
-        cursor = conn.cursor()
+    import tracemalloc
+    
+    issue_list = messages['en']['issue_list']
+    location = {'latitude': 60.4518, 'longitude': 22.2666}
+    
+    def build_dict(user_id):
+        return {
+            'language': 'en', 'consent': True, 'location': dict(location),
+            'action_types': [messages['en']['action_options'][0]], 'action_type': 'issue',
+            'issue_type': [issue_list[user_id % 3], issue_list[3 + user_id % 4]], 'custom_issue': [],
+            'awaiting_multiple_select': 'issue'
+        }
+    
+    def build_session(user_id):
+        session = Session(
+            language='en', consent=True, location=dict(location), action_type='issue',
+            custom_issue=[], awaiting_multiple_select='issue'
+        )
+        session.toggle('action', 0)
+        session.toggle('issue', user_id % 3)
+        session.toggle('issue', 3 + user_id % 4)
+        return session
+    
+    results = {}
+    for name, build in (('dict', build_dict), ('slots', build_session)):
+        tracemalloc.start()
+        sessions = [build(user_id) for user_id in range(count)]
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = current / count
+        del sessions
+    
+    results['ratio'] = results['dict'] / results['slots']
+    flow_logger.info(
+        f"Session memory for {count} sessions: dict {results['dict']:.0f}B, "
+        f"slots {results['slots']:.0f}B per session ({results['ratio']:.1f}x)"
+    )
+    return results
+
+
+class _SessionEntry:
+    __slots__ = ('data', 'lock', 'last_access', 'users')
+    
+    def __init__(self):
+        self.data = Session()
+        self.lock = threading.RLock()
+        self.last_access = time.monotonic()
+        self.users = 0
+
+
+class SessionStore:
+    """
+    Bounded in-memory store of per-user conversation state.
+    
+    Sessions idle for longer than ttl are dropped by a background sweeper,
+    and when more than max_entries exist the least recently used idle ones
+    are evicted. Each session has its own lock, held for the whole time an
+    update for that user is handled, so concurrent callbacks from one user
+    are applied one after the other. Sessions in use are never evicted.
+    """
+    
+    def __init__(self, ttl, max_entries, sweep_interval):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.created = 0
+        self.ttl_evictions = 0
+        self.size_evictions = 0
+        self.approx_bytes = 0
+    
+    @contextlib.contextmanager
+    def session(self, user_id):
+        """
+        Hold the session of a user for the duration of a with block
         
-        cursor.execute("SELECT language FROM user_preferences WHERE user_id = ?", (anonymous_id,))
-        result = cursor.fetchone()
+        Args:
+            user_id (int): Telegram user ID
+            
+        Yields:
+            _SessionEntry: Entry whose data dict holds the conversation state
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                entry = _SessionEntry()
+                self._entries[user_id] = entry
+                self.created += 1
+                self._evict_over_capacity()
+            else:
+                self._entries.move_to_end(user_id)
+            # Pin the entry so neither eviction path drops it while in use
+            entry.users += 1
         
-        return_db_connection(conn)
+        entry.lock.acquire()
+        try:
+            yield entry
+        finally:
+            entry.last_access = time.monotonic()
+            entry.lock.release()
+            with self._lock:
+                entry.users -= 1
+    
+    def _evict_over_capacity(self):
+        # Caller holds self._lock; oldest entries come first in the OrderedDict
+        excess = len(self._entries) - self.max_entries
+        if excess <= 0:
+            return
+        for user_id in list(self._entries):
+            if excess <= 0:
+                break
+            if self._entries[user_id].users == 0:
+                del self._entries[user_id]
+                self.size_evictions += 1
+                excess -= 1
+    
+    def sweep(self):
+        """
+        Drop sessions idle for longer than the TTL and refresh the memory gauge
+        
+        Returns:
+            int: Number of sessions dropped
+        """
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            expired = [
+                user_id for user_id, entry in self._entries.items()
+                if entry.users == 0 and entry.last_access < cutoff
+            ]
+            for user_id in expired:
+                del self._entries[user_id]
+            self.ttl_evictions += len(expired)
+            snapshot = [entry.data for entry in self._entries.values()]
+        
+        # Shallow estimate: the dicts plus their direct keys and values
+        approx_bytes = 0
+        for data in snapshot:
+            try:
+                approx_bytes += sys.getsizeof(data)
+                for key, value in data.items():
+                    approx_bytes += sys.getsizeof(key) + sys.getsizeof(value)
+            except RuntimeError:
+                # Changed by a handler while we were measuring; the next sweep catches up
+                pass
+        self.approx_bytes = approx_bytes
         
-        if result and result[0] and result[0] in messages:
-            # Store in user_data for current session
-            if user_id not in user_data:
-                user_data[user_id] = {}
-            user_data[user_id]['language'] = result[0]
-            return result[0]
+        if expired:
+            flow_logger.info(f"Session sweep dropped {len(expired)} idle sessions, {len(snapshot)} remain")
+        return len(expired)
+    
+    def start(self):
+        """Start the background sweeper thread."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="session-sweeper", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Stop the background sweeper thread."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+    
+    def _run(self):
+        while not self._stop_event.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.exception(f"Error sweeping sessions: {e}")
+    
+    def stats(self):
+        """Return a snapshot of the session gauges and eviction counters."""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'in_use': sum(1 for entry in self._entries.values() if entry.users),
+                'approx_bytes': self.approx_bytes,
+                'created': self.created,
+                'ttl_evictions': self.ttl_evictions,
+                'size_evictions': self.size_evictions
+            }
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+session_store = SessionStore(SESSION_IDLE_TTL, SESSION_MAX_ENTRIES, SESSION_SWEEP_INTERVAL)
+
+
+class RequestContext:
+    """
+    State for handling a single incoming update.
+    
+    Created once per update and passed to every ask_*, handle_* and
+    update_*_keyboard step that serves it, so the anonymous ID and language
+    are resolved at most once per update no matter how many steps run.
+    """
+    
+    def __init__(self, chat_id, user_id, entry):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        # Session entry from session_store, locked by the caller
+        self._entry = entry
+        self.session = entry.data
+        self._anonymous_id = None
+        self._lang_code = None
+        self._stored_language_checked = False
+    
+    @property
+    def anonymous_id(self):
+        """Anonymous ID of the user, resolved on first access."""
+        if self._anonymous_id is None:
+            self._anonymous_id = get_anonymous_user_id(self.user_id)
+        return self._anonymous_id
+    
+    @property
+    def stored_language(self):
+        """Language from the session or database, or None if never chosen."""
+        if not self._stored_language_checked:
+            self._stored_language_checked = True
+            try:
+                # First check the current session
+                lang_code = self.session.get('language')
+                if lang_code not in messages:
+                    # Otherwise check in the database
+                    lang_code = lookup_user_language(self.anonymous_id)
+                    if lang_code:
+                        # Store in session for the following updates
+                        self.session['language'] = lang_code
+                self._lang_code = lang_code
+            except Exception as e:
+                flow_logger.error(f"Error retrieving user language: {e}")
+                self._lang_code = None
+        return self._lang_code
+    
+    @property
+    def lang_code(self):
+        """Language code ('en', 'fi', 'sv', 'uk') with default 'en'."""
+        return self.stored_language or 'en'
+    
+    def set_language(self, lang_code):
+        """Switch the language for the rest of this update and the session."""
+        self.session['language'] = lang_code
+        self._lang_code = lang_code
+        self._stored_language_checked = True
+    
+    def reset_session(self, data):
+        """Replace the user's conversation state with a session holding the given fields."""
+        session = Session(**data)
+        self._entry.data = session
+        self.session = session
+
+
+def with_request_context(handler):
+    """Build the RequestContext for an incoming update and pass it on with any routed arguments."""
+    @functools.wraps(handler)
+    def wrapper(update, *args):
+        if isinstance(update, types.CallbackQuery):
+            chat_id = update.message.chat.id
         else:
-            return 'en'  # Default to English
-    except Exception as e:
-        flow_logger.error(f"Error retrieving user language: {e}")
-        return 'en'  # Default to English in case of error
+            chat_id = update.chat.id
+        user_id = update.from_user.id
+        
+        # Updates from the same user are handled one at a time
+        with session_store.session(user_id) as entry:
+            ctx = RequestContext(chat_id, user_id, entry)
+            return handler(update, ctx, *args)
+    return wrapper
+
+
+# Upper bounds in milliseconds of the callback latency histogram buckets
+CALLBACK_LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+class LatencyHistogram:
+    """Thread-safe fixed-bucket histogram of handler latencies."""
+    
+    def __init__(self, buckets_ms):
+        self.buckets_ms = buckets_ms
+        # One extra bucket for everything slower than the last bound
+        self._counts = [0] * (len(buckets_ms) + 1)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+    
+    def observe(self, seconds):
+        elapsed_ms = seconds * 1000
+        index = bisect.bisect_left(self.buckets_ms, elapsed_ms)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+    
+    def snapshot(self):
+        """Return the bucket counts keyed by upper bound, plus count, mean and max."""
+        with self._lock:
+            labels = [f"le_{bound}ms" for bound in self.buckets_ms] + ['inf']
+            return {
+                'buckets': dict(zip(labels, self._counts)),
+                'count': self.count,
+                'mean_ms': self.total_ms / self.count if self.count else 0.0,
+                'max_ms': self.max_ms
+            }
+
+
+class CallbackRouter:
+    """
+    Single entry point for callback queries, dispatched through dicts.
+    
+    Callback data is parsed once: exact routes ("back_to_menu") are looked
+    up first, otherwise the text before the first '_' is the namespace and
+    the next '_'-separated segment is passed to the handler as its argument
+    ("age_3" calls the 'age' route with "3"). Every route keeps its own
+    latency histogram.
+    """
+    
+    def __init__(self, buckets_ms):
+        self.buckets_ms = buckets_ms
+        self._exact = {}
+        self._namespaces = {}
+        self._latency = {}
+        self.unrouted = 0
+    
+    def route(self, namespace):
+        """Register a handler(call, arg) for callback data '<namespace>_<arg>'."""
+        def decorator(handler):
+            self._namespaces[namespace] = handler
+            self._latency[namespace] = LatencyHistogram(self.buckets_ms)
+            return handler
+        return decorator
+    
+    def route_exact(self, data):
+        """Register a handler(call) for callback data equal to data."""
+        def decorator(handler):
+            self._exact[data] = handler
+            self._latency[data] = LatencyHistogram(self.buckets_ms)
+            return handler
+        return decorator
+    
+    def dispatch(self, call):
+        start = time.perf_counter()
+        data = call.data or ''
+        
+        handler = self._exact.get(data)
+        if handler is not None:
+            route, args = data, ()
+        else:
+            route, _, rest = data.partition('_')
+            handler = self._namespaces.get(route)
+            args = (rest.split('_', 1)[0],)
+        
+        if handler is None:
+            self.unrouted += 1
+            flow_logger.warning(f"No route for callback data namespace '{route}'")
+            return
+        
+        try:
+            handler(call, *args)
+        finally:
+            self._latency[route].observe(time.perf_counter() - start)
+    
+    def stats(self):
+        """Return the latency histogram of every route that has been hit."""
+        routes = {
+            route: histogram.snapshot()
+            for route, histogram in self._latency.items()
+            if histogram.count
+        }
+        return {'routes': routes, 'unrouted': self.unrouted}
+
+callback_router = CallbackRouter(CALLBACK_LATENCY_BUCKETS_MS)
+bot.register_callback_query_handler(callback_router.dispatch, func=lambda call: True)
+
+
+# Callback prefix -> messages key holding the options of each inline question
+KEYBOARD_QUESTIONS = {
+    'action': 'action_options',
+    'issue': 'issue_list',
+    'improvement': 'improvement_list',
+    'age': 'age_options',
+    'gender': 'gender_options',
+    'occupation': 'occupation_options',
+    'time': 'time_in_turku_options'
+}
+SINGLE_CHOICE_QUESTIONS = ('age', 'gender', 'occupation', 'time')
+
+# (question, lang_code, selected index or None) -> serialized markup
+_single_choice_keyboards = {}
+
+def _build_keyboard_json(question, lang_code, mask):
+    """
+    Build and serialize the option keyboard of an inline question
+    
+    Args:
+        question (str): Key of KEYBOARD_QUESTIONS, also the callback prefix
+        lang_code (str): Language of the option labels
+        mask (int): Bitmask of the option indices shown as selected
+        
+    Returns:
+        str: JSON markup, accepted by the Bot API methods as reply_markup
+    """
+    options = messages[lang_code][KEYBOARD_QUESTIONS[question]]
+    
+    inline_kb = types.InlineKeyboardMarkup(row_width=1)
+    buttons = [
+        types.InlineKeyboardButton(
+            text=f"✔️ {option}" if mask >> idx & 1 else option,
+            callback_data=f"{question}_{idx}"
+        )
+        for idx, option in enumerate(options)
+    ]
+    done_button = types.InlineKeyboardButton(
+        text="🎯 " + messages[lang_code]['done_button'],
+        callback_data=f"{question}_done"
+    )
+    inline_kb.add(*buttons)
+    inline_kb.add(done_button)
+    return inline_kb.to_json()
+
+def precompute_keyboards():
+    """
+    Serialize every state of the single-choice keyboards in every language
+    
+    Returns:
+        int: Number of keyboards built
+    """
+    for question in SINGLE_CHOICE_QUESTIONS:
+        for lang_code in messages:
+            option_count = len(messages[lang_code][KEYBOARD_QUESTIONS[question]])
+            for selected_idx in [None, *range(option_count)]:
+                single_choice_keyboard(question, lang_code, selected_idx)
+    return len(_single_choice_keyboards)
+
+def single_choice_keyboard(question, lang_code, selected_idx):
+    """Return the serialized keyboard of a single-choice question with one option ticked."""
+    key = (question, lang_code, selected_idx)
+    markup = _single_choice_keyboards.get(key)
+    if markup is None:
+        mask = 0 if selected_idx is None else 1 << selected_idx
+        markup = _build_keyboard_json(question, lang_code, mask)
+        _single_choice_keyboards[key] = markup
+    return markup
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def multi_select_keyboard(question, lang_code, mask):
+    """Return the serialized keyboard of a multi-select question for a selection bitmask."""
+    return _build_keyboard_json(question, lang_code, mask)
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at rate tokens per second up to capacity."""
+    
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+    
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+    
+    def delay(self, now):
+        """Return the seconds until a token can be taken, 0 if one is available now."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+    
+    def block(self, now, seconds):
+        """Hold the bucket empty for seconds, as requested by a 429 retry_after."""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0.0
+        self.updated = max(now, self.blocked_until)
+    
+    def is_full(self, now):
+        self._refill(now)
+        return now >= self.blocked_until and self.tokens >= self.capacity
+
+
+class _OutboundRequest:
+    __slots__ = ('priority', 'chat_id', 'func', 'args', 'kwargs', 'future', 'attempts', 'queued_at')
+    
+    def __init__(self, priority, chat_id, func, args, kwargs):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+
+
+class OutboundScheduler:
+    """
+    Paces every Bot API request through global and per-chat token buckets.
+    
+    Requests wait in one FIFO per priority class; callback answers go out
+    before keyboard edits, which go out before plain messages. A request
+    takes a token from the global bucket and, when it targets a chat, from
+    that chat's bucket; requests of the same chat and class keep their order.
+    A 429 response blocks the offending bucket for retry_after seconds and
+    puts the request back at the head of its queue. The public methods mirror
+    the TeleBot ones, block until the request is sent and return its result.
+    """
+    
+    PRIORITY_CALLBACK_ANSWER = 0
+    PRIORITY_KEYBOARD_EDIT = 1
+    PRIORITY_MESSAGE = 2
+    
+    # Chat buckets kept before full (idle) ones are pruned
+    MAX_CHAT_BUCKETS = 10000
+    
+    def __init__(self, global_rate, global_burst, chat_rate, chat_burst, workers, max_retries):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self._queues = [collections.deque() for _ in range(3)]
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._executor = None
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+    
+    def is_running(self):
+        return self._running
+    
+    def start(self):
+        """Start the dispatcher thread and the sender pool."""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="outbound"
+        )
+        self._thread = threading.Thread(target=self._run, name="outbound-dispatcher", daemon=True)
+        self._thread.start()
+    
+    def stop(self, timeout=10):
+        """Send what is still queued, within timeout, and stop; requests left unsent fail with RuntimeError."""
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join(timeout=timeout)
+        self._thread = None
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        
+        # Left over when the dispatcher timed out or a 429 re-queued a request after it exited
+        with self._cond:
+            leftover = [request for requests in self._queues for request in requests]
+            for requests in self._queues:
+                requests.clear()
+            self.failed += len(leftover)
+        for request in leftover:
+            if not request.future.done():
+                request.future.set_exception(RuntimeError("outbound scheduler stopped"))
+    
+    def submit(self, priority, chat_id, func, args=(), kwargs=None):
+        """
+        Queue a Bot API call
+        
+        Args:
+            priority (int): One of the PRIORITY_* classes
+            chat_id (int): Chat whose bucket the call consumes, None for none
+            func (callable): TeleBot method to call
+            args (tuple, optional): Positional arguments for func
+            kwargs (dict, optional): Keyword arguments for func
+            
+        Returns:
+            concurrent.futures.Future: Resolves with the method's return value
+        """
+        request = _OutboundRequest(priority, chat_id, func, args, kwargs or {})
+        with self._cond:
+            self._queues[priority].append(request)
+            self._cond.notify()
+        return request.future
+    
+    def call(self, priority, chat_id, func, args=(), kwargs=None):
+        """Queue a Bot API call and wait for its result, or call directly if not started."""
+        if not self._running:
+            return func(*args, **(kwargs or {}))
+        future = self.submit(priority, chat_id, func, args, kwargs)
+        return future.result(timeout=OUTBOUND_RESULT_TIMEOUT)
+    
+    def send_message(self, chat_id, text, **kwargs):
+        return self.call(self.PRIORITY_MESSAGE, chat_id, bot.send_message, (chat_id, text), kwargs)
+    
+    def reply_to(self, message, text, **kwargs):
+        return self.call(self.PRIORITY_MESSAGE, message.chat.id, bot.reply_to, (message, text), kwargs)
+    
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        # Callback answers are not chat messages, only the global bucket applies
+        return self.call(
+            self.PRIORITY_CALLBACK_ANSWER, None, bot.answer_callback_query, (callback_query_id, text), kwargs
+        )
+    
+    def edit_message_reply_markup(self, chat_id=None, message_id=None, **kwargs):
+        kwargs.update(chat_id=chat_id, message_id=message_id)
+        return self.call(self.PRIORITY_KEYBOARD_EDIT, chat_id, bot.edit_message_reply_markup, (), kwargs)
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                now = time.monotonic()
+                for idle_chat in [key for key, value in self._chats.items() if value.is_full(now)]:
+                    del self._chats[idle_chat]
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+    
+    def _next_request(self, now):
+        # Caller holds self._cond; returns (request, None) or (None, seconds to wait)
+        wait = self._global.delay(now)
+        if wait > 0:
+            return None, wait
+        
+        wait = None
+        for requests in self._queues:
+            blocked_chats = set()
+            for index, request in enumerate(requests):
+                chat_id = request.chat_id
+                if chat_id is None:
+                    del requests[index]
+                    return request, None
+                if chat_id in blocked_chats:
+                    continue
+                chat_wait = self._chat_bucket(chat_id).delay(now)
+                if chat_wait == 0:
+                    del requests[index]
+                    self._chats[chat_id].take(now)
+                    return request, None
+                # Later requests of this chat must not overtake this one
+                blocked_chats.add(chat_id)
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, wait
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    request, wait = self._next_request(now)
+                    if request is not None:
+                        self._global.take(now)
+                        break
+                    if not self._running and not any(self._queues):
+                        return
+                    self._cond.wait(wait)
+            
+            try:
+                self._executor.submit(self._execute, request)
+            except (AttributeError, RuntimeError):
+                # stop() gave up waiting for this thread and shut the sender pool down
+                request.future.set_exception(RuntimeError("outbound scheduler stopped"))
+                return
+    
+    def _execute(self, request):
+        if request.attempts == 0:
+            waited = time.monotonic() - request.queued_at
+            with self._cond:
+                self.queue_wait_total += waited
+                self.queue_wait_max = max(self.queue_wait_max, waited)
+        
+        if request.future.cancelled():
+            return
+        try:
+            result = request.func(*request.args, **request.kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429 and request.attempts < self.max_retries:
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after') or 1
+                flow_logger.warning(f"Telegram rate limit hit, retrying after {retry_after}s")
+                request.attempts += 1
+                with self._cond:
+                    self.rate_limited += 1
+                    bucket = self._global if request.chat_id is None else self._chat_bucket(request.chat_id)
+                    bucket.block(time.monotonic(), retry_after)
+                    # Back to the head of its class so it keeps its place in line
+                    self._queues[request.priority].appendleft(request)
+                    self._cond.notify()
+                return
+            with self._cond:
+                self.failed += 1
+            request.future.set_exception(e)
+        except BaseException as e:
+            with self._cond:
+                self.failed += 1
+            request.future.set_exception(e)
+        else:
+            with self._cond:
+                self.sent += 1
+            request.future.set_result(result)
+    
+    def stats(self):
+        """Return queue depths per class and the send, failure and 429 counters."""
+        with self._cond:
+            return {
+                'queued_callback_answers': len(self._queues[self.PRIORITY_CALLBACK_ANSWER]),
+                'queued_keyboard_edits': len(self._queues[self.PRIORITY_KEYBOARD_EDIT]),
+                'queued_messages': len(self._queues[self.PRIORITY_MESSAGE]),
+                'chat_buckets': len(self._chats),
+                'sent': self.sent,
+                'failed': self.failed,
+                'rate_limited': self.rate_limited,
+                'queue_wait_total': self.queue_wait_total,
+                'queue_wait_max': self.queue_wait_max
+            }
+
+outbound = OutboundScheduler(
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_BURST,
+    OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST,
+    OUTBOUND_WORKERS, OUTBOUND_MAX_RETRIES
+)
+
+
+class KeyboardRefreshScheduler:
+    """
+    Debounces inline keyboard edits per message.
+    
+    The first schedule() for a message arms a deadline delay seconds ahead;
+    further taps before it fires only replace the pending markup, so a burst
+    of taps costs a single edit_message_reply_markup call with the latest
+    selection. Due edits are handed to outbound without waiting, so a chat
+    whose bucket is empty does not hold up the edits of other chats; a
+    message has at most one edit in flight, and a newer one stays pending
+    until it completes. cancel() drops the pending edit and waits for one
+    that is already being sent, so callers can safely remove the keyboard
+    afterwards.
+    """
+    
+    def __init__(self, delay):
+        self.delay = delay
+        self._pending = {}
+        self._in_flight = set()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self.scheduled = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.failed = 0
+    
+    def is_running(self):
+        return self._running
+    
+    def start(self):
+        """Start the background thread that sends due edits."""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="keyboard-refresh", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Send every pending edit now and stop the background thread."""
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            for key in self._pending:
+                self._pending[key][0] = 0
+            self._cond.notify_all()
+        self._thread.join(timeout=10)
+        self._thread = None
+    
+    def schedule(self, chat_id, message_id, markup):
+        """
+        Queue a keyboard edit, replacing one still pending for the same message
+        
+        Args:
+            chat_id (int): Chat of the message
+            message_id (int): Message carrying the keyboard
+            markup (str): Serialized reply markup with the latest state
+        """
+        key = (chat_id, message_id)
+        with self._cond:
+            if self._running:
+                self.scheduled += 1
+                pending = self._pending.get(key)
+                if pending is not None:
+                    pending[1] = markup
+                    self.coalesced += 1
+                    return
+                self._pending[key] = [time.monotonic() + self.delay, markup]
+                self._cond.notify()
+                return
+        
+        # Without the background thread, edit right away
+        with self._cond:
+            self._in_flight.add(key)
+        self._send(key, markup)
+    
+    def cancel(self, chat_id, message_id):
+        """
+        Drop the pending edit of a message and wait out one being sent
+        
+        Returns:
+            bool: True if a pending edit was dropped
+        """
+        key = (chat_id, message_id)
+        with self._cond:
+            dropped = self._pending.pop(key, None) is not None
+            if dropped:
+                self.cancelled += 1
+            while key in self._in_flight:
+                self._cond.wait()
+        return dropped
+    
+    def _send(self, key, markup):
+        # Caller has put key in _in_flight; _finish takes it out when the edit completes
+        chat_id, message_id = key
+        kwargs = {'chat_id': chat_id, 'message_id': message_id, 'reply_markup': markup}
+        if outbound.is_running():
+            future = outbound.submit(
+                outbound.PRIORITY_KEYBOARD_EDIT, chat_id, bot.edit_message_reply_markup, (), kwargs
+            )
+        else:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(bot.edit_message_reply_markup(**kwargs))
+            except Exception as e:
+                future.set_exception(e)
+        future.add_done_callback(functools.partial(self._finish, key))
+    
+    def _finish(self, key, future):
+        error = None if future.cancelled() else future.exception()
+        if error is None:
+            outcome = 'sent'
+        elif isinstance(error, telebot.apihelper.ApiTelegramException) and 'message is not modified' in str(error):
+            # The user may have changed nothing visible between two flushes
+            outcome = None
+        else:
+            logging.error(f"Error refreshing keyboard: {error}")
+            outcome = 'failed'
+        
+        with self._cond:
+            if outcome == 'sent':
+                self.sent += 1
+            elif outcome == 'failed':
+                self.failed += 1
+            self._in_flight.discard(key)
+            self._cond.notify_all()
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._pending:
+                        if not self._running:
+                            return
+                        self._cond.wait()
+                        continue
+                    now = time.monotonic()
+                    # A message with an edit in flight waits for it, so its edits stay in order
+                    waiting = [
+                        (deadline, key) for key, (deadline, _) in self._pending.items() if key not in self._in_flight
+                    ]
+                    due = [key for deadline, key in waiting if deadline <= now]
+                    if due:
+                        break
+                    if waiting:
+                        self._cond.wait(min(waiting)[0] - now)
+                    else:
+                        self._cond.wait()
+                
+                batch = [(key, self._pending.pop(key)[1]) for key in due]
+                self._in_flight.update(key for key, _ in batch)
+            
+            for key, markup in batch:
+                try:
+                    self._send(key, markup)
+                except Exception as e:
+                    logging.exception(f"Error refreshing keyboard: {e}")
+                    with self._cond:
+                        self.failed += 1
+                        self._in_flight.discard(key)
+                        self._cond.notify_all()
+    
+    def stats(self):
+        """Return the scheduler counters; edits_saved is how many API calls debouncing avoided."""
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'scheduled': self.scheduled,
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'cancelled': self.cancelled,
+                'failed': self.failed,
+                'edits_saved': self.coalesced + self.cancelled
+            }
+
+keyboard_refresher = KeyboardRefreshScheduler(KEYBOARD_REFRESH_DELAY)
+
 def update_welcome_message():
     for lang in messages:
         if lang in menu_messages:
@@ -1045,10 +4310,10 @@ def update_welcome_message():
                 messages[lang][key] = value
 
 # Next, let's add a new function to send the main menu
-def send_main_menu(chat_id, user_id):
+def send_main_menu(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Create inline keyboard with menu options
         inline_kb = types.InlineKeyboardMarkup(row_width=1)
@@ -1081,8 +4346,8 @@ def send_main_menu(chat_id, user_id):
         inline_kb.add(report_button, privacy_button, info_button, language_button)
         
         # Send welcome message with menu
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[lang_code]['welcome'] + "\n\n" + messages[lang_code]['menu_options'],
             reply_markup=inline_kb
         )
@@ -1090,71 +4355,48 @@ def send_main_menu(chat_id, user_id):
     except Exception as e:
         logging.exception(f"Error in send_main_menu: {e}")
         try:
-            lang_code = get_user_language(user_id)
-            bot.send_message(chat_id, messages[lang_code]['error_occurred'])
+            lang_code = ctx.lang_code
+            outbound.send_message(ctx.chat_id, messages[lang_code]['error_occurred'])
         except:
-            bot.send_message(chat_id, "An error occurred. Please try again later.")
+            outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 @bot.message_handler(commands=['start'])
-def send_welcome(message):
+@with_request_context
+def send_welcome(message, ctx):
     try:
-        chat_id = message.chat.id
-        user_id = message.from_user.id
-        
         # Log that we received a start command
 
-        # Initialize user data
-        if user_id not in user_data:
-            user_data[user_id] = {}
-
         # Check if user already has a language preference
-        anonymous_id = get_anonymous_user_id(user_id)
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT language FROM user_preferences WHERE user_id = ?", (anonymous_id,))
-        result = cursor.fetchone()
-        
-        return_db_connection(conn)
-        
-        if result and result[0] and result[0] in messages:
-            # User already has a valid language preference
-            lang_code = result[0]
-            user_data[user_id]['language'] = lang_code
-            
-            
+        if ctx.stored_language:
             # Send main menu in user's preferred language
-            send_main_menu(chat_id, user_id)
+            send_main_menu(ctx)
         else:
             # No valid language preference, ask user to select language first
-            ask_language_selection(chat_id, user_id)
+            ask_language_selection(ctx)
     except Exception as e:
         logging.exception(f"Error in send_welcome: {e}")
         # Use error message in user's language if available
-        lang_code = user_data.get(user_id, {}).get('language', 'en') if 'user_id' in locals() else 'en'
-        bot.send_message(message.chat.id, messages[lang_code]['error_occurred'])
+        lang_code = ctx.session.get('language', 'en')
+        outbound.send_message(ctx.chat_id, messages[lang_code]['error_occurred'])
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('menu_'))
-def handle_menu_selection(call):
+@callback_router.route('menu')
+@with_request_context
+def handle_menu_selection(call, ctx, option):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        option = call.data.split('_')[1]
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Remove the inline keyboard
-        bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+        outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
         
         if option == 'report':
             # Check for consent first
-            if user_id in user_data and user_data[user_id].get('consent') == True:
+            if ctx.session.get('consent') == True:
                 # User has already given consent, proceed to location request
-                ask_location(chat_id, user_id)
+                ask_location(ctx)
             else:
                 # Ask for consent first
-                ask_for_consent(chat_id, user_id)
+                ask_for_consent(ctx)
         
         elif option == 'privacy':
             # Send privacy notice
@@ -1169,8 +4411,8 @@ def handle_menu_selection(call):
             )
             inline_kb.add(link_button, back_button)
             
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 messages[lang_code]['privacy_notice_link'],
                 reply_markup=inline_kb
             )
@@ -1188,61 +4430,57 @@ def handle_menu_selection(call):
             )
             inline_kb.add(link_button, back_button)
             
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 messages[lang_code]['participant_info_link'],
                 reply_markup=inline_kb
             )
         
         elif option == 'language':
             # Ask for language selection again
-            ask_language_selection(chat_id, user_id)
+            ask_language_selection(ctx)
     
     except Exception as e:
         logging.exception(f"Error in handle_menu_selection: {e}")
         try:
-            lang_code = get_user_language(user_id)
-            bot.send_message(chat_id, messages[lang_code]['error_occurred'])
+            lang_code = ctx.lang_code
+            outbound.send_message(ctx.chat_id, messages[lang_code]['error_occurred'])
         except:
-            bot.send_message(chat_id, "An error occurred. Please try again later.")
+            outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "back_to_menu")
-def handle_back_to_menu(call):
+@callback_router.route_exact('back_to_menu')
+@with_request_context
+def handle_back_to_menu(call, ctx):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        
         # Remove the inline keyboard
-        bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+        outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
         
         # Acknowledge the action
-        bot.answer_callback_query(call.id, "Returning to main menu...")
+        outbound.answer_callback_query(call.id, "Returning to main menu...")
         
         # Send main menu
-        send_main_menu(chat_id, user_id)
+        send_main_menu(ctx)
     
     except Exception as e:
         logging.exception(f"Error in handle_back_to_menu: {e}")
         try:
-            lang_code = get_user_language(user_id)
-            bot.send_message(chat_id, messages[lang_code]['error_occurred'])
+            lang_code = ctx.lang_code
+            outbound.send_message(ctx.chat_id, messages[lang_code]['error_occurred'])
         except:
-            bot.send_message(chat_id, "An error occurred. Please try again later.")
+            outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 
 
 # Fix 2: Ensure the ask_language_selection function is working correctly
 
-def ask_language_selection(chat_id, user_id):
+def ask_language_selection(ctx):
     """
     Ask user to select their preferred language
     
     Args:
-        chat_id (int): Telegram chat ID
-        user_id (int): Telegram user ID
+        ctx (RequestContext): Context of the update being handled
     """
     try:
-        
         # Create keyboard with language options
         inline_kb = types.InlineKeyboardMarkup(row_width=2)
         
@@ -1257,67 +4495,57 @@ def ask_language_selection(chat_id, user_id):
         inline_kb.add(*lang_buttons)
         
         # Send language selection message in all supported languages
-        message = bot.send_message(
-            chat_id,
+        message = outbound.send_message(
+            ctx.chat_id,
             "Please select your language / Valitse kieli / Välj språk / Оберіть мову:",
             reply_markup=inline_kb
         )
         
     except Exception as e:
         logging.exception(f"Error in ask_language_selection: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('lang_'))
-def handle_language_selection(call):
+@callback_router.route('lang')
+@with_request_context
+def handle_language_selection(call, ctx, lang_code):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        
-        # Extract language code
-        lang_code = call.data.split('_')[1]
-        
-        
         # Remove the inline keyboard
-        bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+        outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
         
         # Get anonymous ID
-        anonymous_id = get_anonymous_user_id(user_id)
+        anonymous_id = ctx.anonymous_id
         
         # Update language preference in database
         update_user_preferences(anonymous_id=anonymous_id, language=lang_code)
         
-        # Initialize user data if needed
-        if user_id not in user_data:
-            user_data[user_id] = {}
-        
-        # Store language in user_data for current session
-        user_data[user_id]['language'] = lang_code
+        # Store language for the rest of this update and the current session
+        ctx.set_language(lang_code)
         
         # Acknowledge language selection
-        bot.answer_callback_query(call.id, messages[lang_code]['language_selected'])
+        outbound.answer_callback_query(call.id, messages[lang_code]['language_selected'])
         
         # Send language selected confirmation
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[lang_code]['language_selected']
         )
         
         # Send main menu in the selected language
-        send_main_menu(chat_id, user_id)
+        send_main_menu(ctx)
         
     except Exception as e:
         logging.exception(f"Error in handle_language_selection: {e}")
-        bot.send_message(call.message.chat.id, "An error occurred. Please try again later.")
+        outbound.send_message(call.message.chat.id, "An error occurred. Please try again later.")
 
 
      
 # Update the consent function to use language-specific messages
-def ask_for_consent(chat_id, user_id):
+def ask_for_consent(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         inline_kb = types.InlineKeyboardMarkup(row_width=2)
         buttons = [
@@ -1329,8 +4557,8 @@ def ask_for_consent(chat_id, user_id):
         ]
         inline_kb.add(*buttons)
         
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[lang_code]['consent_prompt'],
             reply_markup=inline_kb
         )
@@ -1338,57 +4566,56 @@ def ask_for_consent(chat_id, user_id):
         logging.exception(f"Error in ask_for_consent: {e}")
         # Get language code for error message
         try:
-            lang_code = get_user_language(user_id)
-            bot.send_message(chat_id, messages[lang_code]['error_occurred'])
+            lang_code = ctx.lang_code
+            outbound.send_message(ctx.chat_id, messages[lang_code]['error_occurred'])
         except:
             # Fallback to English if language retrieval fails
-            bot.send_message(chat_id, "An error occurred. Please try again later.")
+            outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 
 # Update the consent handler
-@bot.callback_query_handler(func=lambda call: call.data.startswith('consent_'))
-def handle_consent(call):
+@callback_router.route('consent')
+@with_request_context
+def handle_consent(call, ctx, choice):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        choice = int(call.data.split('_')[1])
+        choice = int(choice)
         
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Get anonymous ID for database update
-        anonymous_id = get_anonymous_user_id(user_id)
+        anonymous_id = ctx.anonymous_id
         
         # Remove the inline keyboard
-        bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+        outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
         
         if choice == 0:  # I agree
             # Store consent in user data
-            user_data[user_id]['consent'] = True
+            ctx.session['consent'] = True
             
             # Update user preferences in the database
             update_user_preferences(anonymous_id=anonymous_id, consent=True)
             
             # Acknowledge consent
-            bot.answer_callback_query(call.id, messages[lang_code]['consent_given'])
+            outbound.answer_callback_query(call.id, messages[lang_code]['consent_given'])
             
             # Send consent confirmation message
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 messages[lang_code]['consent_given']
             )
             
             # Proceed to location request
-            ask_location(chat_id, user_id)
+            ask_location(ctx)
         else:  # I do not agree
             # Store lack of consent
-            user_data[user_id]['consent'] = False
+            ctx.session['consent'] = False
             
             # Update user preferences in the database
             update_user_preferences(anonymous_id=anonymous_id, consent=False)
             
             # Acknowledge decision
-            bot.answer_callback_query(call.id, "You've declined to share your information.")
+            outbound.answer_callback_query(call.id, "You've declined to share your information.")
             
             # Provide restart option
             inline_kb = types.InlineKeyboardMarkup(row_width=1)
@@ -1398,8 +4625,8 @@ def handle_consent(call):
             )
             inline_kb.add(restart_button)
             
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 messages[lang_code]['consent_declined'],
                 reply_markup=inline_kb
             )
@@ -1407,93 +4634,91 @@ def handle_consent(call):
         logging.exception(f"Error in handle_consent: {e}")
         # Try to get user's language for error message
         try:
-            lang_code = get_user_language(user_id)
-            bot.send_message(chat_id, messages[lang_code]['error_occurred'])
+            lang_code = ctx.lang_code
+            outbound.send_message(ctx.chat_id, messages[lang_code]['error_occurred'])
         except:
             # Fallback to English
-            bot.send_message(chat_id, "An error occurred. Please try again later.")
+            outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "restart_bot")
-def handle_restart(call):
+@callback_router.route_exact('restart_bot')
+@with_request_context
+def handle_restart(call, ctx):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        
         # Remove the inline keyboard
-        bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+        outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
         
         # Acknowledge restart
-        bot.answer_callback_query(call.id, "Restarting the bot...")
+        outbound.answer_callback_query(call.id, "Restarting the bot...")
         
         # Get language before clearing user data
-        saved_language = user_data[user_id].get('language', 'en')
+        saved_language = ctx.lang_code
         
         # Clear user data but retain language preference
-        user_data[user_id] = {'language': saved_language}
+        ctx.reset_session({'language': saved_language})
         
         # Start over with welcome message
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[saved_language]['welcome']
         )
         
         # Continue with consent request
-        ask_for_consent(chat_id, user_id)
+        ask_for_consent(ctx)
     except Exception as e:
         logging.exception(f"Error in handle_restart: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('action_'))
-def handle_action_selection(call):
+@callback_router.route('action')
+@with_request_context
+def handle_action_selection(call, ctx, data):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        data = call.data.split('_')[1]
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         if data == 'done':
-            if not user_data[user_id].get('action_types', []):
-                bot.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
+            if not ctx.session.has_selection('action'):
+                outbound.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
                 return
                 
+            # Drop any pending refresh so it cannot bring the keyboard back
+            keyboard_refresher.cancel(ctx.chat_id, call.message.message_id)
+            
             # Remove the inline keyboard
-            bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+            outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
+            
+            # Process selected actions based on language-specific options
+            action_options = messages[lang_code]['action_options']
             
             # Get selected actions
-            selected_actions = user_data[user_id]['action_types']
+            selected_actions = ctx.session.selected_options('action', action_options)
             actions_str = ', '.join(selected_actions)
             
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 f"{messages[lang_code]['your_response']} {actions_str}"
             )
             
             # Clear awaiting_multiple_select
-            user_data[user_id].pop('awaiting_multiple_select', None)
-            
-            # Process selected actions based on language-specific options
-            action_options = messages[lang_code]['action_options']
+            ctx.session.pop('awaiting_multiple_select', None)
             
-            if action_options[0] in selected_actions and action_options[1] in selected_actions:
+            if ctx.session.is_selected('action', 0) and ctx.session.is_selected('action', 1):
                 # Both issue and improvement selected
-                user_data[user_id]['action_type'] = 'both'
+                ctx.session['action_type'] = 'both'
                 
                 # If in modify mode, return to summary after completing issue/improvement selections
-                if user_data[user_id].get('is_modifying'):
-                    user_data[user_id]['return_to_summary_after_both'] = True
+                if ctx.session.get('is_modifying'):
+                    ctx.session['return_to_summary_after_both'] = True
                 
-                ask_issue_list(chat_id, user_id)
-            elif action_options[0] in selected_actions:
+                ask_issue_list(ctx)
+            elif ctx.session.is_selected('action', 0):
                 # Only issue selected
-                user_data[user_id]['action_type'] = 'issue'
-                ask_issue_list(chat_id, user_id)
-            elif action_options[1] in selected_actions:
+                ctx.session['action_type'] = 'issue'
+                ask_issue_list(ctx)
+            elif ctx.session.is_selected('action', 1):
                 # Only improvement selected
-                user_data[user_id]['action_type'] = 'improvement'
-                ask_improvement_list(chat_id, user_id)
+                ctx.session['action_type'] = 'improvement'
+                ask_improvement_list(ctx)
         else:
             idx = int(data)
             options = messages[lang_code]['action_options']
@@ -1501,49 +4726,27 @@ def handle_action_selection(call):
             if 0 <= idx < len(options):
                 choice = options[idx]
                 
-                # Initialize action_types if not already
-                if 'action_types' not in user_data[user_id]:
-                    user_data[user_id]['action_types'] = []
-                
                 # Toggle selection
-                if choice in user_data[user_id]['action_types']:
-                    user_data[user_id]['action_types'].remove(choice)
-                    bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {choice}")
-                else:
-                    user_data[user_id]['action_types'].append(choice)
-                    bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {choice}")
+                ctx.session.toggle('action', idx)
+                outbound.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {choice}")
                 
-                update_action_keyboard(call.message, user_id)
+                update_action_keyboard(call.message, ctx)
             else:
-                bot.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
+                outbound.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
     except Exception as e:
         logging.exception(f"Error in handle_action_selection: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
-def update_action_keyboard(message, user_id):
+def update_action_keyboard(message, ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
-        
-        options = messages[lang_code]['action_options']
-        selected_options = user_data[user_id]['action_types']
-        
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = []
-        
-        for idx, option in enumerate(options):
-            button_text = f"✔️ {option}" if option in selected_options else option
-            callback_data = f"action_{idx}"
-            buttons.append(types.InlineKeyboardButton(text=button_text, callback_data=callback_data))
+        lang_code = ctx.lang_code
         
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'],
-            callback_data="action_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+        # Serialized markup is cached per language and selection state
+        inline_kb = multi_select_keyboard('action', lang_code, ctx.session.action_mask)
         
-        bot.edit_message_reply_markup(chat_id=message.chat.id, message_id=message.message_id, reply_markup=inline_kb)
+        # Rapid taps are collapsed into one edit carrying the latest selection
+        keyboard_refresher.schedule(message.chat.id, message.message_id, inline_kb)
     except Exception as e:
         logging.exception(f"Error in update_action_keyboard: {e}")
 
@@ -1551,121 +4754,100 @@ def update_action_keyboard(message, user_id):
 
 
 
-
-def ask_issue_list(chat_id, user_id):
-    try:
-        # Get user's language
-        lang_code = get_user_language(user_id)
-        
-        # Clear old values if any
-        user_data[user_id]['issue_type'] = []
-        user_data[user_id]['custom_issue'] = []
-        user_data[user_id]['awaiting_multiple_select'] = 'issue'
-        
-        options = messages[lang_code]['issue_list']
-        
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = [
-            types.InlineKeyboardButton(text=option, callback_data=f"issue_{idx}")
-            for idx, option in enumerate(options)
-        ]
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'],
-            callback_data="issue_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+
+def ask_issue_list(ctx):
+    try:
+        # Get user's language
+        lang_code = ctx.lang_code
+        
+        # Clear old values if any
+        ctx.session.clear_selection('issue')
+        ctx.session['custom_issue'] = []
+        ctx.session['awaiting_multiple_select'] = 'issue'
+        
+        inline_kb = multi_select_keyboard('issue', lang_code, 0)
         
         instruction_text = messages[lang_code]['issue_list_prompt']
         
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             instruction_text,
             reply_markup=inline_kb
         )
     except Exception as e:
         logging.exception(f"Error in ask_issue_list: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 # Update the improvement list function to use language-specific options
-def ask_improvement_list(chat_id, user_id):
+def ask_improvement_list(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Clear old values if any
-        user_data[user_id]['improvement_type'] = []
-        user_data[user_id]['custom_improvement'] = []
-        user_data[user_id]['awaiting_multiple_select'] = 'improvement'
+        ctx.session.clear_selection('improvement')
+        ctx.session['custom_improvement'] = []
+        ctx.session['awaiting_multiple_select'] = 'improvement'
         
-        options = messages[lang_code]['improvement_list']
-        
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = [
-            types.InlineKeyboardButton(text=option, callback_data=f"improvement_{idx}")
-            for idx, option in enumerate(options)
-        ]
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'],
-            callback_data="improvement_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+        inline_kb = multi_select_keyboard('improvement', lang_code, 0)
         
         instruction_text = messages[lang_code]['improvement_list_prompt']
         
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             instruction_text,
             reply_markup=inline_kb
         )
     except Exception as e:
         logging.exception(f"Error in ask_improvement_list: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 
   
-@bot.callback_query_handler(func=lambda call: call.data.startswith('issue_'))
-def handle_issue_selection(call):
+@callback_router.route('issue')
+@with_request_context
+def handle_issue_selection(call, ctx, data):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        data = call.data.split('_')[1]
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         if data == 'done':
-            if not user_data[user_id]['issue_type'] and not user_data[user_id].get('custom_issue', []):
-                bot.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
+            if not ctx.session.has_selection('issue') and not ctx.session.get('custom_issue', []):
+                outbound.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
                 return
                 
+            # Drop any pending refresh so it cannot bring the keyboard back
+            keyboard_refresher.cancel(ctx.chat_id, call.message.message_id)
+            
             # Remove the inline keyboard
-            bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+            outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
             
             # Combine selected options and custom inputs
-            all_issues = user_data[user_id]['issue_type'] + user_data[user_id].get('custom_issue', [])
+            all_issues = (
+                ctx.session.selected_options('issue', messages[lang_code]['issue_list'])
+                + ctx.session.get('custom_issue', [])
+            )
             issues_str = ', '.join(all_issues)
             
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 f"{messages[lang_code]['your_response']}: {issues_str}"
             )
             
             # Clear awaiting_multiple_select
-            user_data[user_id].pop('awaiting_multiple_select', None)
+            ctx.session.pop('awaiting_multiple_select', None)
             
             # Check if modifying and both actions were selected
-            if user_data[user_id].get('is_modifying') and user_data[user_id]['action_type'] != 'both':
+            if ctx.session.get('is_modifying') and ctx.session['action_type'] != 'both':
                 # Return to summary if just modifying issues
-                user_data[user_id].pop('is_modifying', None)
-                ask_final_confirmation(chat_id, user_id)
-            elif user_data[user_id]['action_type'] == 'both':
+                ctx.session.pop('is_modifying', None)
+                ask_final_confirmation(ctx)
+            elif ctx.session['action_type'] == 'both':
                 # If both, proceed to improvement list
-                ask_improvement_list(chat_id, user_id)
+                ask_improvement_list(ctx)
             else:
                 # If just issues and not modifying, proceed to additional info
-                ask_additional_info(chat_id, user_id)
+                ask_additional_info(ctx)
         else:
             idx = int(data)
             options = messages[lang_code]['issue_list']
@@ -1676,96 +4858,81 @@ def handle_issue_selection(call):
                 # Check if "Other" option was selected
                 if choice == messages[lang_code]['other_option']:
                     # Prompt for custom input
-                    bot.answer_callback_query(call.id, messages[lang_code]['specify_other'])
-                    bot.send_message(chat_id, messages[lang_code]['specify_other'])
+                    outbound.answer_callback_query(call.id, messages[lang_code]['specify_other'])
+                    outbound.send_message(ctx.chat_id, messages[lang_code]['specify_other'])
                     # Next message will be caught by handle_text_input
                     return
                 
                 # Toggle selection
-                if choice in user_data[user_id]['issue_type']:
-                    user_data[user_id]['issue_type'].remove(choice)
-                    bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']}: {choice}")
-                else:
-                    user_data[user_id]['issue_type'].append(choice)
-                    bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']}: {choice}")
+                ctx.session.toggle('issue', idx)
+                outbound.answer_callback_query(call.id, f"{messages[lang_code]['your_response']}: {choice}")
                 
-                update_issue_keyboard(call.message, user_id)
+                update_issue_keyboard(call.message, ctx)
             else:
-                bot.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
+                outbound.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
     except Exception as e:
         logging.exception(f"Error in handle_issue_selection: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
-def update_issue_keyboard(message, user_id):
+def update_issue_keyboard(message, ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
-        
-        options = messages[lang_code]['issue_list']
-        selected_options = user_data[user_id]['issue_type']
-        
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = []
-        
-        for idx, option in enumerate(options):
-            button_text = f"✔️ {option}" if option in selected_options else option
-            callback_data = f"issue_{idx}"
-            buttons.append(types.InlineKeyboardButton(text=button_text, callback_data=callback_data))
+        lang_code = ctx.lang_code
         
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'],
-            callback_data="issue_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+        # Serialized markup is cached per language and selection state
+        inline_kb = multi_select_keyboard('issue', lang_code, ctx.session.issue_mask)
         
-        bot.edit_message_reply_markup(chat_id=message.chat.id, message_id=message.message_id, reply_markup=inline_kb)
+        # Rapid taps are collapsed into one edit carrying the latest selection
+        keyboard_refresher.schedule(message.chat.id, message.message_id, inline_kb)
     except Exception as e:
         logging.exception(f"Error in update_issue_keyboard: {e}")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('improvement_'))
-def handle_improvement_selection(call):
+@callback_router.route('improvement')
+@with_request_context
+def handle_improvement_selection(call, ctx, data):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        data = call.data.split('_')[1]
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         if data == 'done':
-            if not user_data[user_id]['improvement_type'] and not user_data[user_id].get('custom_improvement', []):
-                bot.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
+            if not ctx.session.has_selection('improvement') and not ctx.session.get('custom_improvement', []):
+                outbound.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
                 return
                 
+            # Drop any pending refresh so it cannot bring the keyboard back
+            keyboard_refresher.cancel(ctx.chat_id, call.message.message_id)
+            
             # Remove the inline keyboard
-            bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+            outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
             
             # Combine selected options and custom inputs
-            all_improvements = user_data[user_id]['improvement_type'] + user_data[user_id].get('custom_improvement', [])
+            all_improvements = (
+                ctx.session.selected_options('improvement', messages[lang_code]['improvement_list'])
+                + ctx.session.get('custom_improvement', [])
+            )
             improvements_str = ', '.join(all_improvements)
             
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 f"{messages[lang_code]['your_response']} {improvements_str}"
             )
             
             # Clear awaiting_multiple_select
-            user_data[user_id].pop('awaiting_multiple_select', None)
+            ctx.session.pop('awaiting_multiple_select', None)
             
             # Check if this is the second part of "both" in modify mode
-            if user_data[user_id].get('return_to_summary_after_both'):
-                user_data[user_id].pop('return_to_summary_after_both', None)
-                user_data[user_id].pop('is_modifying', None)
-                ask_final_confirmation(chat_id, user_id)
+            if ctx.session.get('return_to_summary_after_both'):
+                ctx.session.pop('return_to_summary_after_both', None)
+                ctx.session.pop('is_modifying', None)
+                ask_final_confirmation(ctx)
             # Check if modifying
-            elif user_data[user_id].get('is_modifying'):
-                user_data[user_id].pop('is_modifying', None)
-                ask_final_confirmation(chat_id, user_id)
+            elif ctx.session.get('is_modifying'):
+                ctx.session.pop('is_modifying', None)
+                ask_final_confirmation(ctx)
             else:
                 # Regular flow - proceed to additional info
-                ask_additional_info(chat_id, user_id)
+                ask_additional_info(ctx)
         else:
             idx = int(data)
             options = messages[lang_code]['improvement_list']
@@ -1776,83 +4943,63 @@ def handle_improvement_selection(call):
                 # Check if "Other" option was selected
                 if choice == messages[lang_code]['other_option']:
                     # Prompt for custom input
-                    bot.answer_callback_query(call.id, messages[lang_code]['specify_other'])
-                    bot.send_message(chat_id, messages[lang_code]['specify_other'])
+                    outbound.answer_callback_query(call.id, messages[lang_code]['specify_other'])
+                    outbound.send_message(ctx.chat_id, messages[lang_code]['specify_other'])
                     # Next message will be caught by handle_text_input
                     return
                 
                 # Toggle selection
-                if choice in user_data[user_id]['improvement_type']:
-                    user_data[user_id]['improvement_type'].remove(choice)
-                    bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {choice}")
-                else:
-                    user_data[user_id]['improvement_type'].append(choice)
-                    bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {choice}")
+                ctx.session.toggle('improvement', idx)
+                outbound.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {choice}")
                 
-                update_improvement_keyboard(call.message, user_id)
+                update_improvement_keyboard(call.message, ctx)
             else:
-                bot.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
+                outbound.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
     except Exception as e:
         logging.exception(f"Error in handle_improvement_selection: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 
 # Update the improvement keyboard function
-def update_improvement_keyboard(message, user_id):
+def update_improvement_keyboard(message, ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
-        
-        options = messages[lang_code]['improvement_list']
-        selected_options = user_data[user_id]['improvement_type']
-        
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = []
-        
-        for idx, option in enumerate(options):
-            button_text = f"✔️ {option}" if option in selected_options else option
-            callback_data = f"improvement_{idx}"
-            buttons.append(types.InlineKeyboardButton(text=button_text, callback_data=callback_data))
+        lang_code = ctx.lang_code
         
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'],
-            callback_data="improvement_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+        # Serialized markup is cached per language and selection state
+        inline_kb = multi_select_keyboard('improvement', lang_code, ctx.session.improvement_mask)
         
-        bot.edit_message_reply_markup(chat_id=message.chat.id, message_id=message.message_id, reply_markup=inline_kb)
+        # Rapid taps are collapsed into one edit carrying the latest selection
+        keyboard_refresher.schedule(message.chat.id, message.message_id, inline_kb)
     except Exception as e:
         logging.exception(f"Error in update_improvement_keyboard: {e}")
 
 
 
 # Update the location request function
-def ask_location(chat_id, user_id):
+def ask_location(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Send location request message
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[lang_code]['location_request']
         )
         
         # Register the next step handler
-        bot.register_next_step_handler_by_chat_id(chat_id, handle_location)
+        bot.register_next_step_handler_by_chat_id(ctx.chat_id, handle_location)
     except Exception as e:
         logging.exception(f"Error in ask_location: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 # Update the location handler
-def handle_location(message):
+@with_request_context
+def handle_location(message, ctx):
     try:
-        chat_id = message.chat.id
-        user_id = message.from_user.id
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         if message.content_type == 'location':
             # Extract location data
@@ -1860,7 +5007,7 @@ def handle_location(message):
             longitude = message.location.longitude
             
             # Store location data
-            user_data[user_id]['location'] = {
+            ctx.session['location'] = {
                 'latitude': latitude,
                 'longitude': longitude,
                 'venue_title': '',
@@ -1868,18 +5015,18 @@ def handle_location(message):
             }
             
             # Confirm location received
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 f"📍 {messages[lang_code]['location_received']}"
             )
             
             # If in modify mode, return to summary
-            if user_data[user_id].get('is_modifying'):
-                user_data[user_id].pop('is_modifying', None)
-                ask_final_confirmation(chat_id, user_id)
+            if ctx.session.get('is_modifying'):
+                ctx.session.pop('is_modifying', None)
+                ask_final_confirmation(ctx)
             else:
                 # Otherwise proceed to action selection
-                ask_action_selection(chat_id, user_id)
+                ask_action_selection(ctx)
             
         elif message.content_type == 'venue':
             # Extract venue data
@@ -1889,7 +5036,7 @@ def handle_location(message):
             venue_address = message.venue.address if message.venue.address else ''
             
             # Store venue data
-            user_data[user_id]['location'] = {
+            ctx.session['location'] = {
                 'latitude': latitude,
                 'longitude': longitude,
                 'venue_title': venue_title,
@@ -1897,73 +5044,61 @@ def handle_location(message):
             }
             
             # Confirm venue received
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 f"📍 {messages[lang_code]['location_received']}: {venue_title}"
             )
             
             # If in modify mode, return to summary
-            if user_data[user_id].get('is_modifying'):
-                user_data[user_id].pop('is_modifying', None)
-                ask_final_confirmation(chat_id, user_id)
+            if ctx.session.get('is_modifying'):
+                ctx.session.pop('is_modifying', None)
+                ask_final_confirmation(ctx)
             else:
                 # Otherwise proceed to action selection
-                ask_action_selection(chat_id, user_id)
+                ask_action_selection(ctx)
             
         else:
             # Not a location or venue message
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 messages[lang_code]['please_send_location']
             )
             
             # Ask again for location
-            bot.register_next_step_handler_by_chat_id(chat_id, handle_location)
+            bot.register_next_step_handler_by_chat_id(ctx.chat_id, handle_location)
     except Exception as e:
         logging.exception(f"Error in handle_location: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 
 
-def ask_action_selection(chat_id, user_id):
+def ask_action_selection(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Clear old values if any
-        user_data[user_id]['action_types'] = []
-        user_data[user_id]['awaiting_multiple_select'] = 'action'
-        
-        options = messages[lang_code]['action_options']
+        ctx.session.clear_selection('action')
+        ctx.session['awaiting_multiple_select'] = 'action'
         
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = [
-            types.InlineKeyboardButton(text=option, callback_data=f"action_{idx}")
-            for idx, option in enumerate(options)
-        ]
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'],  
-            callback_data="action_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+        inline_kb = multi_select_keyboard('action', lang_code, 0)
         
         instruction_text = f"{messages[lang_code]['select_action']}"
         
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             instruction_text,
             reply_markup=inline_kb
         )
     except Exception as e:
         logging.exception(f"Error in ask_action_selection: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 
-def ask_additional_info(chat_id, user_id):
+def ask_additional_info(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Create inline keyboard with Skip button
         inline_kb = types.InlineKeyboardMarkup()
@@ -1974,100 +5109,96 @@ def ask_additional_info(chat_id, user_id):
         inline_kb.add(skip_button)
         
         # Send message asking for additional info
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[lang_code]['additional_info_prompt'],
             reply_markup=inline_kb
         )
         
         # Register next step handler
-        bot.register_next_step_handler_by_chat_id(chat_id, handle_additional_info)
+        bot.register_next_step_handler_by_chat_id(ctx.chat_id, handle_additional_info)
     except Exception as e:
         logging.exception(f"Error in ask_additional_info: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 # Update the skip additional info handler
-@bot.callback_query_handler(func=lambda call: call.data == 'skip_additional_info')
-def handle_skip_additional_info(call):
+@callback_router.route_exact('skip_additional_info')
+@with_request_context
+def handle_skip_additional_info(call, ctx):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Remove the inline keyboard
-        bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+        outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
         
         # Acknowledge the skip action
-        bot.answer_callback_query(call.id, messages[lang_code]['skip_button'])
+        outbound.answer_callback_query(call.id, messages[lang_code]['skip_button'])
         
         # Clear the next step handler
-        bot.clear_step_handler_by_chat_id(chat_id)
+        bot.clear_step_handler_by_chat_id(ctx.chat_id)
         
         # Store empty additional info
-        user_data[user_id]['additional_info'] = ''
+        ctx.session['additional_info'] = ''
         
         # Check if we're returning from modify flow
-        if user_data[user_id].get('returning_from_modify'):
+        if ctx.session.get('returning_from_modify'):
             # Remove the flag
-            user_data[user_id].pop('returning_from_modify', None)
+            ctx.session.pop('returning_from_modify', None)
             # Return to summary
-            ask_final_confirmation(chat_id, user_id)
+            ask_final_confirmation(ctx)
         else:
             # Proceed to socioeconomic info
-            ask_socioeconomic_info(chat_id, user_id)
+            ask_socioeconomic_info(ctx)
     except Exception as e:
         logging.exception(f"Error in handle_skip_additional_info: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
-def handle_additional_info(message):
+@with_request_context
+def handle_additional_info(message, ctx):
     try:
-        chat_id = message.chat.id
-        user_id = message.from_user.id
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         if message.content_type == 'text':
             # Store the additional info
-            user_data[user_id]['additional_info'] = message.text.strip()
+            ctx.session['additional_info'] = message.text.strip()
             
             # Check if we're returning from modify flow
-            if user_data[user_id].get('returning_from_modify'):
+            if ctx.session.get('returning_from_modify'):
                 # Remove the flag
-                user_data[user_id].pop('returning_from_modify', None)
+                ctx.session.pop('returning_from_modify', None)
                 # Return to summary
-                ask_final_confirmation(chat_id, user_id)
+                ask_final_confirmation(ctx)
             else:
                 # Proceed to socioeconomic info
-                ask_socioeconomic_info(chat_id, user_id)
+                ask_socioeconomic_info(ctx)
         else:
             # Not a text message
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 messages[lang_code]['please_send_location']
             )
             
             # Ask again for additional info
-            ask_additional_info(chat_id, user_id)
+            ask_additional_info(ctx)
     except Exception as e:
         logging.exception(f"Error in handle_additional_info: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
-def ask_socioeconomic_info(chat_id, user_id):
+def ask_socioeconomic_info(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Get the anonymous ID for the user
-        anonymous_id = get_anonymous_user_id(user_id)
+        anonymous_id = ctx.anonymous_id
         
         # Check if user has already provided socioeconomic data
         existing_data = check_user_socioeconomic_data(anonymous_id)
         
         # If we're modifying, always show the consent question
-        if user_data[user_id].get('is_modifying') or not existing_data:
+        if ctx.session.get('is_modifying') or not existing_data:
             # No existing data or modifying, ask user if they want to provide socioeconomic info
             inline_kb = types.InlineKeyboardMarkup(row_width=2)
             yes_button = types.InlineKeyboardButton(
@@ -2081,8 +5212,8 @@ def ask_socioeconomic_info(chat_id, user_id):
             inline_kb.add(yes_button, no_button)
             
             # Send message asking if user wants to share socioeconomic info
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 messages[lang_code]['socioeconomic_intro'],
                 reply_markup=inline_kb
             )
@@ -2090,58 +5221,55 @@ def ask_socioeconomic_info(chat_id, user_id):
             # User has already provided socioeconomic data and we're not modifying
             flow_logger.info(f"Using existing socioeconomic data for user: {anonymous_id}")
             
-            # Store the existing socioeconomic data in user_data
-            user_data[user_id]['age'] = existing_data['age']
-            user_data[user_id]['gender'] = existing_data['gender']
-            user_data[user_id]['occupation'] = existing_data['occupation']
-            user_data[user_id]['time_in_turku'] = existing_data['time_in_turku']
+            # Store the existing socioeconomic data in the session
+            ctx.session['age'] = existing_data['age']
+            ctx.session['gender'] = existing_data['gender']
+            ctx.session['occupation'] = existing_data['occupation']
+            ctx.session['time_in_turku'] = existing_data['time_in_turku']
             
             # Send a message to inform user
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 "Using your previously provided personal information. "
                 "You can proceed to review your submission."
             )
             
             # Skip to final confirmation
-            ask_final_confirmation(chat_id, user_id)
+            ask_final_confirmation(ctx)
         
     except Exception as e:
         logging.exception(f"Error in ask_socioeconomic_info: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 # Update the socioeconomic choice handler
-@bot.callback_query_handler(func=lambda call: call.data.startswith('socio_'))
-def handle_socioeconomic_choice(call):
+@callback_router.route('socio')
+@with_request_context
+def handle_socioeconomic_choice(call, ctx, choice):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        choice = call.data.split('_')[1]
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Remove the inline keyboard
-        bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+        outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
         
         if choice == 'yes':  # Yes, I'll share
             # Acknowledge the choice
-            bot.answer_callback_query(call.id, messages[lang_code]['socioeconomic_options'][0])
+            outbound.answer_callback_query(call.id, messages[lang_code]['socioeconomic_options'][0])
             
             # Start with age question
-            ask_age(chat_id, user_id)
+            ask_age(ctx)
         else:  # No, skip this part
             # Acknowledge the choice
-            bot.answer_callback_query(call.id, messages[lang_code]['socioeconomic_options'][1])
+            outbound.answer_callback_query(call.id, messages[lang_code]['socioeconomic_options'][1])
             
             # Initialize empty socioeconomic data fields
-            user_data[user_id]['age'] = 'Not provided'
-            user_data[user_id]['gender'] = 'Not provided'
-            user_data[user_id]['occupation'] = 'Not provided'
-            user_data[user_id]['time_in_turku'] = 'Not provided'
+            ctx.session['age'] = 'Not provided'
+            ctx.session['gender'] = 'Not provided'
+            ctx.session['occupation'] = 'Not provided'
+            ctx.session['time_in_turku'] = 'Not provided'
             
             # Store the user's preference to not share socioeconomic data
-            anonymous_id = get_anonymous_user_id(user_id)
+            anonymous_id = ctx.anonymous_id
             update_user_preferences(
                 anonymous_id=anonymous_id,
                 age='Not provided',
@@ -2151,110 +5279,127 @@ def handle_socioeconomic_choice(call):
             )
             
             # Check if we're in modify mode
-            if user_data[user_id].get('is_modifying'):
+            if ctx.session.get('is_modifying'):
                 # Remove the flag
-                user_data[user_id].pop('is_modifying', None)
+                ctx.session.pop('is_modifying', None)
                 # Return to summary
-                ask_final_confirmation(chat_id, user_id)
+                ask_final_confirmation(ctx)
             else:
                 # Regular flow - proceed to final confirmation
-                ask_final_confirmation(chat_id, user_id)
+                ask_final_confirmation(ctx)
     except Exception as e:
         logging.exception(f"Error in handle_socioeconomic_choice: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 # Update the age question function
-def ask_age(chat_id, user_id):
+def ask_age(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Initialize/reset age selection
-        user_data[user_id]['age_selected'] = None
+        ctx.session['age_selected'] = None
         
         # Create inline keyboard for age options
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = [
-            types.InlineKeyboardButton(text=option, callback_data=f"age_{idx}")
-            for idx, option in enumerate(messages[lang_code]['age_options'])
-        ]
-        # Add Done button (disabled initially since no selection has been made)
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'],
-            callback_data="age_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+        inline_kb = single_choice_keyboard('age', lang_code, None)
         
         # Send message asking for age
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[lang_code]['age_question'],
             reply_markup=inline_kb
         )
     except Exception as e:
         logging.exception(f"Error in ask_age: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 # Update age selection handler
-@bot.callback_query_handler(func=lambda call: call.data.startswith('age_'))
-def handle_age_selection(call):
+@callback_router.route('age')
+@with_request_context
+def handle_age_selection(call, ctx, data):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        data = call.data.split('_')[1]
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         if data == 'done':
-            if user_data[user_id].get('age_selected') is None:
-                bot.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
+            if ctx.session.get('age_selected') is None:
+                outbound.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
                 return
             
             # Selection confirmed, store the selected age
-            user_data[user_id]['age'] = messages[lang_code]['age_options'][user_data[user_id]['age_selected']]
+            ctx.session['age'] = messages[lang_code]['age_options'][ctx.session['age_selected']]
             
             # Remove the inline keyboard
-            bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+            outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
             
             # Acknowledge the confirmation
-            bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {user_data[user_id]['age']}")
+            outbound.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {ctx.session['age']}")
             
             # Check if we're returning from modify flow
-            if user_data[user_id].get('returning_from_modify'):
+            if ctx.session.get('returning_from_modify'):
                 # If only modifying age, update the database and return to summary
-                if user_data[user_id].get('gender') and user_data[user_id].get('occupation') and user_data[user_id].get('time_in_turku'):
+                if ctx.session.get('gender') and ctx.session.get('occupation') and ctx.session.get('time_in_turku'):
                     # Update database
-                    anonymous_id = get_anonymous_user_id(user_id)
+                    anonymous_id = ctx.anonymous_id
                     update_user_preferences(
                         anonymous_id=anonymous_id,
-                        age=user_data[user_id]['age']
+                        age=ctx.session['age']
                     )
                     # Return to summary
-                    ask_final_confirmation(chat_id, user_id)
+                    ask_final_confirmation(ctx)
                 else:
                     # Continue with gender question
-                    ask_gender(chat_id, user_id)
+                    ask_gender(ctx)
             else:
                 # Proceed to gender question
-                ask_gender(chat_id, user_id)
+                ask_gender(ctx)
         else:
             idx = int(data)
             if 0 <= idx < len(messages[lang_code]['age_options']):
                 # Store the temporarily selected age
-                user_data[user_id]['age_selected'] = idx
+                ctx.session['age_selected'] = idx
                 
                 # Acknowledge the selection
-                bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {messages[lang_code]['age_options'][idx]}")
+                outbound.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {messages[lang_code]['age_options'][idx]}")
                 
                 # Update the keyboard to show selection
-                update_age_keyboard(call.message, user_id)
+                update_age_keyboard(call.message, ctx)
             else:
-                bot.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
+                outbound.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
     except Exception as e:
         logging.exception(f"Error in handle_age_selection: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
+
+def _fetch_socioeconomic_data(conn, anonymous_id):
+    """Read complete socioeconomic data for a user on the given connection, or None."""
+    cursor = conn.cursor()
+    
+    # Check if user already exists in preferences with socioeconomic data
+    cursor.execute(
+        """
+        SELECT age, gender, occupation, time_in_turku 
+        FROM user_preferences 
+        WHERE user_id = ? AND 
+              age IS NOT NULL AND age != 'Not provided' AND
+              gender IS NOT NULL AND gender != 'Not provided' AND
+              occupation IS NOT NULL AND occupation != 'Not provided' AND
+              time_in_turku IS NOT NULL AND time_in_turku != 'Not provided'
+        """, 
+        (anonymous_id,)
+    )
+    result = cursor.fetchone()
+    
+    if result:
+        # User has socioeconomic data
+        return {
+            'age': result[0],
+            'gender': result[1],
+            'occupation': result[2],
+            'time_in_turku': result[3]
+        }
+    else:
+        # No socioeconomic data available
+        return None
 
 def check_user_socioeconomic_data(anonymous_id):
     """
@@ -2266,447 +5411,319 @@ def check_user_socioeconomic_data(anonymous_id):
     Returns:
         dict: Dictionary containing socioeconomic data if available, otherwise None
     """
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        
-        # Check if user already exists in preferences with socioeconomic data
-        cursor.execute(
-            """
-            SELECT age, gender, occupation, time_in_turku 
-            FROM user_preferences 
-            WHERE user_id = ? AND 
-                  age IS NOT NULL AND age != 'Not provided' AND
-                  gender IS NOT NULL AND gender != 'Not provided' AND
-                  occupation IS NOT NULL AND occupation != 'Not provided' AND
-                  time_in_turku IS NOT NULL AND time_in_turku != 'Not provided'
-            """, 
-            (anonymous_id,)
-        )
-        result = cursor.fetchone()
-        
-        if result:
-            # User has socioeconomic data
-            return {
-                'age': result[0],
-                'gender': result[1],
-                'occupation': result[2],
-                'time_in_turku': result[3]
-            }
-        else:
-            # No socioeconomic data available
-            return None
+        with db_read_pool.connection() as conn:
+            return _fetch_socioeconomic_data(conn, anonymous_id)
     except Exception as e:
         flow_logger.error(f"Error in check_user_socioeconomic_data: {e}")
         return None
-    finally:
-        return_db_connection(conn)
 
 
 # Update the age keyboard function
-def update_age_keyboard(message, user_id):
+def update_age_keyboard(message, ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
-        options = messages[lang_code]['age_options']
-        selected_idx = user_data[user_id]['age_selected']
-        
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = []
-        
-        for idx, option in enumerate(options):
-            button_text = f"✔️ {option}" if idx == selected_idx else option
-            callback_data = f"age_{idx}"
-            buttons.append(types.InlineKeyboardButton(text=button_text, callback_data=callback_data))
-        
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'],
-            callback_data="age_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+        # Serialized markup is precomputed per language and selection state
+        inline_kb = single_choice_keyboard('age', lang_code, ctx.session['age_selected'])
         
-        bot.edit_message_reply_markup(chat_id=message.chat.id, message_id=message.message_id, reply_markup=inline_kb)
+        outbound.edit_message_reply_markup(chat_id=message.chat.id, message_id=message.message_id, reply_markup=inline_kb)
     except Exception as e:
         logging.exception(f"Error in update_age_keyboard: {e}")
 
 # Update the gender question function
-def ask_gender(chat_id, user_id):
+def ask_gender(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Initialize/reset gender selection
-        user_data[user_id]['gender_selected'] = None
+        ctx.session['gender_selected'] = None
         
         # Create inline keyboard for gender options
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = [
-            types.InlineKeyboardButton(text=option, callback_data=f"gender_{idx}")
-            for idx, option in enumerate(messages[lang_code]['gender_options'])
-        ]
-        # Add Done button
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'], 
-            callback_data="gender_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+        inline_kb = single_choice_keyboard('gender', lang_code, None)
         
         # Send message asking for gender
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[lang_code]['gender_question'],
             reply_markup=inline_kb
         )
     except Exception as e:
         logging.exception(f"Error in ask_gender: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 # Update the gender selection handler
-@bot.callback_query_handler(func=lambda call: call.data.startswith('gender_'))
-def handle_gender_selection(call):
+@callback_router.route('gender')
+@with_request_context
+def handle_gender_selection(call, ctx, data):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        data = call.data.split('_')[1]
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         if data == 'done':
-            if user_data[user_id].get('gender_selected') is None:
-                bot.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
+            if ctx.session.get('gender_selected') is None:
+                outbound.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
                 return
             
             # Selection confirmed, store the selected gender
-            user_data[user_id]['gender'] = messages[lang_code]['gender_options'][user_data[user_id]['gender_selected']]
+            ctx.session['gender'] = messages[lang_code]['gender_options'][ctx.session['gender_selected']]
             
             # Remove the inline keyboard
-            bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+            outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
             
             # Acknowledge the confirmation
-            bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {user_data[user_id]['gender']}")
+            outbound.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {ctx.session['gender']}")
             
             # Check if we're returning from modify flow
-            if user_data[user_id].get('returning_from_modify'):
+            if ctx.session.get('returning_from_modify'):
                 # If only modifying gender, update the database and return to summary
-                if user_data[user_id].get('age') and user_data[user_id].get('occupation') and user_data[user_id].get('time_in_turku'):
+                if ctx.session.get('age') and ctx.session.get('occupation') and ctx.session.get('time_in_turku'):
                     # Update database
-                    anonymous_id = get_anonymous_user_id(user_id)
+                    anonymous_id = ctx.anonymous_id
                     update_user_preferences(
                         anonymous_id=anonymous_id,
-                        gender=user_data[user_id]['gender']
+                        gender=ctx.session['gender']
                     )
                     # Return to summary
-                    ask_final_confirmation(chat_id, user_id)
+                    ask_final_confirmation(ctx)
                 else:
                     # Continue with occupation question
-                    ask_occupation(chat_id, user_id)
+                    ask_occupation(ctx)
             else:
                 # Proceed to occupation question
-                ask_occupation(chat_id, user_id)
+                ask_occupation(ctx)
         else:
             idx = int(data)
             if 0 <= idx < len(messages[lang_code]['gender_options']):
                 # Store the temporarily selected gender
-                user_data[user_id]['gender_selected'] = idx
+                ctx.session['gender_selected'] = idx
                 
                 # Acknowledge the selection
-                bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {messages[lang_code]['gender_options'][idx]}")
+                outbound.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {messages[lang_code]['gender_options'][idx]}")
                 
                 # Update the keyboard to show selection
-                update_gender_keyboard(call.message, user_id)
+                update_gender_keyboard(call.message, ctx)
             else:
-                bot.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
+                outbound.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
     except Exception as e:
         logging.exception(f"Error in handle_gender_selection: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 # Update the gender keyboard function
-def update_gender_keyboard(message, user_id):
+def update_gender_keyboard(message, ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
-        
-        options = messages[lang_code]['gender_options']
-        selected_idx = user_data[user_id]['gender_selected']
+        lang_code = ctx.lang_code
         
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = []
-        
-        for idx, option in enumerate(options):
-            button_text = f"✔️ {option}" if idx == selected_idx else option
-            callback_data = f"gender_{idx}"
-            buttons.append(types.InlineKeyboardButton(text=button_text, callback_data=callback_data))
-        
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'],
-            callback_data="gender_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+        # Serialized markup is precomputed per language and selection state
+        inline_kb = single_choice_keyboard('gender', lang_code, ctx.session['gender_selected'])
         
-        bot.edit_message_reply_markup(chat_id=message.chat.id, message_id=message.message_id, reply_markup=inline_kb)
+        outbound.edit_message_reply_markup(chat_id=message.chat.id, message_id=message.message_id, reply_markup=inline_kb)
     except Exception as e:
         logging.exception(f"Error in update_gender_keyboard: {e}")
 
 # Update the occupation question function
-def ask_occupation(chat_id, user_id):
+def ask_occupation(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Initialize/reset occupation selection
-        user_data[user_id]['occupation_selected'] = None
+        ctx.session['occupation_selected'] = None
         
         # Create inline keyboard for occupation options
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = [
-            types.InlineKeyboardButton(text=option, callback_data=f"occupation_{idx}")
-            for idx, option in enumerate(messages[lang_code]['occupation_options'])
-        ]
-        # Add Done button
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'],
-            callback_data="occupation_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+        inline_kb = single_choice_keyboard('occupation', lang_code, None)
         
         # Send message asking for occupation
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[lang_code]['occupation_question'],
             reply_markup=inline_kb
         )
     except Exception as e:
         logging.exception(f"Error in ask_occupation: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('occupation_'))
-def handle_occupation_selection(call):
+@callback_router.route('occupation')
+@with_request_context
+def handle_occupation_selection(call, ctx, data):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        data = call.data.split('_')[1]
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         if data == 'done':
-            if user_data[user_id].get('occupation_selected') is None:
-                bot.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
+            if ctx.session.get('occupation_selected') is None:
+                outbound.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
                 return
             
             # Selection confirmed, store the selected occupation
-            user_data[user_id]['occupation'] = messages[lang_code]['occupation_options'][user_data[user_id]['occupation_selected']]
+            ctx.session['occupation'] = messages[lang_code]['occupation_options'][ctx.session['occupation_selected']]
             
             # Remove the inline keyboard
-            bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+            outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
             
             # Acknowledge the confirmation
-            bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {user_data[user_id]['occupation']}")
+            outbound.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {ctx.session['occupation']}")
             
             # Check if we're returning from modify flow
-            if user_data[user_id].get('returning_from_modify'):
+            if ctx.session.get('returning_from_modify'):
                 # If only modifying occupation, update the database and return to summary
-                if user_data[user_id].get('age') and user_data[user_id].get('gender') and user_data[user_id].get('time_in_turku'):
+                if ctx.session.get('age') and ctx.session.get('gender') and ctx.session.get('time_in_turku'):
                     # Update database
-                    anonymous_id = get_anonymous_user_id(user_id)
+                    anonymous_id = ctx.anonymous_id
                     update_user_preferences(
                         anonymous_id=anonymous_id,
-                        occupation=user_data[user_id]['occupation']
+                        occupation=ctx.session['occupation']
                     )
                     # Return to summary
-                    ask_final_confirmation(chat_id, user_id)
+                    ask_final_confirmation(ctx)
                 else:
                     # Continue with time_in_turku question
-                    ask_time_in_turku(chat_id, user_id)
+                    ask_time_in_turku(ctx)
             else:
                 # Proceed to time_in_turku question
-                ask_time_in_turku(chat_id, user_id)
+                ask_time_in_turku(ctx)
         else:
             idx = int(data)
             if 0 <= idx < len(messages[lang_code]['occupation_options']):
                 # Store the temporarily selected occupation
-                user_data[user_id]['occupation_selected'] = idx
+                ctx.session['occupation_selected'] = idx
                 
                 # Acknowledge the selection
-                bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {messages[lang_code]['occupation_options'][idx]}")
+                outbound.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {messages[lang_code]['occupation_options'][idx]}")
                 
                 # Update the keyboard to show selection
-                update_occupation_keyboard(call.message, user_id)
+                update_occupation_keyboard(call.message, ctx)
             else:
-                bot.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
+                outbound.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
     except Exception as e:
         logging.exception(f"Error in handle_occupation_selection: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 # Update the occupation keyboard function
-def update_occupation_keyboard(message, user_id):
+def update_occupation_keyboard(message, ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
-        
-        options = messages[lang_code]['occupation_options']
-        selected_idx = user_data[user_id]['occupation_selected']
+        lang_code = ctx.lang_code
         
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = []
-        
-        for idx, option in enumerate(options):
-            button_text = f"✔️ {option}" if idx == selected_idx else option
-            callback_data = f"occupation_{idx}"
-            buttons.append(types.InlineKeyboardButton(text=button_text, callback_data=callback_data))
-        
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'],
-            callback_data="occupation_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+        # Serialized markup is precomputed per language and selection state
+        inline_kb = single_choice_keyboard('occupation', lang_code, ctx.session['occupation_selected'])
         
-        bot.edit_message_reply_markup(chat_id=message.chat.id, message_id=message.message_id, reply_markup=inline_kb)
+        outbound.edit_message_reply_markup(chat_id=message.chat.id, message_id=message.message_id, reply_markup=inline_kb)
     except Exception as e:
         logging.exception(f"Error in update_occupation_keyboard: {e}")
 
 # Update the time in Turku question function
-def ask_time_in_turku(chat_id, user_id):
+def ask_time_in_turku(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Initialize/reset time in Turku selection
-        user_data[user_id]['time_in_turku_selected'] = None
+        ctx.session['time_in_turku_selected'] = None
         
         # Create inline keyboard for time in Turku options
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = [
-            types.InlineKeyboardButton(text=option, callback_data=f"time_{idx}")
-            for idx, option in enumerate(messages[lang_code]['time_in_turku_options'])
-        ]
-        # Add Done button
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'],
-            callback_data="time_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+        inline_kb = single_choice_keyboard('time', lang_code, None)
         
         # Send message asking for time in Turku
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[lang_code]['time_in_turku_question'],
             reply_markup=inline_kb
         )
     except Exception as e:
         logging.exception(f"Error in ask_time_in_turku: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('time_'))
-def handle_time_in_turku_selection(call):
+@callback_router.route('time')
+@with_request_context
+def handle_time_in_turku_selection(call, ctx, data):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        data = call.data.split('_')[1]
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         if data == 'done':
-            if user_data[user_id].get('time_in_turku_selected') is None:
-                bot.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
+            if ctx.session.get('time_in_turku_selected') is None:
+                outbound.answer_callback_query(call.id, messages[lang_code]['please_select_at_least_one'])
                 return
             
             # Selection confirmed, store the selected time in Turku
-            user_data[user_id]['time_in_turku'] = messages[lang_code]['time_in_turku_options'][user_data[user_id]['time_in_turku_selected']]
+            ctx.session['time_in_turku'] = messages[lang_code]['time_in_turku_options'][ctx.session['time_in_turku_selected']]
             
             # Remove the inline keyboard
-            bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+            outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
             
             # Acknowledge the confirmation
-            bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {user_data[user_id]['time_in_turku']}")
+            outbound.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {ctx.session['time_in_turku']}")
             
             # Store the socioeconomic data immediately
-            anonymous_id = get_anonymous_user_id(user_id)
+            anonymous_id = ctx.anonymous_id
             update_user_preferences(
                 anonymous_id=anonymous_id,
-                age=user_data[user_id]['age'],
-                gender=user_data[user_id]['gender'],
-                occupation=user_data[user_id]['occupation'],
-                time_in_turku=user_data[user_id]['time_in_turku'],
+                age=ctx.session['age'],
+                gender=ctx.session['gender'],
+                occupation=ctx.session['occupation'],
+                time_in_turku=ctx.session['time_in_turku'],
                 language=lang_code
             )
             
             # Check if we're in modify mode
-            if user_data[user_id].get('is_modifying'):
+            if ctx.session.get('is_modifying'):
                 # Remove the flag
-                user_data[user_id].pop('is_modifying', None)
+                ctx.session.pop('is_modifying', None)
                 # Return to summary
-                ask_final_confirmation(chat_id, user_id)
+                ask_final_confirmation(ctx)
             else:
                 # Regular flow - proceed to final confirmation
-                ask_final_confirmation(chat_id, user_id)
+                ask_final_confirmation(ctx)
         else:
             idx = int(data)
             if 0 <= idx < len(messages[lang_code]['time_in_turku_options']):
                 # Store the temporarily selected time in Turku
-                user_data[user_id]['time_in_turku_selected'] = idx
+                ctx.session['time_in_turku_selected'] = idx
                 
                 # Acknowledge the selection
-                bot.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {messages[lang_code]['time_in_turku_options'][idx]}")
+                outbound.answer_callback_query(call.id, f"{messages[lang_code]['your_response']} {messages[lang_code]['time_in_turku_options'][idx]}")
                 
                 # Update the keyboard to show selection
-                update_time_in_turku_keyboard(call.message, user_id)
+                update_time_in_turku_keyboard(call.message, ctx)
             else:
-                bot.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
+                outbound.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
     except Exception as e:
         logging.exception(f"Error in handle_time_in_turku_selection: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 
 # Update the time in Turku keyboard function
-def update_time_in_turku_keyboard(message, user_id):
+def update_time_in_turku_keyboard(message, ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
-        
-        options = messages[lang_code]['time_in_turku_options']
-        selected_idx = user_data[user_id]['time_in_turku_selected']
+        lang_code = ctx.lang_code
         
-        inline_kb = types.InlineKeyboardMarkup(row_width=1)
-        buttons = []
-        
-        for idx, option in enumerate(options):
-            button_text = f"✔️ {option}" if idx == selected_idx else option
-            callback_data = f"time_{idx}"
-            buttons.append(types.InlineKeyboardButton(text=button_text, callback_data=callback_data))
-        
-        done_button = types.InlineKeyboardButton(
-            text="🎯 " + messages[lang_code]['done_button'],
-            callback_data="time_done"
-        )
-        inline_kb.add(*buttons)
-        inline_kb.add(done_button)
+        # Serialized markup is precomputed per language and selection state
+        inline_kb = single_choice_keyboard('time', lang_code, ctx.session['time_in_turku_selected'])
         
-        bot.edit_message_reply_markup(chat_id=message.chat.id, message_id=message.message_id, reply_markup=inline_kb)
+        outbound.edit_message_reply_markup(chat_id=message.chat.id, message_id=message.message_id, reply_markup=inline_kb)
     except Exception as e:
         logging.exception(f"Error in update_time_in_turku_keyboard: {e}")
 
-def ask_final_confirmation(chat_id, user_id):
+def ask_final_confirmation(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Prepare the summary message
-        summary = generate_summary(user_id)
+        summary = generate_summary(ctx)
+        
+        # A fresh token per shown summary; confirming consumes it
+        ctx.session['submission_token'] = uuid.uuid4().hex
         
         # Send the summary
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             f"{messages[lang_code]['submission_summary']}\n\n{summary}"
         )
         
@@ -2723,40 +5740,48 @@ def ask_final_confirmation(chat_id, user_id):
         inline_kb.add(yes_button, modify_button)
         
         # Ask for confirmation
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[lang_code]['confirm_responses'],
             reply_markup=inline_kb
         )
     except Exception as e:
         logging.exception(f"Error in ask_final_confirmation: {e}")
-        lang_code = get_user_language(user_id) if 'user_id' in locals() else 'en'
-        bot.send_message(chat_id, messages[lang_code]['error_occurred'])
+        lang_code = ctx.lang_code
+        outbound.send_message(ctx.chat_id, messages[lang_code]['error_occurred'])
 
 # Update the summary generation function
-def generate_summary(user_id):
+def generate_summary(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
-        action_type = user_data[user_id]['action_type']
-        location_data = user_data[user_id]['location']
+        action_type = ctx.session['action_type']
+        location_data = ctx.session['location']
+        issue_options = messages[lang_code]['issue_list']
+        improvement_options = messages[lang_code]['improvement_list']
         
         summary_parts = []
         
         # Action type and details
         if action_type == 'issue':
-            issues = user_data[user_id]['issue_type'] + user_data[user_id].get('custom_issue', [])
+            issues = ctx.session.selected_options('issue', issue_options) + ctx.session.get('custom_issue', [])
             issues_text = ', '.join(issues)
             summary_parts.append(f"{messages[lang_code]['labels']['issue_type']}: {issues_text}")
         elif action_type == 'improvement':
-            improvements = user_data[user_id]['improvement_type'] + user_data[user_id].get('custom_improvement', [])
+            improvements = (
+                ctx.session.selected_options('improvement', improvement_options)
+                + ctx.session.get('custom_improvement', [])
+            )
             improvements_text = ', '.join(improvements)
             summary_parts.append(f"{messages[lang_code]['labels']['improvement_type']}: {improvements_text}")
         elif action_type == 'both':
             # Handle both issues and improvements
-            issues = user_data[user_id]['issue_type'] + user_data[user_id].get('custom_issue', [])
-            improvements = user_data[user_id]['improvement_type'] + user_data[user_id].get('custom_improvement', [])
+            issues = ctx.session.selected_options('issue', issue_options) + ctx.session.get('custom_issue', [])
+            improvements = (
+                ctx.session.selected_options('improvement', improvement_options)
+                + ctx.session.get('custom_improvement', [])
+            )
             
             issues_text = ', '.join(issues)
             improvements_text = ', '.join(improvements)
@@ -2771,22 +5796,22 @@ def generate_summary(user_id):
             summary_parts.append(f"{messages[lang_code]['labels']['location']}: {location_data['latitude']}, {location_data['longitude']}")
         
         # Additional info if provided
-        additional_info = user_data[user_id].get('additional_info', '')
+        additional_info = ctx.session.get('additional_info', '')
         if additional_info:
             summary_parts.append(f"{messages[lang_code]['additional_info_prompt']}: {additional_info}")
         
         # Socioeconomic information if provided
-        if user_data[user_id].get('age') and user_data[user_id]['age'] != 'Not provided':
-            summary_parts.append(f"{messages[lang_code]['labels']['age']}: {user_data[user_id]['age']}")
+        if ctx.session.get('age') and ctx.session['age'] != 'Not provided':
+            summary_parts.append(f"{messages[lang_code]['labels']['age']}: {ctx.session['age']}")
         
-        if user_data[user_id].get('gender') and user_data[user_id]['gender'] != 'Not provided':
-            summary_parts.append(f"{messages[lang_code]['labels']['gender']}: {user_data[user_id]['gender']}")
+        if ctx.session.get('gender') and ctx.session['gender'] != 'Not provided':
+            summary_parts.append(f"{messages[lang_code]['labels']['gender']}: {ctx.session['gender']}")
         
-        if user_data[user_id].get('occupation') and user_data[user_id]['occupation'] != 'Not provided':
-            summary_parts.append(f"{messages[lang_code]['labels']['occupation']}: {user_data[user_id]['occupation']}")
+        if ctx.session.get('occupation') and ctx.session['occupation'] != 'Not provided':
+            summary_parts.append(f"{messages[lang_code]['labels']['occupation']}: {ctx.session['occupation']}")
         
-        if user_data[user_id].get('time_in_turku') and user_data[user_id]['time_in_turku'] != 'Not provided':
-            summary_parts.append(f"{messages[lang_code]['labels']['time_in_turku']}: {user_data[user_id]['time_in_turku']}")
+        if ctx.session.get('time_in_turku') and ctx.session['time_in_turku'] != 'Not provided':
+            summary_parts.append(f"{messages[lang_code]['labels']['time_in_turku']}: {ctx.session['time_in_turku']}")
         
         # Current date and time
         current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -2798,62 +5823,71 @@ def generate_summary(user_id):
         return "Error generating summary."
 
 # Update the final confirmation handler
-@bot.callback_query_handler(func=lambda call: call.data.startswith('confirm_'))
-def handle_final_confirmation(call):
+@callback_router.route('confirm')
+@with_request_context
+def handle_final_confirmation(call, ctx, choice):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        choice = call.data.split('_')[1]
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
+        
+        if choice == 'yes':
+            # A double tap or replayed update finds the token already used
+            submission_token = ctx.session.get('submission_token')
+            if submission_token is None or submission_token in confirmed_submission_tokens:
+                flow_logger.info(f"Ignoring repeated confirmation for user: {ctx.anonymous_id}")
+                outbound.answer_callback_query(call.id)
+                return
         
         # Remove the inline keyboard
-        bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+        outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
         
         if choice == 'yes':  # Yes, submit
             # Save the data
-            success = save_data(chat_id, user_id)
+            success = save_data(ctx)
             
             if success:
+                # Consume the token so further taps on this summary are ignored
+                confirmed_submission_tokens.add(submission_token)
+                ctx.session.pop('submission_token', None)
+                
                 # Ask if they want to submit another location
-                ask_submit_another(chat_id, user_id)
+                ask_submit_another(ctx)
             else:
                 # Error message handled in save_data function
                 pass
                 
         elif choice == 'modify':  # User wants to modify responses
             # Show modifiable question blocks
-            show_modifiable_questions(chat_id, user_id)
+            show_modifiable_questions(ctx)
             
         elif choice == 'no':  # No, start over
             # Acknowledge the choice
-            bot.answer_callback_query(call.id, "Starting over...")
+            outbound.answer_callback_query(call.id, "Starting over...")
             
             # Send a message and restart
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 "Let's start over."
             )
             
             # Get language before restarting
-            saved_language = user_data[user_id].get('language', 'en')
+            saved_language = lang_code
             
             # Restart the process from consent
             # Initialize user data but keep language
-            user_data[user_id] = {'language': saved_language}
+            ctx.reset_session({'language': saved_language})
             
             # Ask for consent
-            ask_for_consent(chat_id, user_id)
+            ask_for_consent(ctx)
     except Exception as e:
         logging.exception(f"Error in handle_final_confirmation: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 
-def show_modifiable_questions(chat_id, user_id):
+def show_modifiable_questions(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Create simplified modification options
         inline_kb = types.InlineKeyboardMarkup(row_width=1)
@@ -2886,87 +5920,81 @@ def show_modifiable_questions(chat_id, user_id):
         inline_kb.add(location_button, action_button, socio_button, done_button)
         
         # Send message with options
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[lang_code]['select_questions_to_modify'],
             reply_markup=inline_kb
         )
     except Exception as e:
         logging.exception(f"Error in show_modifiable_questions: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('modify_'))
-def handle_modify_selection(call):
+@callback_router.route('modify')
+@with_request_context
+def handle_modify_selection(call, ctx, action):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        action = call.data.split('_')[1]
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Remove the inline keyboard
-        bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
+        outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
         
         # Handle different modification options
         if action == 'done':
             # Return to summary and confirmation
-            ask_final_confirmation(chat_id, user_id)
+            ask_final_confirmation(ctx)
             
         elif action == 'location':
             # Set flag to indicate we're in modify mode
-            user_data[user_id]['is_modifying'] = True
+            ctx.session['is_modifying'] = True
             # Ask for location again
-            bot.answer_callback_query(call.id, "Updating location...")
-            ask_location(chat_id, user_id)
+            outbound.answer_callback_query(call.id, "Updating location...")
+            ask_location(ctx)
             
         elif action == 'action':
             # Set flag to indicate we're in modify mode
-            user_data[user_id]['is_modifying'] = True
+            ctx.session['is_modifying'] = True
             # Reset action data
-            if 'action_type' in user_data[user_id]:
-                user_data[user_id].pop('action_type', None)
-            if 'action_types' in user_data[user_id]:
-                user_data[user_id].pop('action_types', None)
-            if 'issue_type' in user_data[user_id]:
-                user_data[user_id].pop('issue_type', None)
-            if 'custom_issue' in user_data[user_id]:
-                user_data[user_id].pop('custom_issue', None)
-            if 'improvement_type' in user_data[user_id]:
-                user_data[user_id].pop('improvement_type', None)
-            if 'custom_improvement' in user_data[user_id]:
-                user_data[user_id].pop('custom_improvement', None)
+            if 'action_type' in ctx.session:
+                ctx.session.pop('action_type', None)
+            ctx.session.clear_selection('action')
+            ctx.session.clear_selection('issue')
+            if 'custom_issue' in ctx.session:
+                ctx.session.pop('custom_issue', None)
+            ctx.session.clear_selection('improvement')
+            if 'custom_improvement' in ctx.session:
+                ctx.session.pop('custom_improvement', None)
                 
             # Ask for action selection again
-            bot.answer_callback_query(call.id, "Updating issue/improvement selection...")
-            ask_action_selection(chat_id, user_id)
+            outbound.answer_callback_query(call.id, "Updating issue/improvement selection...")
+            ask_action_selection(ctx)
             
         elif action == 'socio':
             # Set modify flag
-            user_data[user_id]['is_modifying'] = True
+            ctx.session['is_modifying'] = True
             # Just start the socioeconomic flow from the beginning
-            bot.answer_callback_query(call.id, "Updating personal information...")
+            outbound.answer_callback_query(call.id, "Updating personal information...")
             # Go to socioeconomic intro question
-            ask_socioeconomic_info(chat_id, user_id)
+            ask_socioeconomic_info(ctx)
         
         else:
             # Invalid option
-            bot.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
-            show_modifiable_questions(chat_id, user_id)
+            outbound.answer_callback_query(call.id, messages[lang_code]['invalid_selection'])
+            show_modifiable_questions(ctx)
             
     except Exception as e:
         logging.exception(f"Error in handle_modify_selection: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 # Update the submit another function
-def ask_submit_another(chat_id, user_id):
+def ask_submit_another(ctx):
     try:
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Send thank you message
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[lang_code]['submission_received']
         )
         
@@ -2983,191 +6011,128 @@ def ask_submit_another(chat_id, user_id):
         inline_kb.add(yes_button, no_button)
         
         # Ask if they want to submit another
-        bot.send_message(
-            chat_id,
+        outbound.send_message(
+            ctx.chat_id,
             messages[lang_code]['submit_another'],
             reply_markup=inline_kb
         )
     except Exception as e:
         logging.exception(f"Error in ask_submit_another: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 
 # Update the submit another handler
-@bot.callback_query_handler(func=lambda call: call.data.startswith('another_'))
-def handle_submit_another(call):
+@callback_router.route('another')
+@with_request_context
+def handle_submit_another(call, ctx, choice):
     try:
-        chat_id = call.message.chat.id
-        user_id = call.from_user.id
-        choice = call.data.split('_')[1]
-        
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
         # Remove the inline keyboard
-        bot.edit_message_reply_markup(chat_id=chat_id, message_id=call.message.message_id, reply_markup=None)
-        
-        # Ensure user_id exists in user_data
-        if user_id not in user_data:
-            user_data[user_id] = {'language': lang_code}
+        outbound.edit_message_reply_markup(chat_id=ctx.chat_id, message_id=call.message.message_id, reply_markup=None)
         
         if choice == 'yes':  # Yes, submit another
             # Acknowledge the choice
-            bot.answer_callback_query(call.id, messages[lang_code]['submit_another_options'][0])
+            outbound.answer_callback_query(call.id, messages[lang_code]['submit_another_options'][0])
             
             # Save language, consent and socioeconomic data
-            consent = user_data[user_id].get('consent', True)
-            age = user_data[user_id].get('age', None)
-            gender = user_data[user_id].get('gender', None)
-            occupation = user_data[user_id].get('occupation', None)
-            time_in_turku = user_data[user_id].get('time_in_turku', None)
-            language = user_data[user_id].get('language', 'en')
+            consent = ctx.session.get('consent', True)
+            age = ctx.session.get('age', None)
+            gender = ctx.session.get('gender', None)
+            occupation = ctx.session.get('occupation', None)
+            time_in_turku = ctx.session.get('time_in_turku', None)
+            language = lang_code
             
             # Clear user data but keep consent and socioeconomic data
-            user_data[user_id] = {
+            ctx.reset_session({
                 'consent': consent,
                 'age': age,
                 'gender': gender,
                 'occupation': occupation,
                 'time_in_turku': time_in_turku,
                 'language': language
-            }
+            })
             
             # Start from location request
-            ask_location(chat_id, user_id)
+            ask_location(ctx)
             
         elif choice == 'no':  # No, I'm done
             # Acknowledge the choice
-            bot.answer_callback_query(call.id, messages[lang_code]['submit_another_options'][1])
+            outbound.answer_callback_query(call.id, messages[lang_code]['submit_another_options'][1])
             
             # Send a thank you message
-            bot.send_message(
-                chat_id,
+            outbound.send_message(
+                ctx.chat_id,
                 messages[lang_code]['thank_you']
             )
             
             # Return to main menu
-            send_main_menu(chat_id, user_id)
+            send_main_menu(ctx)
     except Exception as e:
         logging.exception(f"Error in handle_submit_another: {e}")
-        bot.send_message(chat_id, "An error occurred. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
 
 
        
-def save_data(chat_id, user_id):
+def save_data(ctx):
     """
     Save user data to the database, replacing original save_data function
     
+    The preference update and all submissions of the confirmation are written
+    as one SubmissionUnitOfWork, i.e. in a single transaction.
+    
     Args:
-        chat_id (int): Telegram chat ID
-        user_id (int): Telegram user ID
+        ctx (RequestContext): Context of the update being handled
         
     Returns:
         bool: Success status
     """
     try:
         # Generate anonymous ID for the user
-        anonymous_id = get_anonymous_user_id(user_id)
-        
-        # Get action type and location data from user_data dictionary
-        action_type = user_data[user_id]['action_type']
-        location_data = user_data[user_id]['location']
-        additional_info = user_data[user_id].get('additional_info', '')
-        
-        # Get socioeconomic data
-        age = user_data[user_id].get('age', 'Not provided')
-        gender = user_data[user_id].get('gender', 'Not provided')
-        occupation = user_data[user_id].get('occupation', 'Not provided')
-        time_in_turku = user_data[user_id].get('time_in_turku', 'Not provided')
-        
-        # Update user preferences - only update socioeconomic data if it changed
-        # to avoid overwriting with 'Not provided' if previously answered
-        existing_data = check_user_socioeconomic_data(anonymous_id)
-        
-        if existing_data:
-            # User already has socioeconomic data, only update consent
-            update_user_preferences(
-                anonymous_id=anonymous_id,
-                consent=user_data[user_id].get('consent', True)
-            )
-        else:
-            # User doesn't have socioeconomic data or chose to update it
-            update_user_preferences(
-                anonymous_id=anonymous_id,
-                consent=user_data[user_id].get('consent', True),
-                age=age,
-                gender=gender,
-                occupation=occupation,
-                time_in_turku=time_in_turku
-            )
+        anonymous_id = ctx.anonymous_id
+        
+        # Selections are stored as option indices into the user's language
+        lang_code = ctx.lang_code
+        
+        # Get action type and location data from the session
+        action_type = ctx.session['action_type']
+        location_data = ctx.session['location']
+        additional_info = ctx.session.get('additional_info', '')
+        
+        unit = SubmissionUnitOfWork(anonymous_id, submission_token=ctx.session.get('submission_token'))
+        
+        # Update user preferences - only update socioeconomic data if it is not
+        # stored yet to avoid overwriting with 'Not provided' if previously answered
+        unit.update_preferences(
+            keep_existing_socioeconomic=True,
+            consent=ctx.session.get('consent', True),
+            age=ctx.session.get('age', 'Not provided'),
+            gender=ctx.session.get('gender', 'Not provided'),
+            occupation=ctx.session.get('occupation', 'Not provided'),
+            time_in_turku=ctx.session.get('time_in_turku', 'Not provided')
+        )
         
         # Handle different action types
-        success = True
-        
         if action_type == 'both':
-            # First, handle issues
-            issue_standard_selections = user_data[user_id]['issue_type']
-            issue_custom_inputs = user_data[user_id].get('custom_issue', [])
-            
-            issue_standard_details = ';'.join(issue_standard_selections) if issue_standard_selections else ''
-            issue_custom_details = ';'.join(issue_custom_inputs) if issue_custom_inputs else ''
-            
-            # Save issues
-            issue_id = save_submission(
-                anonymous_id=anonymous_id,
-                submission_type='issue',
-                standard_selections=issue_standard_details,
-                custom_inputs=issue_custom_details,
-                latitude=location_data['latitude'],
-                longitude=location_data['longitude'],
-                venue_title=location_data.get('venue_title', ''),
-                venue_address=location_data.get('venue_address', ''),
-                additional_info=additional_info
-            )
-            
-            success = success and issue_id > 0
-            
-            # Second, handle improvements
-            improvement_standard_selections = user_data[user_id]['improvement_type']
-            improvement_custom_inputs = user_data[user_id].get('custom_improvement', [])
-            
-            improvement_standard_details = ';'.join(improvement_standard_selections) if improvement_standard_selections else ''
-            improvement_custom_details = ';'.join(improvement_custom_inputs) if improvement_custom_inputs else ''
-            
-            # Save improvements
-            improvement_id = save_submission(
-                anonymous_id=anonymous_id,
-                submission_type='improvement',
-                standard_selections=improvement_standard_details,
-                custom_inputs=improvement_custom_details,
-                latitude=location_data['latitude'],
-                longitude=location_data['longitude'],
-                venue_title=location_data.get('venue_title', ''),
-                venue_address=location_data.get('venue_address', ''),
-                additional_info=additional_info
-            )
-            
-            success = success and improvement_id > 0
+            submission_types = ['issue', 'improvement']
         else:
-            # Handle single submission types (issue or improvement)
-            
+            submission_types = [action_type]
+        
+        for submission_type in submission_types:
             # Separate standard selections from custom inputs
-            if action_type == 'issue':
-                submission_type = 'issue'
-                standard_selections = user_data[user_id]['issue_type']
-                custom_inputs = user_data[user_id].get('custom_issue', [])
+            if submission_type == 'issue':
+                standard_selections = ctx.session.selected_options('issue', messages[lang_code]['issue_list'])
+                custom_inputs = ctx.session.get('custom_issue', [])
             else:  # improvement
-                submission_type = 'improvement'
-                standard_selections = user_data[user_id]['improvement_type']
-                custom_inputs = user_data[user_id].get('custom_improvement', [])
+                standard_selections = ctx.session.selected_options('improvement', messages[lang_code]['improvement_list'])
+                custom_inputs = ctx.session.get('custom_improvement', [])
             
             # Join all selections with semicolons to maintain format
             standard_details = ';'.join(standard_selections) if standard_selections else ''
             custom_details = ';'.join(custom_inputs) if custom_inputs else ''
             
-            # Save submission
-            submission_id = save_submission(
-                anonymous_id=anonymous_id,
+            unit.add_submission(
                 submission_type=submission_type,
                 standard_selections=standard_details,
                 custom_inputs=custom_details,
@@ -3177,94 +6142,462 @@ def save_data(chat_id, user_id):
                 venue_address=location_data.get('venue_address', ''),
                 additional_info=additional_info
             )
-            
-            success = submission_id > 0
         
-        return success
+        # Wait until the whole confirmation is committed
+        future = unit.commit()
+        try:
+            submission_ids = future.result(timeout=WRITER_RESULT_TIMEOUT)
+        except sqlite3.IntegrityError as e:
+            if 'submission_token' not in str(e):
+                raise
+            # This confirmation was already stored, e.g. before a restart emptied the memory guard
+            flow_logger.info(f"Submission token already stored for user: {anonymous_id}")
+            return True
+        flow_logger.info(f"Saved submissions {submission_ids} for user: {anonymous_id}")
+        
+        return True
     except Exception as e:
         logging.exception(f"Error in save_data: {e}")
         flow_logger.error(f"Save data failed: {e}")
-        bot.send_message(chat_id, "An error occurred while saving your data. Please try again later.")
+        outbound.send_message(ctx.chat_id, "An error occurred while saving your data. Please try again later.")
         return False
 
 # Handle text messages for custom inputs
 @bot.message_handler(func=lambda m: True, content_types=['text'])
-def handle_text_input(message):
+@with_request_context
+def handle_text_input(message, ctx):
     try:
-        chat_id = message.chat.id
-        user_id = message.from_user.id
         text = message.text.strip()
         
         # Get user's language
-        lang_code = get_user_language(user_id)
+        lang_code = ctx.lang_code
         
-        if user_id in user_data and 'awaiting_multiple_select' in user_data[user_id]:
-            mode = user_data[user_id]['awaiting_multiple_select']
+        if 'awaiting_multiple_select' in ctx.session:
+            mode = ctx.session['awaiting_multiple_select']
             
             if mode == 'issue':
                 # Initialize custom_issue if needed
-                if 'custom_issue' not in user_data[user_id]:
-                    user_data[user_id]['custom_issue'] = []
+                if 'custom_issue' not in ctx.session:
+                    ctx.session['custom_issue'] = []
                 
                 # Add the text input to custom issues
-                user_data[user_id]['custom_issue'].append(text)
+                ctx.session['custom_issue'].append(text)
                 
                 # Confirmation message
-                bot.reply_to(message, messages[lang_code]['free_text_added'])
+                outbound.reply_to(message, messages[lang_code]['free_text_added'])
                 
             elif mode == 'improvement':
                 # Initialize custom_improvement if needed
-                if 'custom_improvement' not in user_data[user_id]:
-                    user_data[user_id]['custom_improvement'] = []
+                if 'custom_improvement' not in ctx.session:
+                    ctx.session['custom_improvement'] = []
                 
                 # Add the text input to custom improvements
-                user_data[user_id]['custom_improvement'].append(text)
+                ctx.session['custom_improvement'].append(text)
                 
                 # Confirmation message
-                bot.reply_to(message, messages[lang_code]['free_text_added'])
+                outbound.reply_to(message, messages[lang_code]['free_text_added'])
             
             elif mode == 'action':
                 # Custom actions are not allowed
-                bot.reply_to(message, messages[lang_code]['please_select_at_least_one'])
+                outbound.reply_to(message, messages[lang_code]['please_select_at_least_one'])
                 
             else:
                 # Unknown mode, just restart
-                bot.send_message(chat_id, messages[lang_code]['error_occurred'])
+                outbound.send_message(ctx.chat_id, messages[lang_code]['error_occurred'])
         else:
             # Check if awaiting additional info
-            if user_id in user_data and 'additional_info' in user_data.get(user_id, {}):
+            if 'additional_info' in ctx.session:
                 # Store the additional info and proceed
-                user_data[user_id]['additional_info'] = text
+                ctx.session['additional_info'] = text
                 
                 # Proceed to socioeconomic info
-                ask_socioeconomic_info(chat_id, user_id)
+                ask_socioeconomic_info(ctx)
             else:
                 # Not awaiting any input, suggest using /start
-                bot.send_message(chat_id, "Please use /start to begin using this bot.")
+                outbound.send_message(ctx.chat_id, "Please use /start to begin using this bot.")
     except Exception as e:
         logging.exception(f"Error in handle_text_input: {e}")
         # Try to get user's language for error message
         try:
-            lang_code = get_user_language(user_id)
-            bot.send_message(chat_id, messages[lang_code]['error_occurred'])
+            lang_code = ctx.lang_code
+            outbound.send_message(ctx.chat_id, messages[lang_code]['error_occurred'])
         except:
             # Fallback to English
-            bot.send_message(chat_id, "An error occurred. Please try again later.")
+            outbound.send_message(ctx.chat_id, "An error occurred. Please try again later.")
+
+class ChatShardedExecutor:
+    """
+    Runs updates on a fixed set of worker threads, sharded by chat.
+    
+    Every update of a chat lands on the same shard, and each shard handles
+    its bounded queue one update at a time, so updates of one chat are
+    processed strictly in arrival order while different chats run in
+    parallel across shards. stats() reports per-shard queue depth and
+    utilization and the lag between enqueueing and handling.
+    """
+    
+    _STOP = object()
+    
+    def __init__(self, shards, queue_size):
+        self.shards = shards
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(shards)]
+        self._busy_seconds = [0.0] * shards
+        self._processed = [0] * shards
+        self._lock = threading.Lock()
+        self._threads = []
+        self._started_at = None
+        self.failed = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+    
+    def is_running(self):
+        return bool(self._threads)
+    
+    def start(self):
+        """Start one worker thread per shard."""
+        if self._threads:
+            return
+        # Updates are handled on the shards, not on TeleBot's own worker pool
+        bot.threaded = False
+        self._started_at = time.monotonic()
+        for index in range(self.shards):
+            thread = threading.Thread(target=self._work, args=(index,), name=f"update-shard-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def stop(self, timeout=30):
+        """Let the shards finish their queued updates and stop them."""
+        for shard_queue in self._queues:
+            shard_queue.put(self._STOP)
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+    
+    def shard_for(self, key):
+        return hash(key) % self.shards
+    
+    def submit(self, key, update, block=True, timeout=None):
+        """
+        Queue an update on the shard of its chat
+        
+        Args:
+            key: Chat ID the update belongs to, or another ID for updates without a chat
+            update (telebot.types.Update): Update to handle
+            block (bool, optional): Wait for room in a full shard queue
+            timeout (float, optional): Seconds to wait when blocking
+            
+        Returns:
+            concurrent.futures.Future: Resolves once the update has been handled
+            
+        Raises:
+            queue.Full: The shard queue stayed full
+        """
+        future = concurrent.futures.Future()
+        self._queues[self.shard_for(key)].put((time.monotonic(), update, future), block=block, timeout=timeout)
+        return future
+    
+    def submit_update(self, update, block=True, timeout=None):
+        """Queue an update keyed by its chat, dropping it if its update_id was seen recently."""
+        if not seen_update_ids.add(update.update_id):
+            flow_logger.info(f"Dropping redelivered update {update.update_id}")
+            future = concurrent.futures.Future()
+            future.set_result(None)
+            return future
+        
+        key = _update_chat_id(update)
+        try:
+            return self.submit(update.update_id if key is None else key, update, block, timeout)
+        except queue.Full:
+            # Not queued, so a redelivery of this update must not count as a duplicate
+            seen_update_ids.discard(update.update_id)
+            raise
+    
+    def _work(self, index):
+        shard_queue = self._queues[index]
+        while True:
+            item = shard_queue.get()
+            if item is self._STOP:
+                return
+            queued_at, update, future = item
+            started = time.monotonic()
+            try:
+                bot.process_new_updates([update])
+                future.set_result(None)
+            except Exception as e:
+                logging.exception(f"Error handling update: {e}")
+                with self._lock:
+                    self.failed += 1
+                future.set_exception(e)
+            finished = time.monotonic()
+            with self._lock:
+                self._busy_seconds[index] += finished - started
+                self._processed[index] += 1
+                self.lag_total += started - queued_at
+                self.lag_max = max(self.lag_max, started - queued_at)
+    
+    def stats(self):
+        """Return queue depths, lag and per-shard utilization."""
+        with self._lock:
+            elapsed = time.monotonic() - self._started_at if self._started_at else 0.0
+            shards = [
+                {
+                    'depth': self._queues[index].qsize(),
+                    'processed': self._processed[index],
+                    'utilization': self._busy_seconds[index] / elapsed if elapsed else 0.0
+                }
+                for index in range(self.shards)
+            ]
+            processed = sum(self._processed)
+            return {
+                'queue_depth': sum(shard['depth'] for shard in shards),
+                'processed': processed,
+                'failed': self.failed,
+                'duplicates_dropped': seen_update_ids.duplicates,
+                'lag_mean': self.lag_total / processed if processed else 0.0,
+                'lag_max': self.lag_max,
+                'shards': shards
+            }
+
+update_executor = ChatShardedExecutor(UPDATE_SHARDS, UPDATE_SHARD_QUEUE_SIZE)
+
+def _update_chat_id(update):
+    """Return the ID of the chat an update belongs to, its sender's ID if it has no chat, or None."""
+    for message in (update.message, update.edited_message):
+        if message is not None:
+            return message.chat.id
+    callback_query = update.callback_query
+    if callback_query is not None:
+        # Callbacks from inline-mode messages carry no chat
+        if callback_query.message is not None:
+            return callback_query.message.chat.id
+        return callback_query.from_user.id
+    return None
+
+
+class WebhookServer:
+    """
+    Built-in HTTP server receiving updates pushed by Telegram.
+    
+    A POST to the webhook path is checked against the secret token, parsed,
+    queued on update_executor and acknowledged right away. When the shard
+    of the update's chat is full the update is refused with 503 so Telegram
+    redelivers it later, instead of the server accepting more than the
+    shards can handle.
+    """
+    
+    def __init__(self, listen, port, path, secret_token):
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self._lock = threading.Lock()
+        self._httpd = None
+        self.received = 0
+        self.accepted = 0
+        self.rejected_auth = 0
+        self.rejected_invalid = 0
+        self.rejected_full = 0
+    
+    def _make_handler(self):
+        server = self
+        
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                status = server.receive(
+                    self.path,
+                    self.headers.get('X-Telegram-Bot-Api-Secret-Token', ''),
+                    self.headers.get('Content-Length'),
+                    self.rfile
+                )
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            
+            def log_message(self, format, *args):
+                # Request lines would flood the log at webhook rates
+                pass
+        
+        return Handler
+    
+    def receive(self, path, secret_token, content_length, body_file):
+        """
+        Validate and queue one webhook request
+        
+        Returns:
+            int: HTTP status to answer with
+        """
+        with self._lock:
+            self.received += 1
+        
+        if path != self.path:
+            return 404
+        if not hmac.compare_digest(secret_token.encode(), self.secret_token.encode()):
+            with self._lock:
+                self.rejected_auth += 1
+            return 403
+        
+        try:
+            length = int(content_length)
+        except (TypeError, ValueError):
+            return 411
+        if length > WEBHOOK_MAX_BODY:
+            return 413
+        
+        try:
+            update = types.Update.de_json(body_file.read(length).decode('utf-8'))
+        except Exception:
+            with self._lock:
+                self.rejected_invalid += 1
+            return 400
+        
+        try:
+            update_executor.submit_update(update, block=False)
+        except queue.Full:
+            with self._lock:
+                self.rejected_full += 1
+            flow_logger.warning("Update shard full, refusing webhook update")
+            return 503
+        
+        with self._lock:
+            self.accepted += 1
+        return 200
+    
+    def start(self):
+        """Start the HTTP server thread."""
+        self._httpd = http.server.ThreadingHTTPServer((self.listen, self.port), self._make_handler())
+        self._httpd.daemon_threads = True
+        thread = threading.Thread(target=self._httpd.serve_forever, name="webhook-http", daemon=True)
+        thread.start()
+        flow_logger.info(f"Webhook server listening on {self.listen}:{self._httpd.server_address[1]}{self.path}")
+    
+    def stop(self):
+        """Stop accepting updates."""
+        if self._httpd is None:
+            return
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._httpd = None
+    
+    def stats(self):
+        """Return the request counters; backpressure shows in update_executor.stats()."""
+        with self._lock:
+            return {
+                'received': self.received,
+                'accepted': self.accepted,
+                'rejected_auth': self.rejected_auth,
+                'rejected_invalid': self.rejected_invalid,
+                'rejected_full': self.rejected_full
+            }
+
+webhook_server = WebhookServer(WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN)
+
+def run_webhook():
+    """Serve updates through the webhook server until interrupted."""
+    webhook_server.start()
+    atexit.register(webhook_server.stop)
+    
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN, max_connections=40)
+    
+    while True:
+        time.sleep(60)
+        flow_logger.info(f"Webhook stats: {webhook_server.stats()}, shards: {update_executor.stats()}")
+
+
+def run_polling():
+    """Long-poll for updates and queue them on the chat-sharded executor."""
+    offset = None
+    failures = 0
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=20, long_polling_timeout=20)
+            failures = 0
+        except Exception as e:
+            logging.exception(f"Bot polling failed: {e}")
+            # Back off quickly on a blip, up to 15s while the API stays unreachable
+            failures += 1
+            time.sleep(min(15, 2 ** (failures - 1)))
+            continue
+        
+        for update in updates:
+            offset = update.update_id + 1
+            # Blocks while the chat's shard is full, which slows down polling
+            update_executor.submit_update(update)
+
 
 # Start the bot
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="TurkuSpot Telegram bot")
+    parser.add_argument(
+        'command', nargs='?', default='run',
+        choices=['run', 'export', 'export-parquet', 'export-map', 'export-delta', 'compact-deltas'],
+        help="run the bot (default), write a full CSV or Parquet export, write GeoJSON and map tiles, "
+             "write a delta since the last one, or merge the deltas"
+    )
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], help="compress the exported file")
+    parser.add_argument('--name', default='default', help="watermark used by export-delta")
+    args = parser.parse_args()
+    
     # Initialize the database
     initialize_database()
     
     # Initialize the connection pool
     initialize_connection_pool()
     
-    while True:
-        try:
-            bot.polling(none_stop=True)
-        except Exception as e:
-            logging.exception(f"Bot polling failed: {e}")
-            time.sleep(15)
+    # Export commands run once and exit without starting the bot
+    if args.command != 'run':
+        if args.command == 'export':
+            result = export_data_to_csv(args.compression)
+        elif args.command == 'export-parquet':
+            result = export_data_to_parquet()
+        elif args.command == 'export-map':
+            result = export_map_layers(args.compression)
+        elif args.command == 'export-delta':
+            result = export_delta_csv(args.compression, name=args.name)
+        else:
+            result = compact_export_deltas(args.compression)
+        print(result or "Nothing written")
+        sys.exit(0)
+    
+    # Load known nicknames so repeat users skip the database lookup
+    prewarm_identity_cache()
+    
+    # Serialize the single-choice keyboards once instead of on every tap
+    precompute_keyboards()
+    
+    # Start the single writer thread and flush it on shutdown
+    submission_writer.start()
+    atexit.register(submission_writer.stop)
+    
+    # Recent submissions for linking nearby duplicates at confirmation time; rows from before
+    # the spatial columns existed only count once their coordinates are converted
+    backfill_coordinates(since=recent_submissions.window_start())
+    recent_submissions.load()
+    
+    # Convert TEXT coordinates of older rows for the spatial index without delaying startup
+    threading.Thread(target=backfill_coordinates, name='coordinate-backfill', daemon=True).start()
+    
+    # Drop abandoned conversations in the background
+    session_store.start()
+    atexit.register(session_store.stop)
+    
+    # Pace all Bot API requests; stopped last so pending edits can still go out
+    outbound.start()
+    atexit.register(outbound.stop)
+    
+    # Send debounced keyboard edits in the background
+    keyboard_refresher.start()
+    atexit.register(keyboard_refresher.stop)
+    
+    # Handle updates on per-chat ordered shards; stopped after intake ends
+    update_executor.start()
+    atexit.register(update_executor.stop)
+    
+    if BOT_RUNTIME == 'webhook':
+        run_webhook()
+    else:
+        run_polling()
 
 
 
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+import telebot.util
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The committed bot token is a placeholder; let TeleBot accept it so the module imports
+telebot.util.validate_token = lambda token: True
+telebot.util.extract_bot_id = lambda token: None
+
+
+@pytest.fixture
+def bot_module():
+    import TurkuSpotBot_code
+    return TurkuSpotBot_code
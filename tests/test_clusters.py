@@ -0,0 +1,51 @@
+import concurrent.futures
+import datetime
+import sqlite3
+
+
+def test_index_entries_are_removed_when_a_timed_out_batch_fails(bot_module, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot_module, 'db_file', str(tmp_path / 'bot.db'))
+    bot_module.initialize_database()
+    index = bot_module.RecentSubmissionIndex(100, 3600)
+    monkeypatch.setattr(bot_module, 'recent_submissions', index)
+    
+    # The writer accepts the job but has not finished the batch yet
+    future = concurrent.futures.Future()
+    monkeypatch.setattr(bot_module, 'submit_write', lambda job: future)
+    
+    unit = bot_module.SubmissionUnitOfWork('Tester', 'token')
+    unit.add_submission('issue', 'Littering', '', 60.45, 22.26)
+    assert unit.commit() is future
+    
+    conn = sqlite3.connect(bot_module.db_file)
+    unit.apply(conn)
+    conn.rollback()
+    conn.close()
+    assert index.stats()['entries'] == 1
+    
+    # save_data has already given up waiting when the batch fails
+    future.set_exception(sqlite3.OperationalError('disk I/O error'))
+    assert index.stats()['entries'] == 0
+
+
+def test_rows_from_before_the_spatial_columns_are_loaded_after_the_window_backfill(bot_module, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot_module, 'db_file', str(tmp_path / 'bot.db'))
+    bot_module.initialize_database()
+    monkeypatch.setattr(bot_module, 'db_pool', bot_module.ConnectionPool(2))
+    monkeypatch.setattr(bot_module, 'db_read_pool', bot_module.ConnectionPool(2, read_only=True))
+    index = bot_module.RecentSubmissionIndex(100, 3600)
+    
+    # Written before the upgrade: TEXT coordinates only
+    recent = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn = sqlite3.connect(bot_module.db_file)
+    conn.executemany(
+        "INSERT INTO submissions (user_id, submission_type, standard_selections, latitude, longitude, timestamp) "
+        "VALUES ('Tester', 'issue', 'Littering', '60.45', '22.26', ?)",
+        [('2000-01-01 00:00:00',), (recent,)]
+    )
+    conn.commit()
+    
+    assert bot_module.backfill_coordinates(since=index.window_start()) == 1
+    assert index.load() == 1
+    assert conn.execute("SELECT id FROM submissions WHERE lat IS NULL").fetchall() == [(1,)]
+    conn.close()
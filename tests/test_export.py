@@ -0,0 +1,14 @@
+import sqlite3
+
+
+def test_changed_rows_query_is_driven_by_the_version_index(bot_module, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot_module, 'db_file', str(tmp_path / 'bot.db'))
+    bot_module.initialize_database()
+    
+    conn = sqlite3.connect(bot_module.db_file)
+    params = {'since_version': 0, 'max_version': 1, 'since_id': 10, 'after': 0, 'limit': 10}
+    plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + bot_module.EXPORT_CHANGED_ROWS_QUERY, params)]
+    conn.close()
+    
+    assert plan[0].startswith('SEARCH p USING INDEX idx_user_preferences_version')
+    assert plan[1].startswith('SEARCH s USING INDEX idx_user_id')
@@ -0,0 +1,11 @@
+import time
+
+
+def test_flow_log_is_written_when_the_module_is_imported(bot_module):
+    bot_module.flow_logger.info("Imported without running the bot")
+    
+    deadline = time.monotonic() + 5
+    while bot_module.flow_log_queue.qsize() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert bot_module.flow_log_queue.qsize() == 0
+    assert bot_module.flow_log_handler.stats()['dropped'] == 0
@@ -0,0 +1,37 @@
+import threading
+import time
+
+
+def test_throttled_chat_does_not_delay_other_chats(bot_module, monkeypatch):
+    sent = {}
+    lock = threading.Lock()
+    
+    def edit_message_reply_markup(chat_id=None, message_id=None, reply_markup=None):
+        with lock:
+            sent[chat_id] = time.monotonic()
+        return True
+    
+    monkeypatch.setattr(bot_module.bot, 'edit_message_reply_markup', edit_message_reply_markup)
+    # One request per chat per second, so chat 0 is throttled after its first edit
+    outbound = bot_module.OutboundScheduler(1000, 1000, 1, 1, workers=4, max_retries=0)
+    monkeypatch.setattr(bot_module, 'outbound', outbound)
+    refresher = bot_module.KeyboardRefreshScheduler(0.1)
+    
+    outbound.start()
+    refresher.start()
+    try:
+        outbound.edit_message_reply_markup(chat_id=0, message_id=1, reply_markup='{}')
+        start = time.monotonic()
+        for chat_id in range(21):
+            refresher.schedule(chat_id, 2, '{}')
+        deadline = time.monotonic() + 5
+        while len(sent) < 21 or sent[0] - start < 0.5:
+            assert time.monotonic() < deadline
+            time.sleep(0.02)
+    finally:
+        refresher.stop()
+        outbound.stop()
+    
+    others = [sent[chat_id] - start for chat_id in range(1, 21)]
+    assert max(others) < 0.5
+    assert refresher.stats()['sent'] == 21
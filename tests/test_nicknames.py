@@ -0,0 +1,41 @@
+def test_claim_registers_through_the_writer(bot_module, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot_module, 'db_file', str(tmp_path / 'bot.db'))
+    bot_module.initialize_database()
+    monkeypatch.setattr(bot_module, 'db_pool', bot_module.ConnectionPool(2))
+    monkeypatch.setattr(bot_module, 'db_read_pool', bot_module.ConnectionPool(2, read_only=True))
+    
+    jobs = []
+    submit_write = bot_module.submit_write
+    
+    def recording_submit_write(job):
+        jobs.append(job)
+        return submit_write(job)
+    
+    monkeypatch.setattr(bot_module, 'submit_write', recording_submit_write)
+    registry = bot_module.NicknameRegistry(max_attempts=10)
+    
+    nickname = registry.claim(1234)
+    assert len(jobs) == 1
+    
+    # Known users are answered from the read pool without a write
+    assert registry.claim(1234) == nickname
+    assert len(jobs) == 1
+    assert registry.stats()['assigned'] == 1
+
+
+def test_lookup_failure_gives_a_stable_fallback_that_is_not_cached(bot_module, monkeypatch):
+    monkeypatch.setattr(bot_module, 'identity_cache', bot_module.IdentityCache(10))
+    monkeypatch.setattr(bot_module, 'fallback_identity_cache', bot_module.IdentityCache(10))
+    
+    def failing_claim(telegram_id):
+        raise bot_module.sqlite3.OperationalError('database is locked')
+    
+    monkeypatch.setattr(bot_module.nickname_registry, 'claim', failing_claim)
+    fallback = bot_module.get_anonymous_user_id(1234)
+    assert fallback.startswith('Anonymous')
+    assert bot_module.get_anonymous_user_id(1234) == fallback
+    
+    # Once the database answers again the stored nickname is used and cached
+    monkeypatch.setattr(bot_module.nickname_registry, 'claim', lambda telegram_id: 'QuietOtter123')
+    assert bot_module.get_anonymous_user_id(1234) == 'QuietOtter123'
+    assert bot_module.identity_cache.get(1234) == 'QuietOtter123'
@@ -0,0 +1,179 @@
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+import pytest
+import telebot
+
+
+class FakeBotApi(http.server.BaseHTTPRequestHandler):
+    """Bot API stand-in that records every call and answers 429 while told to."""
+    
+    protocol_version = 'HTTP/1.1'
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        method = url.path.rsplit('/', 1)[-1]
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params.update(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        
+        server = self.server
+        with server.lock:
+            server.calls.append((time.monotonic(), method, params))
+            limited = server.rate_limits.get(params.get('chat_id'), 0)
+            if limited:
+                server.rate_limits[params['chat_id']] = limited - 1
+        
+        if limited:
+            status, body = 429, {
+                'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1}
+            }
+        elif method == 'sendMessage':
+            status, body = 200, {'ok': True, 'result': {
+                'message_id': len(server.calls), 'date': 0, 'text': params.get('text', ''),
+                'chat': {'id': int(params['chat_id']), 'type': 'private'}
+            }}
+        else:
+            status, body = 200, {'ok': True, 'result': True}
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    do_GET = do_POST
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeBotApi)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.calls = []
+    server.rate_limits = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(telebot.apihelper, 'API_URL', f"http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_scheduler(bot_module):
+    schedulers = []
+    
+    def make(global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000, workers=4):
+        scheduler = bot_module.OutboundScheduler(global_rate, global_burst, chat_rate, chat_burst, workers, 5)
+        schedulers.append(scheduler)
+        return scheduler
+    
+    yield make
+    for scheduler in schedulers:
+        scheduler.stop()
+
+
+def send(bot_module, scheduler, chat_id, text, priority=None):
+    if priority is None:
+        priority = scheduler.PRIORITY_MESSAGE
+    return scheduler.submit(priority, chat_id, bot_module.bot.send_message, (chat_id, text))
+
+
+def test_global_bucket_paces_requests_across_chats(bot_module, fake_api, make_scheduler):
+    scheduler = make_scheduler(global_rate=20, global_burst=1)
+    scheduler.start()
+    
+    futures = [send(bot_module, scheduler, chat_id, "hello") for chat_id in range(1, 12)]
+    for future in futures:
+        future.result(timeout=10)
+    
+    times = [call[0] for call in fake_api.calls]
+    # 11 requests at 20 per second need at least 10 intervals of 50 ms
+    assert len(times) == 11
+    assert times[-1] - times[0] >= 0.45
+
+
+def test_chat_bucket_paces_one_chat_without_delaying_others(bot_module, fake_api, make_scheduler):
+    scheduler = make_scheduler(chat_rate=10, chat_burst=1)
+    scheduler.start()
+    
+    busy = [send(bot_module, scheduler, 1, f"busy {index}") for index in range(6)]
+    other = send(bot_module, scheduler, 2, "other")
+    for future in busy + [other]:
+        future.result(timeout=10)
+    
+    busy_calls = [call for call in fake_api.calls if call[2]['chat_id'] == '1']
+    other_call = next(call for call in fake_api.calls if call[2]['chat_id'] == '2')
+    assert [call[2]['text'] for call in busy_calls] == [f"busy {index}" for index in range(6)]
+    assert busy_calls[-1][0] - busy_calls[0][0] >= 0.45
+    assert other_call[0] - busy_calls[0][0] < 0.1
+
+
+def test_priority_classes_go_out_in_order(bot_module, fake_api, make_scheduler):
+    scheduler = make_scheduler(workers=1)
+    bot = bot_module.bot
+    
+    # Queued before the dispatcher starts, so its choice alone decides the order
+    for index in range(3):
+        send(bot_module, scheduler, 10 + index, "message")
+        scheduler.submit(
+            scheduler.PRIORITY_KEYBOARD_EDIT, 10 + index, bot.edit_message_reply_markup,
+            (), {'chat_id': 10 + index, 'message_id': 1}
+        )
+        scheduler.submit(scheduler.PRIORITY_CALLBACK_ANSWER, None, bot.answer_callback_query, (str(index),))
+    scheduler.start()
+    scheduler.stop()
+    
+    assert [call[1] for call in fake_api.calls] == (
+        ['answerCallbackQuery'] * 3 + ['editMessageReplyMarkup'] * 3 + ['sendMessage'] * 3
+    )
+
+
+def test_rate_limited_request_is_retried_after_retry_after(bot_module, fake_api, make_scheduler):
+    scheduler = make_scheduler()
+    scheduler.start()
+    fake_api.rate_limits['5'] = 1
+    
+    limited = send(bot_module, scheduler, 5, "first")
+    deadline = time.monotonic() + 5
+    while scheduler.stats()['rate_limited'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # Queued while the chat is blocked, so it must wait behind the retry
+    later = send(bot_module, scheduler, 5, "second")
+    other = send(bot_module, scheduler, 6, "other chat")
+    
+    assert other.result(timeout=10).text == "other chat"
+    assert limited.result(timeout=10).text == "first"
+    assert later.result(timeout=10).text == "second"
+    
+    chat_calls = [call for call in fake_api.calls if call[2]['chat_id'] == '5']
+    other_call = next(call for call in fake_api.calls if call[2]['chat_id'] == '6')
+    assert sorted(call[2]['text'] for call in chat_calls) == ["first", "first", "second"]
+    # Nothing else goes to the blocked chat until retry_after has passed; other chats are not held up
+    assert chat_calls[0][2]['text'] == "first"
+    assert min(call[0] for call in chat_calls[1:]) - chat_calls[0][0] >= 0.95
+    assert other_call[0] - chat_calls[0][0] < 0.5
+    assert scheduler.stats()['rate_limited'] == 1
+    assert scheduler.stats()['failed'] == 0
+
+
+def test_stop_fails_requests_requeued_after_the_dispatcher_exited(bot_module, fake_api, make_scheduler):
+    scheduler = make_scheduler()
+    scheduler.start()
+    fake_api.rate_limits['5'] = 1
+    
+    limited = send(bot_module, scheduler, 5, "first")
+    # The 429 arrives while stop() waits for the sender pool, after the dispatcher has returned
+    scheduler.stop()
+    
+    with pytest.raises(RuntimeError, match="stopped"):
+        limited.result(timeout=1)
+    assert scheduler.stats()['queued_messages'] == 0
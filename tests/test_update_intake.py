@@ -0,0 +1,99 @@
+import io
+import json
+import threading
+
+from telebot import types
+
+
+def _update_body(update_id, user_id):
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': 'hello',
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test'},
+        },
+    }).encode()
+
+
+def _post(server, body):
+    return server.receive(server.path, server.secret_token, str(len(body)), io.BytesIO(body))
+
+
+def test_update_refused_with_503_is_processed_when_redelivered(bot_module, monkeypatch):
+    handled = []
+    done = threading.Event()
+    
+    def process_new_updates(updates):
+        handled.extend(update.update_id for update in updates)
+        if 2 in handled:
+            done.set()
+    
+    monkeypatch.setattr(bot_module.bot, 'process_new_updates', process_new_updates)
+    
+    # One shard with room for one update, not started yet so the first update fills it
+    executor = bot_module.ChatShardedExecutor(shards=1, queue_size=1)
+    monkeypatch.setattr(bot_module, 'update_executor', executor)
+    monkeypatch.setattr(bot_module, 'seen_update_ids', bot_module.RecentKeys(100))
+    server = bot_module.WebhookServer('127.0.0.1', 0, '/hook', 'secret')
+    
+    assert _post(server, _update_body(1, 42)) == 200
+    assert _post(server, _update_body(2, 42)) == 503
+    
+    executor.start()
+    try:
+        # Telegram redelivers the refused update
+        assert _post(server, _update_body(2, 42)) == 200
+        assert done.wait(5)
+    finally:
+        executor.stop()
+    
+    assert handled == [1, 2]
+    assert executor.stats()['duplicates_dropped'] == 0
+
+
+def test_redelivered_update_is_dropped_once_queued(bot_module, monkeypatch):
+    handled = []
+    monkeypatch.setattr(bot_module.bot, 'process_new_updates', lambda updates: handled.extend(updates))
+    monkeypatch.setattr(bot_module, 'seen_update_ids', bot_module.RecentKeys(100))
+    executor = bot_module.ChatShardedExecutor(shards=2, queue_size=10)
+    
+    update = types.Update.de_json(_update_body(7, 42).decode())
+    executor.start()
+    try:
+        executor.submit_update(update).result(5)
+        executor.submit_update(update).result(5)
+    finally:
+        executor.stop()
+    
+    assert len(handled) == 1
+
+
+def test_updates_are_sharded_by_chat(bot_module):
+    group_chat = {'id': -100, 'type': 'group'}
+    message = types.Update.de_json(json.dumps({
+        'update_id': 1,
+        'message': {
+            'message_id': 1, 'date': 0, 'text': 'hello', 'chat': group_chat,
+            'from': {'id': 42, 'is_bot': False, 'first_name': 'Test'},
+        },
+    }))
+    callback = types.Update.de_json(json.dumps({
+        'update_id': 2,
+        'callback_query': {
+            'id': '1', 'chat_instance': '1', 'data': 'x',
+            'from': {'id': 43, 'is_bot': False, 'first_name': 'Other'},
+            'message': {'message_id': 1, 'date': 0, 'text': 'q', 'chat': group_chat},
+        },
+    }))
+    inline_callback = types.Update.de_json(json.dumps({
+        'update_id': 3,
+        'callback_query': {
+            'id': '2', 'chat_instance': '1', 'data': 'x', 'inline_message_id': 'abc',
+            'from': {'id': 44, 'is_bot': False, 'first_name': 'Inline'},
+        },
+    }))
+    
+    assert bot_module._update_chat_id(message) == -100
+    assert bot_module._update_chat_id(callback) == -100
+    assert bot_module._update_chat_id(inline_callback) == 44